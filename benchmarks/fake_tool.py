@@ -0,0 +1,158 @@
+# Every fake on PATH is a wrapper running this file with the tool's name
+# as first argument. It sleeps for a latency drawn from the profile in
+# BOOTBAKER_FAKE_PROFILE and produces the outputs bootbaker reads back,
+# qemu prints a scripted console ending in a pass, a failure or a hang.
+import hashlib
+import random
+import shlex
+import json
+import math
+import time
+import sys
+import os
+
+
+def load_profile():
+    with open(os.environ["BOOTBAKER_FAKE_PROFILE"], 'r') as f:
+        return json.load(f)
+
+
+def sample(spec, rng):
+    # seconds drawn from a latency distribution, never negative
+    if spec is None:
+        return 0.0
+    if isinstance(spec, (int, float)):
+        return float(spec)
+    dist = spec.get("dist", "constant")
+    if dist == "constant":
+        value = spec["value"]
+    elif dist == "uniform":
+        value = rng.uniform(spec["low"], spec["high"])
+    elif dist == "normal":
+        value = rng.gauss(spec["mean"], spec["stdev"])
+    elif dist == "lognormal":
+        value = rng.lognormvariate(math.log(spec["median"]), spec["sigma"])
+    else:
+        raise ValueError(f"Unknown latency distribution {dist}")
+    return max(0.0, value)
+
+
+def option(args, flag):
+    # value of a "-x value" option
+    for i, arg in enumerate(args[:-1]):
+        if arg == flag:
+            return args[i + 1]
+    return None
+
+
+def positionals(args, with_value):
+    # arguments left once options and their values are skipped
+    result = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg.startswith("-"):
+            skip = arg in with_value
+        else:
+            result.append(arg)
+    return result
+
+
+def create(path, size=0):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.truncate(size)
+
+
+def makefs(args):
+    # makefs [-t type] [-o opt] [-s size] [-B order] image dir...
+    image = positionals(args, {"-t", "-o", "-s", "-B"})[0]
+    create(image, int(option(args, "-s") or 0))
+
+
+def mkimg(args):
+    # the image is as large as its partitions, -p type:=file
+    size = 0
+    for arg in args:
+        if ":=" in arg and os.path.exists(arg.split(":=", 1)[1]):
+            size += os.path.getsize(arg.split(":=", 1)[1])
+    create(option(args, "-o"), size)
+
+
+def mtree(args):
+    os.makedirs(os.path.join(option(args, "-p"), "boot"), exist_ok=True)
+
+
+def make(args):
+    # make buildenv runs the real command from $SHELL, only install has output
+    command = shlex.split(os.environ.get("SHELL", ""))
+    if "install" not in command:
+        return
+    for arg in command:
+        if arg.startswith("DESTDIR="):
+            destdir = arg.split("=", 1)[1]
+            for name in ["boot/loader.efi", "boot/lua/loader.lua", "boot/defaults/loader.conf"]:
+                create(os.path.join(destdir, name), 4096)
+
+
+def qemu_img(args):
+    # qemu-img create ... -b backing overlay
+    create(args[-1])
+
+
+def drive(args):
+    # file of the first -drive, the boot disk in every recipe
+    spec = option(args, "-drive") or ""
+    for part in spec.split(","):
+        if part.startswith("file="):
+            return part[len("file="):]
+    return None
+
+
+def qemu(profile, rng, args):
+    # prints the console in steps, then a verdict line or nothing at all
+    if profile.get("write_disk") and "-snapshot" not in args:
+        # a booting guest writes to its disk, e.g. fsck and rc
+        with open(drive(args), 'r+b') as f:
+            f.write(b"written by the guest")
+    lines = profile.get("console", [])
+    boot = sample(profile.get("boot"), rng)
+    for line in lines:
+        print(line, flush=True)
+        time.sleep(boot / max(len(lines), 1))
+    outcomes = profile.get("outcomes", {"pass": 1.0})
+    outcome = rng.choices(list(outcomes), weights=list(outcomes.values()))[0]
+    if outcome == "pass":
+        print("RC COMMAND RUNNING -- SUCCESS!!!", flush=True)
+    elif outcome == "fail":
+        print("panic: fake failure", flush=True)
+    else:
+        time.sleep(profile.get("hang", 3600))
+    # the engine kills the guest once it has a verdict
+    time.sleep(profile.get("linger", 0))
+
+
+def main():
+    tool, args = sys.argv[1], sys.argv[2:]
+    profile = load_profile()
+    kind = "qemu" if tool.startswith("qemu-system-") else tool
+    spec = profile.get(kind, {})
+    # the same command line gets the same latency across runs, the monitor
+    # endpoint and the scratch area differ every run so they are left out
+    scratch = os.environ.get("BOOTBAKER_SCRATCH")
+    stable = [arg.replace(scratch, "") if scratch else arg
+              for i, arg in enumerate(args) if i == 0 or args[i - 1] != "-monitor"]
+    seed = f"{profile.get('seed', 0)} {tool} {' '.join(stable)} {os.environ.get('SHELL', '')}"
+    rng = random.Random(hashlib.sha256(seed.encode()).hexdigest())
+    time.sleep(sample(spec.get("latency"), rng))
+    if kind == "qemu":
+        qemu(spec, rng, args)
+        return 0
+    handlers = {"makefs": makefs, "mkimg": mkimg, "mtree": mtree, "make": make, "qemu-img": qemu_img}
+    handlers[kind](args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
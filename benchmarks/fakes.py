@@ -0,0 +1,32 @@
+import sys
+import os
+
+
+# FakeTools puts stand-ins for the external tools bootbaker runs into a bin
+# directory, prepended to PATH they are found instead of the real ones.
+# Their latency and console output are scripted by a JSON profile, see
+# profiles/default.json and fake_tool.py
+class FakeTools:
+    TOOLS = ["qemu-system-x86_64", "qemu-system-aarch64", "qemu-system-arm", "qemu-system-riscv64",
+             "qemu-system-ppc64", "qemu-img", "makefs", "mkimg", "mtree", "make"]
+    FAKE_TOOL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_tool.py")
+    DEFAULT_PROFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles", "default.json")
+
+    def __init__(self, bin_dir, profile=None):
+        self.bin_dir = bin_dir
+        self.profile = os.path.abspath(profile or self.DEFAULT_PROFILE)
+
+    def install(self):
+        os.makedirs(self.bin_dir, exist_ok=True)
+        for tool in self.TOOLS:
+            path = os.path.join(self.bin_dir, tool)
+            with open(path, 'w') as f:
+                f.write(f'#!/bin/sh\nexec "{sys.executable}" "{self.FAKE_TOOL}" {tool} "$@"\n')
+            os.chmod(path, 0o755)
+        return self
+
+    def env(self, base=None):
+        # environment a process needs to pick up the fakes
+        base = dict(os.environ if base is None else base)
+        return {**base, "PATH": f"{self.bin_dir}{os.pathsep}{base.get('PATH', '')}",
+                "BOOTBAKER_FAKE_PROFILE": self.profile}
@@ -0,0 +1,150 @@
+import random
+import stat
+import lzma
+
+# A small ISO9660 image with Rock Ridge names and modes holding the members
+# the tree stage extracts, xz compressed like a release bootonly.iso. It is
+# laid out like mkisofs -R output: volume descriptors, path tables and
+# directory records carrying SUSP/Rock Ridge entries, so ISO9660Reader reads
+# it as it reads the real thing and other ISO tools list it too.
+
+SECTOR_SIZE = 2048
+MEMBERS = [
+    "sbin/reboot", "sbin/halt", "sbin/init", "bin/sh", "sbin/sysctl",
+    "lib/libncursesw.so.9", "lib/libc.so.7", "lib/libgcc_s.so.1", "lib/libedit.so.8", "libexec/ld-elf.so.1",
+    "boot/kernel/kernel", "boot/kernel/acl_nfs4.ko", "boot/kernel/cryptodev.ko", "boot/kernel/zfs.ko",
+    "boot/kernel/geom_eli.ko", "boot/device.hints",
+    # not extracted, they only make the directory tree less trivial
+    "bin/ls", "bin/cat", "usr/bin/true", "usr/lib/libutil.so.9", "etc/rc.conf",
+]
+
+
+def both16(value):
+    return value.to_bytes(2, "little") + value.to_bytes(2, "big")
+
+
+def both32(value):
+    return value.to_bytes(4, "little") + value.to_bytes(4, "big")
+
+
+def content(path, size):
+    # deterministic and about half compressible, like binaries
+    rng = random.Random(path)
+    data = bytearray(size)
+    for offset in range(0, size, 512):
+        data[offset:offset + 256] = rng.randbytes(min(256, size - offset))
+    return bytes(data)
+
+
+def rock_ridge(name, mode, root=False):
+    entries = b""
+    if root:
+        # SUSP indicator, no bytes skipped before the entries of other records
+        entries += b"SP" + bytes([7, 1]) + b"\xbe\xef" + bytes([0])
+    entries += b"PX" + bytes([36, 1]) + both32(mode) + both32(1) + both32(0) + both32(0)
+    if name:
+        encoded = name.encode()
+        entries += b"NM" + bytes([5 + len(encoded), 1, 0]) + encoded
+    return entries
+
+
+def record(raw_name, extent, size, is_dir, system_use=b""):
+    padding = b"" if len(raw_name) % 2 else b"\x00"
+    body = (both32(extent) + both32(size) + bytes(7) + bytes([0x02 if is_dir else 0, 0, 0]) + both16(1)
+            + bytes([len(raw_name)]) + raw_name + padding + system_use)
+    length = 2 + len(body)
+    if length % 2:
+        body += b"\x00"
+        length += 1
+    return bytes([length, 0]) + body
+
+
+def build_iso(members=MEMBERS, member_bytes=256 * 1024):
+    # directory path -> child names, "" is the root
+    dirs = {"": []}
+    for member in members:
+        parts = member.split("/")
+        for depth in range(1, len(parts)):
+            parent, path = "/".join(parts[:depth - 1]), "/".join(parts[:depth])
+            if path not in dirs:
+                dirs[path] = []
+                dirs[parent].append(parts[depth - 1])
+        dirs["/".join(parts[:-1])].append(parts[-1])
+
+    def child(directory, name):
+        return f"{directory}/{name}" if directory else name
+
+    def dir_records(directory, extents, sizes):
+        # records never cross a sector, the rest of a full sector is padding
+        records = [record(b"\x00", extents.get(directory, 0), sizes.get(directory, 0), True,
+                          rock_ridge(None, stat.S_IFDIR | 0o755, root=directory == "")),
+                   record(b"\x01", extents.get(directory, 0), sizes.get(directory, 0), True,
+                          rock_ridge(None, stat.S_IFDIR | 0o755))]
+        for name in sorted(dirs[directory]):
+            path = child(directory, name)
+            is_dir = path in dirs
+            raw_name = name.upper().encode() + (b"" if is_dir else b";1")
+            mode = stat.S_IFDIR | 0o755 if is_dir else stat.S_IFREG | 0o555
+            records.append(record(raw_name, extents.get(path, 0), sizes.get(path, 0), is_dir, rock_ridge(name, mode)))
+        data = b""
+        for rec in records:
+            if len(data) % SECTOR_SIZE + len(rec) > SECTOR_SIZE:
+                data += bytes(SECTOR_SIZE - len(data) % SECTOR_SIZE)
+            data += rec
+        return data + bytes(-len(data) % SECTOR_SIZE)
+
+    def path_table(extents, order, big_endian):
+        # directories by depth then name, each naming its parent's position
+        byteorder = "big" if big_endian else "little"
+        table = b""
+        for directory in order:
+            name = directory.rsplit("/", 1)[-1].upper().encode() or b"\x00"
+            parent = order.index(directory.rsplit("/", 1)[0] if "/" in directory else "") + 1
+            table += (bytes([len(name), 0]) + extents[directory].to_bytes(4, byteorder)
+                      + parent.to_bytes(2, byteorder) + name + bytes(len(name) % 2))
+        return table
+
+    # record lengths do not depend on extents, lay out the path tables,
+    # directories then files
+    order = sorted(dirs, key=lambda d: (d.count("/") + bool(d), d))
+    extents, sizes = {}, {}
+    sector = 20
+    for directory in order:
+        extents[directory] = sector
+        sizes[directory] = len(dir_records(directory, {}, {}))
+        sector += sizes[directory] // SECTOR_SIZE
+    for member in members:
+        extents[member] = sector
+        sizes[member] = member_bytes
+        sector += -(-member_bytes // SECTOR_SIZE)
+
+    image = bytearray(sector * SECTOR_SIZE)
+    pvd = bytearray(SECTOR_SIZE)
+    pvd[0:8] = b"\x01CD001\x01\x00"
+    pvd[8:72] = b" " * 32 + b"BOOTBAKER_BENCH".ljust(32)
+    pvd[80:88] = both32(sector)
+    pvd[120:124] = both16(1)
+    pvd[124:128] = both16(1)
+    pvd[128:132] = both16(SECTOR_SIZE)
+    path_table_size = len(path_table(extents, order, False))
+    pvd[132:140] = both32(path_table_size)
+    pvd[140:144] = (18).to_bytes(4, "little")
+    pvd[148:152] = (19).to_bytes(4, "big")
+    pvd[156:190] = record(b"\x00", extents[""], sizes[""], True)
+    pvd[881] = 1
+    image[16 * SECTOR_SIZE:17 * SECTOR_SIZE] = pvd
+    image[17 * SECTOR_SIZE:17 * SECTOR_SIZE + 7] = b"\xffCD001\x01"
+    image[18 * SECTOR_SIZE:18 * SECTOR_SIZE + path_table_size] = path_table(extents, order, False)
+    image[19 * SECTOR_SIZE:19 * SECTOR_SIZE + path_table_size] = path_table(extents, order, True)
+    for directory in dirs:
+        data = dir_records(directory, extents, sizes)
+        image[extents[directory] * SECTOR_SIZE:extents[directory] * SECTOR_SIZE + len(data)] = data
+    for member in members:
+        offset = extents[member] * SECTOR_SIZE
+        image[offset:offset + member_bytes] = content(member, member_bytes)
+    return bytes(image)
+
+
+def write_iso_xz(path, members=MEMBERS, member_bytes=256 * 1024):
+    with lzma.open(path, "wb", format=lzma.FORMAT_XZ, preset=1) as f:
+        f.write(build_iso(members, member_bytes))
@@ -0,0 +1,279 @@
+from benchmarks.fakes import FakeTools
+from benchmarks.iso_fixture import write_iso_xz
+from contextlib import redirect_stdout
+import subprocess
+import itertools
+import platform
+import resource
+import tempfile
+import shutil
+import click
+import json
+import time
+import yaml
+import sys
+import io
+import os
+
+# src is only imported by the measuring process, after BOOTBAKER_ROOT and
+# BOOTBAKER_SRCTOP point at its scratch area
+
+SUITES = ["parser", "build", "schedule", "stream"]
+# metrics compared against a baseline, lower is better for all of them
+KEY_METRICS = {
+    "parser": ["seconds", "first_config_seconds"],
+    "build": ["seconds", "coordinator_cpu"],
+    "schedule": ["makespan", "coordinator_cpu"],
+    "stream": ["makespan", "coordinator_cpu"],
+}
+# arch axis of the benchmark matrix, the arches with a qemu recipe
+ARCHES = "{amd64:amd64,arm64:aarch64}"
+CONFIGS_PER_VERSION = 16
+
+
+def matrix(size):
+    # yields size configs, the matrix grows by adding versions
+    from src.core.parser import Parser
+    versions = [f"{13 + i // 10}.{i % 10}" for i in range(-(-size // CONFIGS_PER_VERSION))]
+    recipe = {"recipe": {"arch": ARCHES, "regex_combination": ["*-*-*"], "version": versions}}
+    return itertools.islice(Parser(io.StringIO(yaml.safe_dump(recipe))).generate_configs(), size)
+
+
+def use_fake_qemu():
+    # the recipes call qemu by absolute path, the fakes are found on PATH
+    from src.utils.freebsd_utils import FreeBSDUtils
+    get_qemu_bin = FreeBSDUtils.get_qemu_bin
+    FreeBSDUtils.get_qemu_bin = lambda ma: get_qemu_bin(ma) and os.path.basename(get_qemu_bin(ma))
+    FreeBSDUtils.QEMU_IMG = "qemu-img"
+
+
+def cpu_times():
+    # (this process, its children) in cpu seconds
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime
+
+
+def measure_parser(size, jobs, timeout):
+    # imported first so the import is not timed
+    import src.core.parser  # noqa: F401
+    start = time.perf_counter()
+    configs = matrix(size)
+    next(configs)
+    first = time.perf_counter() - start
+    count = 1 + sum(1 for _ in configs)
+    seconds = time.perf_counter() - start
+    return {"configs": count, "seconds": seconds, "first_config_seconds": first,
+            "configs_per_second": count / seconds}
+
+
+def bench_builder():
+    from src.core.builder import ConfigBuilder
+
+    # the real builder with the download and firmware steps replaced, the
+    # download leaves a generated bootonly .iso.xz the tree stage extracts
+    # from with ISO9660Reader as it does from a release image
+    class BenchBuilder(ConfigBuilder):
+
+        def update_freebsd_img_cache(self):
+            xz_file = os.path.join(self.CACHE_DIR, f"{self.img_file}.xz")
+            if not os.path.exists(xz_file):
+                with open(os.environ["BOOTBAKER_FAKE_PROFILE"], 'r') as f:
+                    member_bytes = json.load(f).get("iso", {}).get("member_bytes", 256 * 1024)
+                write_iso_xz(xz_file, member_bytes=member_bytes)
+
+        def build_freebsd_firmware(self):
+            for path in self.get_bios_files():
+                with open(path, 'wb') as f:
+                    f.truncate(64 * 1024)
+
+    return BenchBuilder
+
+
+def measure_build(size, jobs, timeout):
+    from src.core import pipeline
+    use_fake_qemu()
+    pipeline.ConfigBuilder = bench_builder()
+    configs = list(matrix(size))
+    cpu, children = cpu_times()
+    start = time.perf_counter()
+    build = pipeline.BuildPipeline(configs, max_workers=jobs)
+    with redirect_stdout(io.StringIO()):
+        built = build.run()
+    seconds = time.perf_counter() - start
+    stages = {}
+    for stage in build.graph.stages.values():
+        kind = stages.setdefault(stage.key.split(":")[0], {"count": 0, "seconds": 0.0})
+        kind["count"] += 1
+        kind["seconds"] += stage.elapsed
+    cpu_end, children_end = cpu_times()
+    return {"configs": len(configs), "built": len(built), "seconds": seconds,
+            "configs_per_second": len(configs) / seconds, "stages": stages,
+            "coordinator_cpu": cpu_end - cpu, "tools_cpu": children_end - children}
+
+
+def measure_schedule(size, jobs, timeout):
+    from src.core.resource_manager import ResourceManager
+    from src.utils.freebsd_utils import FreeBSDUtils
+    use_fake_qemu()
+    configs = list(matrix(size))
+    image = os.path.join(os.environ["BOOTBAKER_ROOT"], "image", "bench.img")
+    os.makedirs(os.path.dirname(image), exist_ok=True)
+    with open(image, 'wb') as f:
+        f.truncate(1024 * 1024)
+    for config in configs:
+        os.makedirs(config.script_dir, exist_ok=True)
+        with open(os.path.join(config.script_dir, config.script_file), 'w') as script:
+            script.write(FreeBSDUtils.get_qemu_recipe(config.machine, config.machine_arch, config.filesystem, image,
+                                                      image, image, config.monitor, config.disk_mode))
+
+    manager = ResourceManager(configs, reverify=True)
+    manager.timeout = timeout
+    if jobs:
+        manager.scheduler.max_jobs = jobs
+    # most guests running at once, as admitted
+    peak = [0]
+    admit = manager.scheduler.admit
+
+    def admit_and_count():
+        admit()
+        peak[0] = max(peak[0], len(manager.scheduler.running))
+    manager.scheduler.admit = admit_and_count
+
+    cpu, children = cpu_times()
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        results = manager.work()
+    makespan = time.perf_counter() - start
+    cpu_end, children_end = cpu_times()
+
+    # a makespan no schedule can beat: all guest cpu time spread over the
+    # cores, or the longest guest
+    work = sum(result.elapsed * manager.scheduler.cost(result.config)[0] for result in results)
+    ideal = max(work / manager.scheduler.cpu_cores, max(result.elapsed for result in results))
+    return {"configs": len(configs), "makespan": makespan, "ideal": ideal, "efficiency": ideal / makespan,
+            "cpu_cores": manager.scheduler.cpu_cores, "peak_guests": peak[0],
+            "mean_guests": sum(result.elapsed for result in results) / makespan,
+            "counters": manager.counters, "coordinator_cpu": cpu_end - cpu,
+            "coordinator_cpu_per_config": (cpu_end - cpu) / len(configs), "guests_cpu": children_end - children}
+
+
+def measure_stream(size, jobs, timeout):
+    # build and test as run --stream does, guests boot while images are built
+    from src.core import pipeline
+    from src.core.resource_manager import ResourceManager
+    use_fake_qemu()
+    pipeline.ConfigBuilder = bench_builder()
+    manager = ResourceManager([], reverify=True, max_jobs=jobs)
+    manager.timeout = timeout
+    cpu, children = cpu_times()
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        results = manager.stream(pipeline.BuildPipeline(matrix(size), max_workers=jobs))
+    makespan = time.perf_counter() - start
+    cpu_end, children_end = cpu_times()
+    return {"configs": len(manager.configs), "tested": len(results), "makespan": makespan,
+            "counters": manager.counters, "coordinator_cpu": cpu_end - cpu, "tools_cpu": children_end - children}
+
+
+MEASURES = {"parser": measure_parser, "build": measure_build, "schedule": measure_schedule, "stream": measure_stream}
+
+
+def run_one(suite, size, profile, jobs, timeout):
+    # every measurement gets a fresh STAND_TEST_ROOT, SRCTOP and interpreter
+    root = tempfile.mkdtemp(prefix="bb-bench-")
+    try:
+        srctop = os.path.join(root, "src")
+        os.makedirs(os.path.join(srctop, "stand"))
+        os.makedirs(os.path.join(srctop, "etc", "mtree"))
+        open(os.path.join(srctop, "etc", "mtree", "BSD.root.dist"), 'w').close()
+        fakes = FakeTools(os.path.join(root, "bin"), profile).install()
+        env = {**fakes.env(), "BOOTBAKER_ROOT": os.path.join(root, "root"), "BOOTBAKER_SRCTOP": srctop}
+        output = os.path.join(root, "result.json")
+        cmd = [sys.executable, "-m", "benchmarks.run", "--measure", suite, "--sizes", str(size),
+               "--output", output, "--timeout", str(timeout)]
+        if jobs:
+            cmd += ["--jobs", str(jobs)]
+        subprocess.run(cmd, env=env, check=True, cwd=os.path.dirname(os.path.dirname(FakeTools.FAKE_TOOL)))
+        with open(output, 'r') as f:
+            return json.load(f)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def revision():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, check=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    # prints the key metrics against the baseline, returns the regressions
+    previous = {(entry["suite"], entry["size"]): entry for entry in baseline["results"]}
+    regressions = []
+    for entry in results:
+        before = previous.get((entry["suite"], entry["size"]))
+        if not before:
+            continue
+        for metric in KEY_METRICS[entry["suite"]]:
+            if not before.get(metric):
+                continue
+            ratio = entry[metric] / before[metric]
+            flag = " REGRESSION" if ratio > 1 + tolerance else ""
+            click.echo(f"{entry['suite']:<9} {entry['size']:>6} {metric:<22} "
+                       f"{before[metric]:>10.3f} -> {entry[metric]:>10.3f} ({ratio:.2f}x){flag}")
+            if flag:
+                regressions.append((entry["suite"], entry["size"], metric))
+    return regressions
+
+
+@click.command()
+@click.option("-s","--suite", "suites", default=",".join(SUITES), help="comma separated suites to run")
+@click.option("-n","--sizes", default="10,100,1000,5000", help="comma separated matrix sizes")
+@click.option("-p","--profile", type=click.Path(exists=True, dir_okay=False), default=None, help="fake tool profile (defaults to profiles/default.json)")
+@click.option("-j","--jobs", type=int, default=None, help="build workers / max guests (defaults to what bootbaker picks)")
+@click.option("-t","--timeout", type=int, default=5, help="seconds before a hanging fake guest is killed")
+@click.option("-o","--output", type=click.Path(dir_okay=False, writable=True), default="benchmark.json", help="where to write the results")
+@click.option("-c","--compare", "baseline", type=click.File(), default=None, help="results of an earlier version to compare against")
+@click.option("--tolerance", type=float, default=0.1, help="slowdown reported as a regression, 0.1 is 10%")
+@click.option("--measure", type=click.Choice(SUITES), default=None, hidden=True)
+def main(suites, sizes, profile, jobs, timeout, output, baseline, tolerance, measure):
+    """Benchmarks bootbaker against fake qemu/makefs/mkimg/mtree/make
+
+    Example: python -m benchmarks.run -s schedule -n 10,100 -c old.json
+    """
+    sizes = [int(size) for size in sizes.split(",")]
+    if measure:
+        result = {"suite": measure, "size": sizes[0], **MEASURES[measure](sizes[0], jobs, timeout)}
+        with open(output, 'w') as f:
+            json.dump(result, f)
+        return
+
+    results = []
+    for suite in suites.split(","):
+        for size in sizes:
+            result = run_one(suite, size, profile, jobs, timeout)
+            headline = KEY_METRICS[suite][0]
+            click.echo(f"{suite:<9} {size:>6} configs {headline} {result[headline]:.3f}s")
+            results.append(result)
+
+    with open(FakeTools(None, profile).profile, 'r') as f:
+        profile_data = json.load(f)
+    report = {
+        "revision": revision(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "profile": profile_data,
+        "results": results,
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    click.echo(f"Results written to {output}")
+    if baseline and compare(results, json.load(baseline), tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,11 @@ import click
 import logging
 from src.config import setup_logging
 from src.config import VALID_ARCH, VALID_ENCRYPTION, VALID_FILE_SYSTEMS, VALID_INTERFACES
-from src.core.configuration import Config
-from src.core.resource_manager import ResourceManager
-from src.core.builder import ConfigBuilder
-from src.core.tester import ConfigTester
-from src.core.parser import Parser
+import os
 
+# the core modules pull in psutil, yaml, xz, asyncio and urllib, they are
+# imported by the commands using them so --help and completion stay fast
 
-# setup log levels
-setup_logging()
 logger = logging.getLogger(__name__)
 
 @click.group()
@@ -20,19 +16,56 @@ def main():
 Example(s):\n
     bootbaker run -a amd64:amd64 -i gpt -f ufs -e none -v -b\n
     """
-    pass
+    # setup log levels
+    setup_logging()
+
+def select_configs(configfile, expression, arch, filesystem, interface, encryption, changed=None, src=None):
+    from src.core.parser import Parser
+    if configfile:
+        configstring = configfile
+    elif expression:
+        configstring = expression
+    else:
+        configstring = f"{arch}-{filesystem}-{interface}-{encryption}"
+
+    # configs are generated lazily as the pipeline plans them
+    configs = Parser(configstring).generate_configs()
+    if changed:
+        # keep only what the source change can affect
+        from src.core.impact import ChangeImpact
+        configs = ChangeImpact(changed, srctop=src).select(configs)
+    return configs
+
+def parse_address(ctx, param, value):
+    # [HOST:]PORT -> (host, port), the host defaults to loopback
+    if value is None:
+        return None
+    host, _, port = value.rpartition(":")
+    if not port.isdigit() or int(port) > 65535:
+        raise click.BadParameter(f"expected [HOST:]PORT, got {value!r}")
+    return host or "127.0.0.1", int(port)
 
 @main.command("run")
 @click.option("-c","--configfile", type=click.File(), help="Config file to run bootbaker")
+@click.option("-x","--expression", default=None, help="matrix expression, e.g. '{amd64:amd64,arm64:aarch64}-!zfs-*-none@{13.2,14.0}'")
 @click.option("-s","--src", type=click.Path(exists=True, dir_okay=True, readable=True, executable=True), help="path to freebsd source tree")
-@click.option("-a","--arch", type=click.Choice(VALID_ARCH), default="*", help="architecture name")
+@click.option("-a","--arch", type=click.Choice([*VALID_ARCH, "*"]), default="*", help="architecture name")
 @click.option("-i","--interface", type=click.Choice([*VALID_INTERFACES, "*"]), default="*", help="interface name")
 @click.option("-f","--filesystem", type=click.Choice([*VALID_FILE_SYSTEMS, "*"]), default="*",help="filesystem name")
 @click.option("-e","--encryption", type=click.Choice(VALID_ENCRYPTION), default="none", help="encryption strategy")
 @click.option("-b","--build-only", default=False, help="Only builds bootloader", is_flag=True)
 @click.option("-t","--test-only", default=False, help="Only tests bootloader", is_flag=True)
+@click.option("--changed", default=None, help="only run configs affected by this revision range of the source tree, e.g. HEAD~1..HEAD")
+@click.option("--reverify", default=False, help="boot configs even if identical inputs passed before", is_flag=True)
+@click.option("-j","--jobs", type=int, default=None, help="max parallel build stages (defaults to cpu count)")
+@click.option("--stream", default=False, help="test each config as soon as it is built instead of after the whole build", is_flag=True)
+@click.option("--test-jobs", type=int, default=None, help="max guests booted at once (defaults to what the host can take)")
+@click.option("--backlog", type=int, default=None, help="with --stream, max built images waiting for a test (defaults to 2x cpu count)")
+@click.option("--trace", type=click.Path(dir_okay=False, writable=True), default=None, help="write a Chrome trace of build stages and test phases")
+@click.option("--timeline", type=click.Path(dir_okay=False, writable=True), default=None, help="write the same spans as a JSON timeline")
+@click.option("--metrics", "metrics_address", default=None, callback=parse_address, help="serve live metrics on [HOST:]PORT, /metrics (Prometheus) and /metrics.json")
 @click.option("-v","--verbose", default=False, help="sets verbosity of output", is_flag=True)
-def run(configfile, src, arch, interface, filesystem, encryption, build_only, test_only, verbose):
+def run(configfile, expression, src, arch, interface, filesystem, encryption, build_only, test_only, changed, reverify, jobs, stream, test_jobs, backlog, trace, timeline, metrics_address, verbose):
 
     # Adjust the log level after setting up logging
     if verbose:
@@ -41,64 +74,227 @@ def run(configfile, src, arch, interface, filesystem, encryption, build_only, te
     else:
         logger.info("LOG LEVEL: INFO")
 
-    if not configfile:
-        configstring = f"{arch}-{filesystem}-{interface}-{encryption}"
-    else:
-        configstring = configfile
+    from src.core.resource_manager import ResourceManager
+    from src.core.pipeline import BuildPipeline
+    from src.core.tester import ConfigTester
+    from src.utils.tracing import tracer
+    configs = select_configs(configfile, expression, arch, filesystem, interface, encryption, changed, src)
 
-    # call parser to get list of Config Objects
-    configs = Parser(configstring).generate_configs()
-    logger.info(f"Parsed {len(configs)} configs.")
-
-    # handles build only and test only logic
-    if not build_only and not test_only:
-        build_only = True
-        test_only = True
-
-    # lets build in series(some stuff is shared, need to fix it)
-    successfull_builds = []
-    if build_only:
-        # since builder has copies of config in its class variables
-        builders = [ ConfigBuilder(config) for config in configs ]
-        for builder in builders:
-            # logger.debug(f"Building Bootloader => {arch}-{filesystem}-{interface}-{encryption}")
+    server = None
+    if metrics_address:
+        from src.utils.metrics import metrics, MetricsServer
+        host, port = metrics_address
+        server = MetricsServer(metrics, host, port).start()
+
+    # a build-only run leaves its images for a later --test-only run
+    testing = test_only or not build_only
+    try:
+        # handles build only and test only logic
+        if not build_only and not test_only:
+            build_only = True
+            test_only = True
+
+        # build and test at once, each config is booted as soon as it is built
+        if stream and build_only and test_only:
             try:
-                builder.build_resource()
-                successfull_builds.append(builder.config)
-                logger.debug("Build Successful")
+                resource = ResourceManager([], reverify=reverify, max_jobs=test_jobs)
+                resource.stream(BuildPipeline(configs, max_workers=jobs), max_backlog=backlog)
             except Exception as e:
-                logger.debug("Build Failed")
-                logger.error(e)
-            
-
-    # test in parallel
-    successfull_tests = []
-    parallel_flag = True
-    if test_only:
-        configs_to_test = successfull_builds if build_only else configs
-        testers = [ ConfigTester(config) for config in configs_to_test]
-        if not parallel_flag:
-            # sequence one by one
-            for tester in testers:
+                logger.error(str(e))
+                logger.error("Error Occurred while building and testing")
+        else:
+            # build as a stage graph, shared per arch stages run once and
+            # per identifier stages run in parallel
+            successfull_builds = []
+            if build_only:
                 try:
-                    status = tester.run_test()
-                    if status :
-                        successfull_tests.append(tester.config)
-                        logger.debug("Test Passed")
-                    else:
-                        logger.debug("Test Failed")
+                    pipeline = BuildPipeline(configs, max_workers=jobs)
+                    successfull_builds = pipeline.run()
+                    logger.info(f"Built {len(successfull_builds)} / {len(pipeline.builders)} configs")
                 except Exception as e:
-                    logger.debug("Test Failed")
+                    logger.debug("Build Failed")
                     logger.error(e)
-        else:
-            # submit to resource manager class (probably rename better)
+
+
+            # test in parallel
+            successfull_tests = []
+            parallel_flag = True
+            if test_only:
+                configs_to_test = successfull_builds if build_only else list(configs)
+                testers = [ ConfigTester(config, reverify=reverify) for config in configs_to_test]
+                if not parallel_flag:
+                    # sequence one by one
+                    for tester in testers:
+                        try:
+                            status = tester.run_test()
+                            if status :
+                                successfull_tests.append(tester.config)
+                                logger.debug("Test Passed")
+                            else:
+                                logger.debug("Test Failed")
+                        except Exception as e:
+                            logger.debug("Test Failed")
+                            logger.error(e)
+                else:
+                    # submit to resource manager class (probably rename better)
+                    try:
+                        resource = ResourceManager(configs_to_test, reverify=reverify, max_jobs=test_jobs)
+                        resource.work()
+                    except Exception as e:
+                        logger.error(str(e))
+                        logger.error("Error Occurred while testing")
+
+        # where did the time go
+        if trace or timeline:
+            if trace:
+                tracer.export_chrome(trace)
+                logger.info(f"Chrome trace written to {trace}")
+            if timeline:
+                tracer.export_timeline(timeline)
+                logger.info(f"Timeline written to {timeline}")
+            click.echo(tracer.format_summary())
+
+        # keep STAND_TEST_ROOT within its disk budget once the run's images,
+        # scripts and partitions have been booted and are no longer needed
+        if testing:
+            from src.core.cache_manager import CacheManager
             try:
-                resource = ResourceManager(configs_to_test)
-                resource.work()
-            except Exception as e:
-                logger.error(str(e))
-                logger.error("Error Occurred while testing")
-    
+                CacheManager().enforce()
+            except OSError as e:
+                logger.warning(f"Could not enforce cache budget: {e}")
+    finally:
+        # the endpoint goes away with the run, however it ended
+        if server:
+            server.stop()
+
+@main.command("plan")
+@click.option("-c","--configfile", type=click.File(), help="Config file to run bootbaker")
+@click.option("-x","--expression", default=None, help="matrix expression, e.g. '{amd64:amd64,arm64:aarch64}-!zfs-*-none@{13.2,14.0}'")
+@click.option("-s","--src", type=click.Path(exists=True, dir_okay=True, readable=True, executable=True), help="path to freebsd source tree")
+@click.option("-a","--arch", type=click.Choice([*VALID_ARCH, "*"]), default="*", help="architecture name")
+@click.option("-i","--interface", type=click.Choice([*VALID_INTERFACES, "*"]), default="*", help="interface name")
+@click.option("-f","--filesystem", type=click.Choice([*VALID_FILE_SYSTEMS, "*"]), default="*",help="filesystem name")
+@click.option("-e","--encryption", type=click.Choice(VALID_ENCRYPTION), default="none", help="encryption strategy")
+@click.option("--changed", default=None, help="only plan configs affected by this revision range of the source tree, e.g. HEAD~1..HEAD")
+@click.option("-j","--jobs", type=int, default=None, help="max parallel build stages (defaults to cpu count)")
+@click.option("--json", "as_json", default=False, help="print the plan as JSON", is_flag=True)
+@click.option("-v","--verbose", default=False, help="list every stage with its cache status", is_flag=True)
+def plan(configfile, expression, src, arch, interface, filesystem, encryption, changed, jobs, as_json, verbose):
+    """Show what run would build, download and boot, without doing any of it"""
+    from src.core.planner import RunPlanner
+    from src.core.cache_manager import CacheManager
+    import json
+    configs = select_configs(configfile, expression, arch, filesystem, interface, encryption, changed, src)
+    planner = RunPlanner(configs, max_workers=jobs).plan()
+    summary = planner.summary()
+    if as_json:
+        if verbose:
+            summary["stage_status"] = {key: {"status": status, "detail": detail}
+                                       for key, (status, detail) in planner.stages.items()}
+        click.echo(json.dumps(summary, indent=2))
+        return
+
+    fmt = CacheManager.format_size
+    click.echo(f"{summary['configs']} configs, {len(planner.stages)} build stages")
+    for kind, counts in summary["stages"].items():
+        click.echo(f"  {kind:<9} " + ", ".join(f"{count} {status}" for status, count in counts.items()))
+    if verbose:
+        for key, (status, detail) in planner.stages.items():
+            click.echo(f"  {status:<8} {key}{f' ({detail})' if detail else ''}")
+    for url in summary["downloads"]:
+        click.echo(f"download {url}")
+    click.echo(f"{summary['tests'].get('boot', 0)} to boot, {summary['tests'].get('cached-pass', 0)} cached-pass")
+    click.echo(f"Estimated build {summary['build_seconds']:.0f}s, test {summary['test_seconds']:.0f}s, "
+               f"total {summary['total_seconds']:.0f}s ({summary['stream_seconds']:.0f}s with --stream)")
+    click.echo(f"Estimated peak memory {fmt(summary['peak_memory'])} ({summary['peak_guests']} guests)")
+
+@main.group("cache")
+def cache():
+    """Inspect and prune the artifact cache under STAND_TEST_ROOT"""
+    pass
+
+@cache.command("stats")
+def cache_stats():
+    from src.core.cache_manager import CacheManager
+    stats = CacheManager().stats()
+    fmt = CacheManager.format_size
+    click.echo(f"Total: {fmt(stats['total'])} / {fmt(stats['budget'])} budget")
+    for kind, kind_stats in stats['kinds'].items():
+        click.echo(f"  {kind:<13} {kind_stats['count']:>6} artifacts {fmt(kind_stats['size']):>10}")
+    for path in stats['pinned']:
+        click.echo(f"  pinned: {path}")
+
+@cache.command("prune")
+@click.option("-b","--budget", default=None, help="byte budget to prune down to, e.g. 20G (defaults to CACHE_BUDGET)")
+@click.option("-n","--dry-run", default=False, help="only list what would be evicted", is_flag=True)
+def cache_prune(budget, dry_run):
+    from src.core.cache_manager import CacheManager
+    manager = CacheManager()
+    budget = manager.parse_size(budget) if budget else None
+    evicted = manager.enforce(budget=budget, dry_run=dry_run)
+    for path, size in evicted:
+        click.echo(f"{'would evict' if dry_run else 'evicted'} {path} ({manager.format_size(size)})")
+    click.echo(f"{len(evicted)} artifacts {'would be ' if dry_run else ''}evicted")
+
+@cache.command("pin")
+@click.argument("patterns", nargs=-1, required=True)
+@click.option("-u","--unpin", default=False, help="remove the pin instead", is_flag=True)
+def cache_pin(patterns, unpin):
+    """Pin artifacts (globs relative to STAND_TEST_ROOT) so they are never evicted"""
+    from src.core.cache_manager import CacheManager
+    manager = CacheManager()
+    for pattern in patterns:
+        matches = manager.pin(pattern, pinned=not unpin)
+        click.echo(f"{'unpinned' if unpin else 'pinned'} {len(matches)} artifacts matching {pattern}")
+
+@main.command("coordinator")
+@click.option("-c","--configfile", type=click.File(), help="Config file to run bootbaker")
+@click.option("-x","--expression", default="*-*-*-none", help="matrix expression when no config file is given")
+@click.option("-H","--host", default="127.0.0.1", help="address to serve workers on, 0.0.0.0 for all (unauthenticated)")
+@click.option("-p","--port", type=int, default=8470, help="port to serve workers on")
+def coordinator(configfile, expression, host, port):
+    """Serve a test matrix to bootbaker workers and collect their results"""
+    from src.core.distributed import Coordinator
+    from src.core.parser import Parser
+    configs = list(Parser(configfile or expression).generate_configs())
+    Coordinator(configs, host=host, port=port).serve()
+
+@main.command("worker")
+@click.argument("url")
+@click.option("-j","--jobs", type=int, default=None, help="guests run at a time (defaults to cpu count)")
+@click.option("-n","--name", default=None, help="worker name (defaults to host-pid)")
+@click.option("--reverify", default=False, help="boot configs even if identical inputs passed before", is_flag=True)
+def worker(url, jobs, name, reverify):
+    """Build and test configs pulled from a coordinator, e.g. http://host:8470"""
+    from src.core.distributed import Worker
+    Worker(url, slots=jobs, name=name, reverify=reverify).run()
+
+@main.command("logs")
+@click.argument("identifier")
+@click.option("-n","--lines", type=int, default=50, help="number of lines from the end of the console log")
+@click.option("-g","--grep", default=None, help="print the lines matching this regex instead of the tail")
+@click.option("-i","--ignore-case", default=False, help="case insensitive --grep", is_flag=True)
+def logs(identifier, lines, grep, ignore_case):
+    """Show the console log of a config, e.g. FreeBSD-13.2-amd64-ufs-gpt-none"""
+    from src.core.configuration import Config
+    from src.utils.logstore import LogReader
+    import glob
+    matches = [path for path in glob.glob(os.path.join(Config.LOG_DIR, "*", f"*{identifier}*")) if os.path.isdir(path)]
+    if not matches:
+        raise click.ClickException(f"No console log for {identifier}")
+    for path in sorted(matches):
+        if len(matches) > 1:
+            click.echo(f"==> {os.path.relpath(path, Config.LOG_DIR)} <==")
+        reader = LogReader(path)
+        if reader.index["truncated"]:
+            click.echo(f"(log capped at {reader.index['stored']} of {reader.index['total']} bytes, the end is kept"
+                       f"{f', {reader.lost()} bytes in between are lost' if reader.lost() else ''})", err=True)
+        if grep is None:
+            for line in reader.tail(lines):
+                click.echo(line)
+            continue
+        for line_no, line in reader.grep(grep, ignore_case):
+            click.echo(f"{line_no if line_no else '-'}: {line}")
 
 @main.command("setup")
 @click.option("-v","--verbose", default="INFO", help="sets verbosity of output")
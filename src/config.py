@@ -11,14 +11,23 @@
 
 # logging config
 import logging.config
+import os
 
 # Defaults
 VALID_ARCH = ["amd64:amd64", "arm64:aarch64", "arm:armv7", "riscv:riscv64", "powerpc:powerpc64"]
 VALID_INTERFACES = ["gpt", "mbr"]
 VALID_FILE_SYSTEMS = ["ufs", "zfs"]
 VALID_ENCRYPTION = ["geom", "geli", "none"]
-STAND_TEST_ROOT = "/home/smk/stand-test-root"
-SRCTOP = "/home/smk/freebsd-src"
+STAND_TEST_ROOT = os.environ.get("BOOTBAKER_ROOT", "/home/smk/stand-test-root")
+SRCTOP = os.environ.get("BOOTBAKER_SRCTOP", "/home/smk/freebsd-src")
+IMPACT_RULES = os.path.join(os.path.dirname(__file__), "..", "config", "impact.yml")  # rules for run --changed
+CACHE_BUDGET = 50 * 1024 * 1024 * 1024     # bytes kept under STAND_TEST_ROOT
+STAND_MAKE_JOBS = None                      # make -j for stand builds, None sizes it to the host
+QEMU_DISK_MODE = "overlay"                  # direct | snapshot | overlay, see FreeBSDUtils.get_disk
+QEMU_MONITOR = "unix"                       # unix: a socket per guest, tcp: a free telnet port per guest
+QEMU_WARM_START = False                     # restore a firmware snapshot instead of cold booting EDK2, see FirmwareSnapshot
+IMAGE_HEADROOM = 0.5                        # free space added on top of the packed content
+IMAGE_ALIGN = 1024 * 1024                   # partition images are rounded up to this many bytes
 
 
 def setup_logging():
@@ -0,0 +1,138 @@
+from src.config import STAND_TEST_ROOT
+from src.utils.sparse import SparseUtils
+import threading
+import hashlib
+import shutil
+import os
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# ArtifactCache is a content addressed store for built artifacts, every
+# artifact lives under the hash of the inputs it was built from, so an
+# unchanged artifact is reused instead of rebuilt
+class ArtifactCache:
+    ARTIFACT_DIR = f"{STAND_TEST_ROOT}/artifacts"
+    CHUNK_SIZE = 1024 * 1024
+
+    # (path, size, mtime_ns) -> sha256, shared across builders of a run
+    _file_hashes: dict[tuple, str] = {}
+
+    def __init__(self, root=None):
+        self.root = root or self.ARTIFACT_DIR
+
+    @classmethod
+    def hash_file(cls, path):
+        st = os.stat(path)
+        memo_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+        digest = cls._file_hashes.get(memo_key)
+        if digest is None:
+            h = hashlib.sha256()
+            with open(path, 'rb') as f:
+                while chunk := f.read(cls.CHUNK_SIZE):
+                    h.update(chunk)
+            digest = h.hexdigest()
+            cls._file_hashes[memo_key] = digest
+        return digest
+
+    @classmethod
+    def hash_tree(cls, path):
+        # hashes relative names, modes, symlink targets and file contents
+        h = hashlib.sha256()
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            rel_dir = os.path.relpath(dirpath, path)
+            h.update(f"d {rel_dir}\n".encode())
+            for name in sorted(filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]):
+                full_path = os.path.join(dirpath, name)
+                rel_path = os.path.join(rel_dir, name)
+                st = os.lstat(full_path)
+                if os.path.islink(full_path):
+                    h.update(f"l {rel_path} {os.readlink(full_path)}\n".encode())
+                else:
+                    h.update(f"f {rel_path} {st.st_mode:o} {cls.hash_file(full_path)}\n".encode())
+        return h.hexdigest()
+
+    @staticmethod
+    def hash_inputs(**inputs):
+        h = hashlib.sha256()
+        for name in sorted(inputs):
+            value = inputs[name]
+            if isinstance(value, str):
+                value = value.encode()
+            elif not isinstance(value, bytes):
+                value = repr(value).encode()
+            h.update(f"{name}:{len(value)}:".encode())
+            h.update(value)
+        return h.hexdigest()
+
+    def path(self, key, name):
+        return os.path.join(self.root, key[:2], key, name)
+
+    def contains(self, key, name):
+        return os.path.exists(self.path(key, name))
+
+    def fetch(self, key, name, dst, link=True):
+        # materialize a cached artifact at dst, returns False on a miss
+        src = self.path(key, name)
+        if not os.path.exists(src):
+            return False
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.lexists(dst):
+            os.remove(dst)
+        self._materialize(src, dst, link)
+        logger.debug(f"Reused {name} artifact {key[:12]} for {dst}")
+        return True
+
+    def store(self, key, name, src, link=True):
+        dst = self.path(key, name)
+        if os.path.exists(dst):
+            return dst
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        # stages run in threads, two of them may store the same key at once,
+        # each writes its own temporary and the last replace wins
+        tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        try:
+            self._materialize(src, tmp, link)
+            os.replace(tmp, dst)
+        finally:
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+        return dst
+
+    def _materialize(self, src, dst, link):
+        # hardlink when the consumer never writes to the file, otherwise
+        # clone it (copy_file_range lets the filesystem reflink blocks)
+        if link:
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                pass
+        self.clone(src, dst)
+
+    @staticmethod
+    def clone(src, dst):
+        # only the data regions are copied so holes in sparse images stay
+        # holes, copy_file_range lets the filesystem reflink those blocks
+        if hasattr(os, "copy_file_range"):
+            try:
+                with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+                    size = os.fstat(fin.fileno()).st_size
+                    for start, length in SparseUtils.data_regions(fin.fileno(), size):
+                        offset = start
+                        while offset < start + length:
+                            copied = os.copy_file_range(fin.fileno(), fout.fileno(),
+                                                        start + length - offset, offset, offset)
+                            if copied == 0:
+                                raise OSError(f"short copy of {src}")
+                            offset += copied
+                    fout.truncate(size)
+                shutil.copymode(src, dst)
+                return
+            except OSError:
+                pass
+        SparseUtils.sparse_copy(src, dst)
@@ -1,9 +1,15 @@
-from src.config import STAND_TEST_ROOT
-from src.config import SRCTOP
+from src.config import STAND_TEST_ROOT, IMAGE_HEADROOM, IMAGE_ALIGN
 from src.core.configuration import Config
+from src.core.artifact_cache import ArtifactCache
+from src.core.cache_manager import CacheManager
+from src.core.stand_cache import StandBuildCache
+from src.core.snapshot import FirmwareSnapshot
 from src.utils.freebsd_utils import FreeBSDUtils
-import urllib.request
-import xz
+from src.utils.download import StreamingDownloader
+from src.utils.iso9660 import ISO9660Reader
+from src.utils.sparse import SparseUtils
+from src.utils.tracing import tracer
+from src.utils.metrics import metrics
 import shutil
 import subprocess
 import os
@@ -15,6 +21,13 @@ class ConfigBuilder:
     SCRIPT_DIR = f"{STAND_TEST_ROOT}/script"
     TREE_DIR = f"{STAND_TEST_ROOT}/tree"
     VIRTUAL_DEVICE_ID = 3
+    MB = 1024 * 1024
+    # smallest partition images makefs produces reliably, zfs refuses vdevs
+    # under 64M and a 1 sector per cluster fat16 needs a few MB of clusters
+    MIN_SIZES = {"esp": 4 * MB, "ufs": 16 * MB, "zfs": 64 * MB}
+    # with 1 sector clusters fat32 needs at least 65525 clusters
+    FAT32_MIN_SIZE = 34 * MB
+    BLOCK_SIZE = 4096
 
     def __init__(self, config: Config):
         self.config = config
@@ -27,13 +40,32 @@ class ConfigBuilder:
         self.override_kernel = False
         self.identifier = self.config.identifier
 
+        # shared per machine_combo trees and an isolated per identifier workspace
+        self.tree_root = os.path.join(self.TREE_DIR, self.machine_combo)
+        self.tree = os.path.join(self.tree_root, f"freebsd-{self.config.version}")
+        self.test_dir = os.path.join(self.tree_root, "test-stand")
+        self.esp_dir = os.path.join(self.tree_root, "freebsd-esp")
+        # partitions only depend on machine_combo (esp) or on machine_combo,
+        # version and filesystem (root), so every interface and encryption
+        # variant assembles its image from the same two files
+        self.fstab_dir = os.path.join(self.tree_root, "work", f"freebsd-{self.config.version}-{self.config.filesystem}")
+        self.esp_file = os.path.join(self.IMAGE_DIR, self.machine_combo, f"freebsd-{self.machine_combo}.esp")
+        self.fs_file = os.path.join(self.IMAGE_DIR, self.machine_combo,
+                                    f"freebsd-{self.config.version}-{self.machine_combo}.{self.config.filesystem}")
+        self.artifacts = ArtifactCache()
+        self.cache = CacheManager()
+
     def build_resource(self):
         self.setup_dirs()
         self.update_freebsd_img_cache()
         self.build_freebsd_minimal_trees()
         self.build_freebsd_test_trees()
         self.build_freebsd_esps()
+        self.build_freebsd_esp_partition()
+        self.build_freebsd_fs_partition()
         self.build_freebsd_images()
+        self.build_freebsd_firmware()
+        self.build_freebsd_snapshot()
         self.build_freebsd_scripts()
 
     def setup_dirs(self):
@@ -42,35 +74,39 @@ class ConfigBuilder:
             os.makedirs(dir, exist_ok=True)
     
     def update_freebsd_img_cache(self):
-
-        # check file exists in cache
         file_path = os.path.join(self.CACHE_DIR, self.img_file)
-        if os.path.exists(file_path):
+        xz_file_path = f"{file_path}.xz"
+        downloader = StreamingDownloader(self.CACHE_DIR)
+
+        # bootonly isos are read straight from the seekable .xz, only other
+        # flavors still need the decompressed image
+        if self.config.flavor == "bootonly.iso":
+            file_path = None
+
+        # a verified .xz (by size and mtime) plus its image means nothing to do
+        if downloader.is_verified(xz_file_path) and (file_path is None or os.path.exists(file_path)):
             print(f"File {self.img_file} Exists!")
+            self.cache.touch(*filter(None, [xz_file_path, file_path]))
             return
 
-        # fetch file and uncompress using xz
-        print("File doesn't exists fetching ...")
-            # Download the image
-        xz_file_path = f"{file_path}.xz"
-        if os.path.exists(xz_file_path):
-            # compressed file exists but needs to be unpacked
-            with xz.open(xz_file_path) as f:
-                with open(file_path, 'wb') as fout:
-                    shutil.copyfileobj(f, fout)
-            return
-        
-        # fetch file
-        urllib.request.urlretrieve(self.img_url, xz_file_path)
-        # Extract the image
-        with xz.open(xz_file_path) as f:
-            with open(file_path, 'wb') as fout:
-                shutil.copyfileobj(f, fout)
-        # os.remove(xz_file_path)
+        # fetch, verify and decompress in a single streaming pass, resuming
+        # any partial download left behind by an interrupted run
+        print(f"Fetching {self.img_file} ...")
+        checksums = downloader.fetch_checksums(self.config.checksum_url)
+        expected = checksums.get(os.path.basename(xz_file_path))
+        if expected is None:
+            print(f"No checksum found for {self.img_file}.xz, skipping verification")
+        with tracer.span("download", image=self.img_file):
+            downloader.fetch(self.img_url, xz_file_path, file_path, expected_sha512=expected)
+        self.cache.touch(*filter(None, [xz_file_path, file_path]))
 
+    def get_iso_path(self):
+        # prefer a decompressed iso left by older runs, it is cheaper to seek
+        file_path = os.path.join(self.CACHE_DIR, self.img_file)
+        return file_path if os.path.exists(file_path) else f"{file_path}.xz"
 
     def build_freebsd_minimal_trees(self):
-        tree = f"{self.TREE_DIR}/{self.machine_combo}/freebsd"
+        tree = self.tree
 
         # cleanup & recreate tree
         # note if sudo creates the tree, then shutil doesn't work properly and ignore_error bypasses that
@@ -95,9 +131,17 @@ class ConfigBuilder:
             "sbin/reboot", "sbin/halt", "sbin/init", "bin/sh", "sbin/sysctl",
             "lib/libncursesw.so.9", "lib/libc.so.7", "lib/libgcc_s.so.1", "lib/libedit.so.8", "libexec/ld-elf.so.1"
         ]
+        # kernel files are optional and only picked when not overriding the kernel
+        override_files = ["boot/kernel/kernel", "boot/kernel/acl_nfs4.ko", "boot/kernel/cryptodev.ko", "boot/kernel/zfs.ko", "boot/kernel/geom_eli.ko", "boot/device.hints"]
         if self.config.flavor == "bootonly.iso":
-            cmd = ["tar", "-C", tree, "-xf", f"{self.CACHE_DIR}/{self.img_file}"] + bins
-            subprocess.run(cmd)
+            # one indexed pass over the iso for binaries and kernel files
+            members = bins + ([] if self.override_kernel else override_files)
+            with tracer.span("tree-extract", machine_combo=self.machine_combo, version=self.config.version):
+                with ISO9660Reader.open(self.get_iso_path()) as iso:
+                    missing = iso.extract(members, tree)
+            missing_bins = [member for member in missing if member in bins]
+            if missing_bins:
+                raise FileNotFoundError(f"{self.img_file} is missing {', '.join(missing_bins)}")
         else :
             # implement mount logic
             pass
@@ -111,47 +155,20 @@ class ConfigBuilder:
 
         # override kernel setup
         if not self.override_kernel :
-            override_files = ["boot/kernel/kernel", "boot/kernel/acl_nfs4.ko", "boot/kernel/cryptodev.ko", "boot/kernel/zfs.ko", "boot/kernel/geom_eli.ko", "boot/device.hints"]
-            # script || true -> always pass
-            for file in override_files:
-                override_cmd = ["tar", "-C", tree, "-xf", f"{self.CACHE_DIR}/{self.img_file}", file]
-                subprocess.run(override_cmd, check=False)
+            # kernel files were extracted with the binaries above
             print("Kernel Override Ignored!")
         else:
             # implement kernel override code
             pass
 
     def build_freebsd_test_trees(self):
-        test_dir = os.path.join(self.TREE_DIR, self.machine_combo, "test-stand")
-        os.makedirs(test_dir, exist_ok=True)
-
-        mtree_cmd = ["mtree", "-deUW", "-f", f"{SRCTOP}/etc/mtree/BSD.root.dist", "-p", test_dir]
-        subprocess.run(mtree_cmd, check=True)
-
-        buildenv_cmd = ["cd", f"{SRCTOP}/stand", "&&", 
-                        "SHELL='make -j 100 all'", "make", "buildenv", 
-                        f"TARGET={self.config.machine}",
-                        f"TARGET_ARCH={self.config.machine_arch}"]
-        buildinstall_cmd = ["cd", f"{SRCTOP}/stand", "&&", 
-                        f"SHELL=\"make install DESTDIR='{test_dir}' MK_MAN=no MK_INSTALL_AS_USER=yes WITHOUT_DEBUG_FILES=yes\"",
-                        "make",
-                        "buildenv",
-                        f"TARGET={self.config.machine}",
-                        f"TARGET_ARCH={self.config.machine_arch}"]
-        try:
-            buildenv_cmd_str = " ".join(buildenv_cmd)
-            buildinstall_cmd_str = " ".join(buildinstall_cmd)
-            os.system(buildenv_cmd_str)
-            os.system(buildinstall_cmd_str)
-        except Exception:
-            raise Exception("Could not Build Env")
-
-        subprocess.run(["rm", "-rf", f"{test_dir}/bin"], check=True)
-        subprocess.run(["rm", "-rf", f"{test_dir}/[ac-z]*"], check=True)
+        # stand is only rebuilt when its sources, target or make vars change
+        stand = StandBuildCache(self.config.machine, self.config.machine_arch)
+        stand.install(self.test_dir)
 
     def build_freebsd_esps(self):
-        test_dir = os.path.join(self.TREE_DIR, self.machine_combo, "test-stand")
-        esp_dir = os.path.join(self.TREE_DIR, self.machine_combo, "freebsd-esp")
+        test_dir = self.test_dir
+        esp_dir = self.esp_dir
 
         shutil.rmtree(esp_dir, ignore_errors=True)
         os.makedirs(esp_dir)
@@ -163,80 +180,230 @@ class ConfigBuilder:
         dst_path = os.path.join(esp_dir, "efi", "boot", boot_efi)
         shutil.copy(src_path, dst_path)
 
-    def build_esp(self, esp, src):
-        # -t msdos : fat32 filesystem
-        # -o fat_type=32 : 32 or 64 bit fat file
+    def content_size(self, *dirs):
+        # bytes the trees take once packed, every file and directory rounded
+        # up to a block, hardlinked files counted once
+        block = self.BLOCK_SIZE
+        seen = set()
+        total = 0
+        for top in dirs:
+            for dirpath, dirnames, filenames in os.walk(top):
+                total += block
+                for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]:
+                    st = os.lstat(os.path.join(dirpath, name))
+                    if (st.st_dev, st.st_ino) in seen:
+                        continue
+                    seen.add((st.st_dev, st.st_ino))
+                    total += -(-st.st_size // block) * block or block
+        return total
+
+    def image_size(self, kind, *dirs):
+        # content plus headroom, at least the per kind minimum, aligned
+        size = max(int(self.content_size(*dirs) * (1 + IMAGE_HEADROOM)), self.MIN_SIZES[kind])
+        return -(-size // IMAGE_ALIGN) * IMAGE_ALIGN
+
+    def get_fat_type(self, size):
+        # fat16 until the image holds enough clusters for a valid fat32
+        return 32 if size >= self.FAT32_MIN_SIZE else 16
+
+    def get_esp_cmd(self, esp, src, size):
+        # -t msdos : fat filesystem
+        # -o fat_type=16|32 : picked from the size, see get_fat_type
         # -o sectors_per_cluster=1 : each cluster will have 1 sector
-        # -s 100m : size of fs to be 100MB
-        cmd = f"makefs -t msdos -o fat_type=32 -o sectors_per_cluster=1 -o volume_label=EFISYS -s 100m {esp} {src}"
-        subprocess.run(cmd, shell=True)
+        # -s size : sized to the content, see image_size
+        fat_type = self.get_fat_type(size) if isinstance(size, int) else "{fat_type}"
+        return f"makefs -t msdos -o fat_type={fat_type} -o sectors_per_cluster=1 -o volume_label=EFISYS -s {size} {esp} {src}"
 
-    def build_fs(self, fs_file, dir1, dir2):
+    def build_esp(self, esp, src):
+        with tracer.span("makefs-esp", machine_combo=self.machine_combo):
+            subprocess.run(self.get_esp_cmd(esp, src, self.image_size("esp", src)), shell=True, check=True)
+            self.make_sparse(esp)
+
+    def get_fs_cmd(self, fs_file, size, *dirs):
         #- -t ffs : fast file system
         #- -B little : little_endian format
-        #- -s 200m : size of fs to be created 200MB
+        #- -s size : sized to the content, see image_size
         #- -o label=root : specifies the label as root
-        #- copies over content of the dir1, dir2 into the fs indicated
+        #- copies over content of all the dirs into the fs indicated
+        src_dirs = " ".join(dirs)
         if self.config.filesystem == "zfs":
             zfs_pool = "tank"
-            cmd = f"makefs -t zfs -s 200m -o poolname={zfs_pool} -o bootfs={zfs_pool} -o rootpath=/ {fs_file} {dir1} {dir2}"
-        else:
-            cmd = f"makefs -t ffs -B little -s 200m -o label=root {fs_file} {dir1} {dir2}"
-        
-        subprocess.run(cmd, shell=True, check=True)
+            return f"makefs -t zfs -s {size} -o poolname={zfs_pool} -o bootfs={zfs_pool} -o rootpath=/ {fs_file} {src_dirs}"
+        return f"makefs -t ffs -B little -s {size} -o label=root {fs_file} {src_dirs}"
 
-    def build_image(self, esp_file, fs_file, img_file):
+    def build_fs(self, fs_file, *dirs):
+        size = self.image_size(self.config.filesystem, *dirs)
+        with tracer.span("makefs-fs", machine_combo=self.machine_combo, filesystem=self.config.filesystem):
+            subprocess.run(self.get_fs_cmd(fs_file, size, *dirs), shell=True, check=True)
+            self.make_sparse(fs_file)
+
+    @staticmethod
+    def make_sparse(path):
+        # makefs and mkimg may write the free space out as zeros
+        if not SparseUtils.is_sparse(path):
+            SparseUtils.sparsify(path)
+
+    def get_image_cmd(self, esp_file, fs_file, img_file):
         bi = self.config.interface
         if bi == "mbr":
-            cmd = f"mkimg -s {bi} -p efi:={esp_file} -p freebsd:={fs_file} -o {img_file}"
+            return f"mkimg -s {bi} -p efi:={esp_file} -p freebsd:={fs_file} -o {img_file}"
+        return f"mkimg -s {bi} -p efi:={esp_file} -p freebsd-{self.config.filesystem}:={fs_file} -o {img_file}"
+
+    def build_image(self, esp_file, fs_file, img_file):
+        with tracer.span("mkimg", identifier=self.identifier):
+            subprocess.run(self.get_image_cmd(esp_file, fs_file, img_file), shell=True, check=True)
+            self.make_sparse(img_file)
+
+    def get_esp_key(self, src):
+        loader = os.path.join(self.test_dir, "boot", "loader.efi")
+        return self.artifacts.hash_inputs(
+            kind="esp",
+            loader=self.artifacts.hash_file(loader),
+            tree=self.artifacts.hash_tree(src),
+            size=self.image_size("esp", src),
+            cmd=self.get_esp_cmd("{esp}", "{src}", "{size}"))
+
+    def get_fs_key(self, *dirs):
+        return self.artifacts.hash_inputs(
+            kind="fs",
+            filesystem=self.config.filesystem,
+            rc_conf=self.rc_conf,
+            loader_conf=self.loader_conf,
+            fstab_conf=self.config.fstab_conf,
+            trees=[self.artifacts.hash_tree(d) for d in dirs],
+            size=self.image_size(self.config.filesystem, *dirs),
+            cmd=self.get_fs_cmd("{fs}", "{size}", *[f"{{dir{i}}}" for i in range(len(dirs))]))
+
+    def get_image_key(self, esp_key, fs_key):
+        return self.artifacts.hash_inputs(
+            kind="img",
+            esp=esp_key,
+            fs=fs_key,
+            interface=self.config.interface,
+            filesystem=self.config.filesystem,
+            cmd=self.get_image_cmd("{esp}", "{fs}", "{img}"))
+
+    def cached_build(self, key, name, path, build, link=True):
+        # reuse the artifact stored under key, or build and store it
+        hit = self.artifacts.fetch(key, name, path, link=link)
+        metrics.cache(name, hit)
+        if hit:
+            print(f"{os.path.basename(path)} reused from cache")
         else:
-            cmd = f"mkimg -s {bi} -p efi:={esp_file} -p freebsd-{self.config.filesystem}:={fs_file} -o {img_file}"
-        subprocess.run(cmd, shell=True, check=True)
+            if os.path.lexists(path):
+                os.remove(path)
+            build()
+            self.artifacts.store(key, name, path, link=link)
+        self.cache.touch(path, self.artifacts.path(key, name))
+
+    def build_freebsd_esp_partition(self):
+        os.makedirs(os.path.dirname(self.esp_file), exist_ok=True)
+        self.cached_build(self.get_esp_key(self.esp_dir), "esp", self.esp_file,
+                          lambda: self.build_esp(self.esp_file, self.esp_dir))
+
+    def write_fstab(self):
+        # fstab differs per filesystem, so it lives in its own workspace
+        # instead of the shared test-stand tree
+        shutil.rmtree(self.fstab_dir, ignore_errors=True)
+        os.makedirs(os.path.join(self.fstab_dir, "etc"), exist_ok=True)
+        with open(os.path.join(self.fstab_dir, "etc/fstab"), 'w') as fstab_file:
+            fstab_file.write(self.config.fstab_conf)
+
+    def get_fs_dirs(self):
+        return self.tree, self.test_dir, self.fstab_dir
+
+    def build_freebsd_fs_partition(self):
+        self.write_fstab()
+        dirs = self.get_fs_dirs()
+        os.makedirs(os.path.dirname(self.fs_file), exist_ok=True)
+        self.cached_build(self.get_fs_key(*dirs), self.config.filesystem, self.fs_file,
+                          lambda: self.build_fs(self.fs_file, *dirs))
 
     def build_freebsd_images(self):
-        src = os.path.join(self.TREE_DIR, self.machine_combo, "freebsd-esp")
-        dir = os.path.join(self.TREE_DIR, self.machine_combo, "freebsd")
-        fstab_dir = os.path.join(self.TREE_DIR, self.machine_combo, "test-stand")
-        self.esp_file = os.path.join(self.IMAGE_DIR, self.machine_combo, f"freebsd-{self.identifier}.esp")
-        self.fs_file = os.path.join(self.IMAGE_DIR, self.machine_combo, f"freebsd-{self.identifier}.{self.config.filesystem}")
+        # assembles the per identifier image from the shared partitions
+        # built by build_freebsd_esp_partition and build_freebsd_fs_partition
         self.img_file = os.path.join(self.IMAGE_DIR, self.machine_combo, f"freebsd-{self.identifier}.img")
-        
-        # mkdirs
         os.makedirs(os.path.join(self.IMAGE_DIR, self.machine_combo),exist_ok=True)
-        os.makedirs(os.path.join(fstab_dir, "etc"),exist_ok=True)
-        
-        # fstab file
-        with open(os.path.join(fstab_dir, "etc/fstab"), 'w') as fstab_file:
-            fstab_file.write(self.config.fstab_conf)
 
-        self.build_esp(self.esp_file, src)
-        self.build_fs(self.fs_file, dir, fstab_dir)
-        self.build_image(self.esp_file, self.fs_file, self.img_file)
+        esp_key = self.get_esp_key(self.esp_dir)
+        fs_key = self.get_fs_key(*self.get_fs_dirs())
+        self.image_key = self.get_image_key(esp_key, fs_key)
 
-    def build_freebsd_scripts(self):
+        # partitions are only read by mkimg so they can be hardlinked, the
+        # image too unless it is booted read-write, then it gets its own
+        # (reflinked) copy
+        img_link = self.config.disk_mode != "direct"
+        self.cached_build(self.image_key, "img", self.img_file,
+                          lambda: self.build_image(self.esp_file, self.fs_file, self.img_file), link=img_link)
+
+    def get_bios_files(self):
         bios_code = os.path.join(self.BIOS_DIR, f"edk2-{self.machine_combo}-code.fd")
         bios_var = os.path.join(self.BIOS_DIR, f"edk2-{self.machine_combo}-var.fd")
+        return bios_code, bios_var
 
-        if self.config.machine_arch == "amd64":
-            shutil.copy("/usr/local/share/qemu/edk2-x86_64-code.fd", bios_code)
-            shutil.copy("/usr/local/share/qemu/edk2-i386-vars.fd", bios_var)
-        elif self.config.machine_arch == "aarch64":
-            subprocess.run(["dd","if=/dev/zero", f"of={bios_var}", "bs=1M", "count=64"])
-            subprocess.run(["dd","if=/dev/zero", f"of={bios_code}", "bs=1M", "count=64"])
-            subprocess.run(["dd","if=/usr/local/share/qemu/edk2-aarch64-code.fd", f"of={bios_code}", "conv=notrunc"])
-        elif self.config.machine_arch == "riscv64":
-            shutil.copy("/usr/local/share/qemu/opensbi-riscv64-generic-fw_dynamic.bin", bios_code)
-        else:
-            raise Exception(f"{self.config.machine_arch} not implemented yet!")
-            pass
+    def build_freebsd_firmware(self):
+        bios_code, bios_var = self.get_bios_files()
+
+        with tracer.span("firmware", machine_combo=self.machine_combo):
+            if self.config.machine_arch == "amd64":
+                shutil.copy("/usr/local/share/qemu/edk2-x86_64-code.fd", bios_code)
+                shutil.copy("/usr/local/share/qemu/edk2-i386-vars.fd", bios_var)
+            elif self.config.machine_arch == "aarch64":
+                subprocess.run(["dd","if=/dev/zero", f"of={bios_var}", "bs=1M", "count=64"])
+                subprocess.run(["dd","if=/dev/zero", f"of={bios_code}", "bs=1M", "count=64"])
+                subprocess.run(["dd","if=/usr/local/share/qemu/edk2-aarch64-code.fd", f"of={bios_code}", "conv=notrunc"])
+            elif self.config.machine_arch == "riscv64":
+                shutil.copy("/usr/local/share/qemu/opensbi-riscv64-generic-fw_dynamic.bin", bios_code)
+            else:
+                raise Exception(f"{self.config.machine_arch} not implemented yet!")
+
+    def get_snapshot(self):
+        bios_code, bios_var = self.get_bios_files()
+        return FirmwareSnapshot(self.config.machine, self.config.machine_arch, bios_code, bios_var)
+
+    def build_freebsd_snapshot(self):
+        # the template guest is booted once per machine_combo and firmware
+        if FirmwareSnapshot.enabled(self.config):
+            self.get_snapshot().ensure()
+
+    def build_freebsd_scripts(self):
+        bios_code, bios_var = self.get_bios_files()
+        incoming = None
+        if FirmwareSnapshot.enabled(self.config):
+            # restored guests need the vars the template was saved with
+            incoming, bios_var = self.get_snapshot().ensure()
 
         # make script dirs
         os.makedirs(os.path.join(self.SCRIPT_DIR, self.machine_combo), exist_ok=True)
         self.script = os.path.join(self.SCRIPT_DIR, self.machine_combo, self.identifier)+".sh"
+        # the monitor endpoint changes every run, the fingerprint keys the
+        # recipe with a placeholder and only the written script has this
+        # run's monitor
         qemu_recipe = FreeBSDUtils.get_qemu_recipe(self.config.machine, self.config.machine_arch,
-                                     self.config.filesystem, self.img_file, bios_code, bios_var, self.config.port)
+                                     self.config.filesystem, self.img_file, bios_code, bios_var, "{monitor}",
+                                     self.config.disk_mode, incoming)
         with open(self.script, 'w') as s:
-            s.write(qemu_recipe)
+            s.write(qemu_recipe.replace("{monitor}", self.config.monitor))
+
+        self.config.fingerprint = self.get_test_fingerprint(qemu_recipe, bios_code, bios_var)
+
+    def get_test_fingerprint(self, qemu_recipe, *firmware):
+        # everything a boot depends on: the image's inputs, the qemu command
+        # line, firmware and qemu binary, and what the verdict is matched on
+        qemu_bin = FreeBSDUtils.get_qemu_bin(self.machine_arch)
+        qemu = None
+        if qemu_bin and os.path.exists(qemu_bin):
+            st = os.stat(qemu_bin)
+            qemu = f"{qemu_bin} {st.st_size} {st.st_mtime_ns}"
+        return self.artifacts.hash_inputs(
+            kind="test",
+            image=self.image_key,
+            recipe=qemu_recipe,
+            firmware=[self.artifacts.hash_file(path) for path in firmware if os.path.exists(path)],
+            qemu=qemu,
+            target=self.config.target_string,
+            success=self.config.success_patterns,
+            failure=self.config.failure_patterns)
     
     def __str__(self):
         return f"Config({', '.join(f'{attr}={value}' for attr, value in vars(self).items())})"
\ No newline at end of file
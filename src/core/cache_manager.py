@@ -0,0 +1,264 @@
+from src.config import STAND_TEST_ROOT, CACHE_BUDGET
+from src.utils.filelock import file_lock
+import contextlib
+import threading
+import fnmatch
+import glob
+import shutil
+import json
+import time
+import os
+import re
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# CacheManager keeps STAND_TEST_ROOT within a byte budget. It indexes the
+# artifacts under the root with their size and last access time and evicts
+# the least recently used ones, cheapest to recreate first. Accesses are
+# collected in memory and written to the index by flush, the index is
+# only read and rewritten under a file lock, as several local workers
+# may share the root
+class CacheManager:
+    INDEX_FILE = f"{STAND_TEST_ROOT}/cache-index.json"
+
+    # eviction classes, lower classes are evicted before higher ones
+    EVICTION_ORDER = ["log", "workspace", "decompressed", "intermediate", "compressed", "final"]
+
+    _lock = threading.Lock()
+    # index file -> {unit: (kind, atime)} touched since the last flush,
+    # shared by every manager of the process
+    _pending: dict[str, dict] = {}
+
+    def __init__(self, root=None, budget=None):
+        self.root = root or STAND_TEST_ROOT
+        self.budget = budget if budget is not None else CACHE_BUDGET
+        self.index_file = os.path.join(self.root, os.path.basename(self.INDEX_FILE))
+
+    @contextlib.contextmanager
+    def locked(self):
+        # threads of this process, then other processes on the root
+        with self._lock, file_lock(f"{self.index_file}.lock"):
+            yield
+
+    @staticmethod
+    def parse_size(size):
+        # accepts plain bytes or a K/M/G/T suffixed size, e.g. 50G
+        match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*', str(size), re.IGNORECASE)
+        if not match:
+            raise ValueError(f"Invalid size: {size}")
+        number, unit = match.groups()
+        return int(float(number) * 1024 ** " kmgt".index(unit.lower() or " "))
+
+    @staticmethod
+    def format_size(size):
+        for unit in ["B", "K", "M", "G"]:
+            if size < 1024:
+                return f"{size:.1f}{unit}"
+            size /= 1024
+        return f"{size:.1f}T"
+
+    def unit(self, rel_path):
+        # artifact cache entries and workspaces are evicted as a whole
+        parts = rel_path.split(os.sep)
+        if parts[0] == "artifacts" and len(parts) > 3:
+            return os.path.join(*parts[:3])
+        if parts[0] == "tree" and len(parts) > 4 and parts[2] == "work":
+            return os.path.join(*parts[:4])
+        if parts[0] in ("stand-cache", "snapshots") and len(parts) > 2:
+            return os.path.join(*parts[:2])
+        return rel_path
+
+    def classify(self, rel_path):
+        # maps an artifact unit (relative to the root) to its eviction class
+        parts = rel_path.split(os.sep)
+        if parts[0] == "logs":
+            return "log"
+        if parts[0] == "tree" and len(parts) == 4 and parts[2] == "work":
+            return "workspace"
+        if parts[0] == "cache":
+            return "compressed" if rel_path.endswith(".xz") else "decompressed"
+        if parts[0] == "image":
+            return "final" if rel_path.endswith(".img") else "intermediate"
+        if parts[0] in ("stand-cache", "snapshots") and len(parts) == 2:
+            return "intermediate"
+        if parts[0] == "artifacts" and len(parts) == 3:
+            return "final" if os.path.exists(os.path.join(self.root, rel_path, "img")) else "intermediate"
+        return None
+
+    def discover(self):
+        # yields (relative path, absolute path) of every evictable unit
+        for top in ["cache", "image"]:
+            for dirpath, _, filenames in os.walk(os.path.join(self.root, top)):
+                for name in filenames:
+                    if name.endswith((".part", ".tmp", ".json")):
+                        continue
+                    full_path = os.path.join(dirpath, name)
+                    yield os.path.relpath(full_path, self.root), full_path
+        # a console log is a LogSink directory, older ones plain files
+        for pattern in [os.path.join("logs", "*", "*"), os.path.join("artifacts", "*", "*"), os.path.join("tree", "*", "work", "*"),
+                        os.path.join("stand-cache", "*"), os.path.join("snapshots", "*")]:
+            for full_path in self.glob(pattern):
+                if full_path.endswith(".tmp"):
+                    continue
+                yield os.path.relpath(full_path, self.root), full_path
+
+    def glob(self, pattern):
+        return glob.glob(os.path.join(self.root, pattern))
+
+    def inodes(self, full_path):
+        # {(dev, ino): size} so hardlinked artifacts are only counted once
+        inodes = {}
+        paths = [full_path]
+        if os.path.isdir(full_path) and not os.path.islink(full_path):
+            paths = [os.path.join(d, f) for d, _, files in os.walk(full_path) for f in files]
+        for path in paths:
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            inodes[(st.st_dev, st.st_ino)] = st.st_blocks * 512 if hasattr(st, "st_blocks") else st.st_size
+        return inodes
+
+    def load(self):
+        try:
+            with open(self.index_file, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save(self, index):
+        os.makedirs(self.root, exist_ok=True)
+        tmp = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp, self.index_file)
+
+    def touch(self, *paths):
+        # records an access, called whenever an artifact is produced or
+        # reused, the index is only written by flush
+        now = time.time()
+        with self._lock:
+            pending = self._pending.setdefault(self.index_file, {})
+            for path in paths:
+                rel_path = self.unit(os.path.relpath(os.path.abspath(path), self.root))
+                kind = self.classify(rel_path)
+                if kind is not None:
+                    pending[rel_path] = (kind, now)
+
+    def merge_pending(self, index):
+        # called with the lock held
+        for rel_path, (kind, atime) in self._pending.pop(self.index_file, {}).items():
+            entry = index.setdefault(rel_path, {'kind': kind, 'pinned': False})
+            entry['atime'] = max(atime, entry.get('atime', 0))
+
+    def flush(self):
+        # writes the accesses recorded by touch, once per build rather than
+        # once per artifact
+        with self._lock:
+            if not self._pending.get(self.index_file):
+                return
+        with self.locked():
+            index = self.load()
+            self.merge_pending(index)
+            self.save(index)
+
+    def scan(self):
+        with self.locked():
+            return self.reconcile()
+
+    def reconcile(self):
+        # reconciles the index with what is on disk and refreshes sizes,
+        # called with the lock held
+        index = self.load()
+        self.merge_pending(index)
+        found = {}
+        for rel_path, full_path in self.discover():
+            kind = self.classify(rel_path)
+            if kind is None:
+                continue
+            entry = index.get(rel_path) or {'kind': kind, 'pinned': False}
+            if 'atime' not in entry:
+                st = os.stat(full_path)
+                entry['atime'] = max(st.st_atime, st.st_mtime)
+            entry['kind'] = kind
+            entry['inodes'] = [[*inode, size] for inode, size in self.inodes(full_path).items()]
+            entry['size'] = sum(size for *_, size in entry['inodes'])
+            found[rel_path] = entry
+        self.save(found)
+        return found
+
+    def total_size(self, index):
+        unique = {}
+        for entry in index.values():
+            for dev, ino, size in entry.get('inodes', []):
+                unique[(dev, ino)] = size
+        return sum(unique.values())
+
+    def stats(self):
+        index = self.scan()
+        by_kind = {kind: {'count': 0, 'size': 0} for kind in self.EVICTION_ORDER}
+        for entry in index.values():
+            by_kind[entry['kind']]['count'] += 1
+            by_kind[entry['kind']]['size'] += entry['size']
+        return {
+            'total': self.total_size(index),
+            'budget': self.budget,
+            'pinned': sorted(path for path, entry in index.items() if entry.get('pinned')),
+            'kinds': by_kind,
+        }
+
+    def eviction_candidates(self, index, keep_since=None):
+        # artifacts accessed at or after keep_since are still in use
+        candidates = [(path, entry) for path, entry in index.items() if not entry.get('pinned')
+                      and (keep_since is None or entry['atime'] < keep_since)]
+        candidates.sort(key=lambda item: (self.EVICTION_ORDER.index(item[1]['kind']), item[1]['atime']))
+        return candidates
+
+    def enforce(self, budget=None, dry_run=False, keep_since=None):
+        # evicts least recently used artifacts until the root fits the budget
+        budget = self.budget if budget is None else budget
+        evicted = []
+        with self.locked():
+            index = self.reconcile()
+            # hardlinked artifacts share inodes, an inode is only freed with
+            # the last entry holding it
+            sizes, holders = {}, {}
+            for entry in index.values():
+                for dev, ino, size in entry.get('inodes', []):
+                    sizes[(dev, ino)] = size
+                    holders[(dev, ino)] = holders.get((dev, ino), 0) + 1
+            total = sum(sizes.values())
+            for rel_path, entry in self.eviction_candidates(index, keep_since):
+                if total <= budget:
+                    break
+                if not dry_run:
+                    self.remove(os.path.join(self.root, rel_path))
+                del index[rel_path]
+                evicted.append((rel_path, entry['size']))
+                for dev, ino, size in entry.get('inodes', []):
+                    holders[(dev, ino)] -= 1
+                    if not holders[(dev, ino)]:
+                        total -= size
+            if not dry_run:
+                self.save(index)
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} artifacts, cache is now {self.format_size(total)}")
+        return evicted
+
+    def remove(self, full_path):
+        if os.path.isdir(full_path) and not os.path.islink(full_path):
+            shutil.rmtree(full_path, ignore_errors=True)
+        elif os.path.lexists(full_path):
+            os.remove(full_path)
+
+    def pin(self, pattern, pinned=True):
+        # pins every indexed artifact matching the glob, returns the matches
+        with self.locked():
+            index = self.reconcile()
+            matches = [path for path in index if fnmatch.fnmatch(path, pattern)]
+            for path in matches:
+                index[path]['pinned'] = pinned
+            self.save(index)
+        return matches
@@ -1,4 +1,5 @@
-from src.config import STAND_TEST_ROOT
+from src.config import STAND_TEST_ROOT, QEMU_DISK_MODE, QEMU_WARM_START
+from src.core.monitor import monitors
 import os
 
 
@@ -6,15 +7,16 @@ import os
 class Config:
     URLBASE = "https://download.freebsd.org/ftp/releases"
     VALID_ARCHES = ["amd64:amd64", "arm64:aarch64", "arm:armv7", "riscv:riscv64",
-                     "powerpc:powerc64", "arm:arm", "arm:armv6", "powerpc:powerpc"]
+                     "powerpc:powerpc64", "arm:arm", "arm:armv6", "powerpc:powerpc"]
     VALID_FILESYSTEMS = ["ufs", "zfs", "ffs"]
     VALID_INTERFACES = ["gpt", "mbr"]
     VALID_ENCRYPTIONS = ["geom","geli","none"]
     SCRIPT_DIR = f"{STAND_TEST_ROOT}/script"
     LOG_DIR = f"{STAND_TEST_ROOT}/logs"
+    SCRATCH_DIR = f"{STAND_TEST_ROOT}/scratch"
     target_string = "RC COMMAND RUNNING -- SUCCESS!!!"
 
-    def __init__(self, arch, filesystem, interface, flavor, img_file, img_url, port, encryption="none", version="13.2", recipe={}):
+    def __init__(self, arch, filesystem, interface, flavor, img_file, img_url, port=None, encryption="none", version="13.2", recipe={}):
         # validation
         self.validate_arch(arch)
         self.validate_filesystem(filesystem)
@@ -32,9 +34,21 @@ class Config:
         self.flavor = flavor or self.get_flavor(self.arch)
         self.img_file = img_file or self.get_image_file(self.machine_combo, self.flavor, self.version)
         self.img_url = img_url or self.get_img_url(self.machine, self.machine_arch, self.version, self.img_file)
+        self.checksum_url = recipe.get('checksum_url') or self.get_checksum_url(self.machine, self.machine_arch, self.version)
+        # pins the qemu monitor to a telnet port, see monitor
         self.port = port
+        self._monitor = None
         self.identifier = self.get_identifier_name()
         self.recipe = recipe
+        # console patterns deciding the verdict, None uses the defaults
+        self.success_patterns = recipe.get('success_patterns')
+        self.failure_patterns = recipe.get('failure_patterns')
+        # how the guest gets its disk, only "direct" writes to the built image
+        self.disk_mode = recipe.get('disk_mode') or QEMU_DISK_MODE
+        # restore a firmware-ready snapshot instead of booting EDK2, amd64/aarch64 only
+        self.warm_start = recipe.get('warm_start', QEMU_WARM_START)
+        # hash of everything the test boots, set by the builder
+        self.fingerprint = None
 
         # config files
         self.rc_conf = self.get_rc_conf()
@@ -45,11 +59,17 @@ class Config:
         self.script_file = f"{self.identifier}.sh"
         self.script_dir = os.path.join(self.SCRIPT_DIR, self.machine_combo)
         self.log_path = os.path.join(self.LOG_DIR, self.machine_combo)
-        self.log_file = os.path.join(self.log_path, self.script_file.replace('.sh', '.log'))
-        self.setup_dirs()
-
-    def setup_dirs(self):
-        os.makedirs(self.LOG_DIR,exist_ok=True)
+        # a LogSink directory
+        self.log_file = os.path.join(self.log_path, self.identifier)
+
+    @property
+    def monitor(self):
+        # qemu monitor endpoint, unique within the run. Allocated on first
+        # use so creating a config has no side effects, a tcp allocation
+        # probes the port
+        if self._monitor is None:
+            self._monitor = monitors.allocate(self.port)
+        return self._monitor
 
     def get_machine_combo(self, m, ma):
         return f"{m}-{ma}" if m != ma else ma
@@ -63,6 +83,10 @@ class Config:
     def get_img_url(self, m, ma, version, img_file):
         return f"{self.URLBASE}/{m}/{ma}/ISO-IMAGES/{version}/{img_file}.xz"
 
+    def get_checksum_url(self, m, ma, version):
+        mc = self.get_machine_combo(m, ma)
+        return f"{self.URLBASE}/{m}/{ma}/ISO-IMAGES/{version}/CHECKSUM.SHA512-FreeBSD-{version}-RELEASE-{mc}"
+
     def get_identifier_name(self):
         return f"FreeBSD-{self.version}-{self.machine_combo}-{self.filesystem}-{self.interface}-{self.encryption}"
     
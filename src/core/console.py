@@ -0,0 +1,89 @@
+import time
+import re
+
+
+class Verdict:
+
+    def __init__(self, passed, pattern, line):
+        self.passed = passed
+        self.pattern = pattern
+        self.line = line
+
+    def __str__(self):
+        return f"Verdict({'passed' if self.passed else 'failed'}, {self.line!r})"
+
+
+# ConsoleMatcher scans serial output as it streams in and reaches a verdict
+# as soon as a success or failure pattern shows up, so a guest stuck at a
+# prompt or after a panic does not have to run into the timeout
+class ConsoleMatcher:
+    FAILURE_PATTERNS = [
+        r"panic: ",
+        r"Fatal trap \d+",
+        r"mountroot>",
+        r"can't load 'kernel'",
+        r"Unable to load a kernel",
+        r"ERROR: cannot open /boot/lua/loader\.lua",
+        r"No bootable partition",
+        r"Shell> ",
+        r"UEFI Interactive Shell",
+    ]
+    # boot milestones in order, they time the firmware/loader/kernel phases
+    MILESTONES = [
+        ("loader", r"Consoles: |EFI loader|BTX loader"),
+        ("kernel", r"---<<BOOT>>---|Copyright \(c\) 1992-"),
+    ]
+    # prompts are printed without a trailing newline, so the unterminated
+    # tail is matched too, keeping at most this many characters of it
+    MAX_LINE = 4096
+
+    def __init__(self, target_string, success_patterns=None, failure_patterns=None):
+        success_patterns = success_patterns or [re.escape(target_string)]
+        failure_patterns = self.FAILURE_PATTERNS if failure_patterns is None else failure_patterns
+        self.success = re.compile("|".join(f"(?:{p})" for p in success_patterns))
+        self.failure = re.compile("|".join(f"(?:{p})" for p in failure_patterns)) if failure_patterns else None
+        self.milestone_patterns = [(name, re.compile(pattern)) for name, pattern in self.MILESTONES]
+        self.pending = ""
+        self.verdict = None
+        self.verdict_at = None
+        # first console output and milestone name -> time it was first seen
+        self.first_output = None
+        self.milestones = {}
+
+    def feed(self, data: bytes):
+        # returns a Verdict once one is reached, None while undecided
+        if self.verdict:
+            return self.verdict
+        now = time.time()
+        if self.first_output is None and data:
+            self.first_output = now
+        text = self.pending + data.decode(errors='replace')
+        lines = text.split("\n")
+        self.pending = lines.pop()[-self.MAX_LINE:]
+        for line in lines:
+            self.mark(line, now)
+            verdict = self.match(line)
+            if verdict:
+                self.verdict_at = now
+                return verdict
+        self.mark(self.pending, now)
+        if self.match(self.pending):
+            self.verdict_at = now
+        return self.verdict
+
+    def mark(self, line, now):
+        for name, pattern in self.milestone_patterns:
+            if name not in self.milestones and pattern.search(line):
+                self.milestones[name] = now
+
+    def match(self, line):
+        line = line.rstrip("\r")
+        # success wins when both appear on one line
+        match = self.success.search(line)
+        if match:
+            self.verdict = Verdict(True, match.group(0), line.strip())
+        elif self.failure:
+            match = self.failure.search(line)
+            if match:
+                self.verdict = Verdict(False, match.group(0), line.strip())
+        return self.verdict
@@ -0,0 +1,467 @@
+from src.config import STAND_TEST_ROOT
+from src.core.configuration import Config
+from src.core.engine import TestEngine, TestResult
+from src.core.scheduler import AdmissionScheduler
+from src.core.resource_manager import ResourceManager
+from src.core.pipeline import BuildPipeline
+from src.core.cache_manager import CacheManager
+from src.core.history import RunHistory
+from src.utils.logstore import LogSink
+from src.utils.filelock import file_lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib import request as urlrequest
+from urllib.error import URLError
+import threading
+import asyncio
+import socket
+import json
+import time
+import os
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Task:
+    QUEUED = "queued"
+    LEASED = "leased"
+    RUNNING = "running"
+    DONE = "done"
+
+    def __init__(self, task_id, config: Config):
+        self.id = task_id
+        self.config = config
+        self.state = self.QUEUED
+        self.worker = None
+        self.attempts = 0
+        # a lease not renewed by then is requeued
+        self.deadline = None
+
+    def payload(self, timeout):
+        # what a worker needs to recreate the config on its side
+        config = self.config
+        return {
+            "id": self.id,
+            "arch": config.arch,
+            "filesystem": config.filesystem,
+            "interface": config.interface,
+            "encryption": config.encryption,
+            "version": config.version,
+            "recipe": config.recipe,
+            "timeout": timeout,
+        }
+
+    @staticmethod
+    def config_from(payload):
+        recipe = payload["recipe"]
+        return Config(
+            arch = payload["arch"],
+            filesystem = payload["filesystem"],
+            interface = payload["interface"],
+            flavor = recipe.get('flavor') or None,
+            img_file = recipe.get('img_file') or None,
+            img_url = recipe.get('img_url') or None,
+            encryption = payload["encryption"],
+            version = payload["version"],
+            recipe = recipe
+        )
+
+
+# Coordinator holds the run's config queue and serves it to workers over
+# HTTP/JSON. Workers lease a few tasks ahead of what they run; an idle
+# worker that finds the queue empty steals leased tasks another worker has
+# not started yet, and the tasks of a worker that stopped sending
+# heartbeats go back into the queue. Heartbeats renew the leases of the
+# tasks a worker still holds, a task it dropped (a crash, a result it could
+# not deliver) goes back into the queue when its lease expires.
+class Coordinator:
+    WORKER_TIMEOUT = 30
+    LEASE_TIMEOUT = 60
+    REAP_INTERVAL = 5
+    # a task lost this many times while running is reported as an error
+    MAX_ATTEMPTS = 3
+    # console logs arrive as the files of a LogSink directory
+    LOG_FILES = (LogSink.DATA, LogSink.INDEX, LogSink.TAIL)
+
+    def __init__(self, configs: list[Config], host="127.0.0.1", port=8470):
+        self.host = host
+        self.port = port
+        self.lock = threading.Lock()
+        # results are reported and summarized like local runs
+        self.reporter = ResourceManager(configs)
+        ordered = self.reporter.scheduler.order(configs)
+        self.tasks = {str(i): Task(str(i), config) for i, config in enumerate(ordered)}
+        self.queue = list(self.tasks)
+        self.workers = {}
+        self.finished = threading.Event()
+        if not self.tasks:
+            self.finished.set()
+
+    # -- request handlers, called with self.lock held
+
+    def register(self, worker, slots=1):
+        self.workers[worker] = {"slots": slots, "seen": time.time()}
+        logger.info(f"Worker {worker} joined with {slots} slots")
+        return {"ok": True}
+
+    def lease(self, worker, count=1):
+        self.heartbeat(worker)
+        leased = []
+        while self.queue and len(leased) < count:
+            leased.append(self.tasks[self.queue.pop(0)])
+        if not leased:
+            leased = self.steal(worker, count)
+        for task in leased:
+            task.state = Task.LEASED
+            task.worker = worker
+            task.deadline = time.time() + self.LEASE_TIMEOUT
+        return {
+            "tasks": [task.payload(self.timeout_for(task.config)) for task in leased],
+            "done": self.finished.is_set(),
+        }
+
+    def steal(self, worker, count):
+        # takes half of the not yet started backlog of the busiest worker
+        backlogs = {}
+        for task in self.tasks.values():
+            if task.state == Task.LEASED and task.worker != worker:
+                backlogs.setdefault(task.worker, []).append(task)
+        if not backlogs:
+            return []
+        victim, backlog = max(backlogs.items(), key=lambda item: len(item[1]))
+        stolen = backlog[(len(backlog) + 1) // 2:][:count]
+        if stolen:
+            logger.info(f"Worker {worker} stole {len(stolen)} tasks from {victim}")
+        return stolen
+
+    def start(self, worker, task_id):
+        # the owner confirms before running, a stolen task is refused
+        task = self.tasks.get(task_id)
+        if not task or task.worker != worker or task.state != Task.LEASED:
+            return {"ok": False}
+        task.state = Task.RUNNING
+        task.deadline = time.time() + self.LEASE_TIMEOUT
+        return {"ok": True}
+
+    def heartbeat(self, worker, tasks=()):
+        # tasks are the ids the worker still holds, their leases are renewed
+        now = time.time()
+        if worker not in self.workers:
+            self.workers[worker] = {"slots": 1, "seen": now}
+        self.workers[worker]["seen"] = now
+        for task_id in tasks:
+            task = self.tasks.get(task_id)
+            if task and task.worker == worker and task.state in (Task.LEASED, Task.RUNNING):
+                task.deadline = now + self.LEASE_TIMEOUT
+        return {"ok": True, "done": self.finished.is_set()}
+
+    def result(self, worker, task_id, status, elapsed, returncode=None, detail=None, matched=None, tail=None,
+               fingerprint=None):
+        task = self.tasks.get(task_id)
+        if not task or task.state == Task.DONE:
+            return {"ok": False}
+        # a late result of an expired lease still counts
+        if task.id in self.queue:
+            self.queue.remove(task.id)
+        # the inputs the worker booted, the verdict is recorded under them
+        task.config.fingerprint = fingerprint
+        self.finish(task, TestResult(task.config, status, elapsed, returncode, detail, matched, tail))
+        return {"ok": True}
+
+    def finish(self, task, result):
+        task.state = Task.DONE
+        self.reporter.history.record(result)
+        self.reporter.report(result)
+        if all(t.state == Task.DONE for t in self.tasks.values()):
+            self.finished.set()
+
+    def store_log(self, task_id, name, data):
+        # one file of a worker's LogSink directory
+        task = self.tasks.get(task_id)
+        if not task or name not in self.LOG_FILES:
+            return {"ok": False}
+        if os.path.isfile(task.config.log_file):
+            os.remove(task.config.log_file)
+        os.makedirs(task.config.log_file, exist_ok=True)
+        with open(os.path.join(task.config.log_file, name), 'wb') as log:
+            log.write(data)
+        return {"ok": True}
+
+    def status(self):
+        states = {}
+        for task in self.tasks.values():
+            states[task.state] = states.get(task.state, 0) + 1
+        return {"tasks": states, "workers": sorted(self.workers), "done": self.finished.is_set()}
+
+    def timeout_for(self, config):
+        return self.reporter.history.timeout_for(config, self.reporter.timeout)
+
+    def reap(self):
+        # requeues the tasks of workers that stopped sending heartbeats and
+        # the tasks whose lease was not renewed
+        now = time.time()
+        for worker, info in list(self.workers.items()):
+            if now - info["seen"] < self.WORKER_TIMEOUT:
+                continue
+            logger.warning(f"Worker {worker} timed out, requeueing its tasks")
+            del self.workers[worker]
+            for task in self.tasks.values():
+                if task.worker == worker and task.state in (Task.LEASED, Task.RUNNING):
+                    self.requeue(task)
+        for task in self.tasks.values():
+            if task.state in (Task.LEASED, Task.RUNNING) and task.deadline < now:
+                logger.warning(f"Lease of {task.config.identifier} on {task.worker} expired, requeueing it")
+                self.requeue(task)
+
+    def requeue(self, task):
+        task.worker = None
+        task.deadline = None
+        if task.state == Task.RUNNING:
+            task.attempts += 1
+        if task.attempts >= self.MAX_ATTEMPTS:
+            self.finish(task, TestResult(task.config, TestResult.ERROR, 0.0,
+                                         detail=f"lost {task.attempts} workers"))
+        else:
+            task.state = Task.QUEUED
+            self.queue.insert(0, task.id)
+
+    def handler(self):
+        coordinator = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path != "/status":
+                    return self.reply(404, {"error": "not found"})
+                with coordinator.lock:
+                    self.reply(200, coordinator.status())
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                route = self.path.strip("/").split("/")
+                try:
+                    with coordinator.lock:
+                        if route[0] == "log" and len(route) == 3:
+                            return self.reply(200, coordinator.store_log(route[1], route[2], body))
+                        endpoints = {
+                            "register": coordinator.register,
+                            "lease": coordinator.lease,
+                            "start": coordinator.start,
+                            "heartbeat": coordinator.heartbeat,
+                            "result": coordinator.result,
+                        }
+                        if route[0] not in endpoints:
+                            return self.reply(404, {"error": "not found"})
+                        return self.reply(200, endpoints[route[0]](**json.loads(body or b"{}")))
+                except (TypeError, ValueError) as e:
+                    return self.reply(400, {"error": str(e)})
+
+            def reply(self, code, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logger.debug(f"{self.address_string()} {format % args}")
+
+        return Handler
+
+    def serve(self):
+        # serves until every task has a result, returns the results
+        server = ThreadingHTTPServer((self.host, self.port), self.handler())
+        thread = threading.Thread(target=server.serve_forever, name="coordinator", daemon=True)
+        thread.start()
+        print(f"Coordinator serving {len(self.tasks)} tasks on {self.host}:{server.server_address[1]}")
+        start_time = time.time()
+        try:
+            while not self.finished.wait(self.REAP_INTERVAL):
+                with self.lock:
+                    self.reap()
+            # let workers see done on their next poll before going away
+            time.sleep(self.REAP_INTERVAL)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        print(f"Total Time Elapsed: {time.time() - start_time:.2f}s")
+        counters = self.reporter.counters
+        print(f"\nSummary : \n{counters['passed']} Passed\n{counters['cached-pass']} Cached-pass\n{counters['failed']} Failed\n{counters['timeout']} Timed-out")
+        return self.reporter.results
+
+
+# Worker pulls tasks from a coordinator, builds (or fetches from the
+# artifact cache) their images, boots them under its own admission
+# scheduler and sends results and console logs back
+class Worker:
+    HEARTBEAT_INTERVAL = 5
+    POLL_INTERVAL = 2
+    # tasks leased ahead of free slots, idle workers may steal them
+    PREFETCH = 2
+    REQUEST_TIMEOUT = 30
+    # consecutive failed leases before giving up on the coordinator
+    MAX_FAILURES = 5
+    # attempts of a start, log or result post, backing off from RETRY_DELAY
+    RETRIES = 4
+    RETRY_DELAY = 1
+    # per machine_combo build locks, shared by every worker on this host
+    LOCK_DIR = f"{STAND_TEST_ROOT}/locks"
+
+    def __init__(self, url, slots=None, name=None, reverify=False):
+        self.url = url.rstrip("/")
+        self.slots = slots or os.cpu_count() or 1
+        self.name = name or f"{socket.gethostname()}-{os.getpid()}"
+        self.scheduler = AdmissionScheduler(max_jobs=self.slots)
+        self.backlog = []
+        # asyncio task -> id of the task it processes
+        self.running = {}
+        # machine_combo -> lock, configs of one combo share trees and
+        # partitions so their builds must not race, other combos build in
+        # parallel. Workers sharing STAND_TEST_ROOT also take a file lock
+        self.build_locks = {}
+        self.history = RunHistory()
+        # reverify boots configs even when identical inputs passed before
+        self.verdicts = None if reverify else self.history
+        # task id -> when it started, what in-flight tasks use is not evicted
+        self.started = {}
+        self.done = False
+
+    def call(self, endpoint, payload=None, data=None):
+        body = data if data is not None else json.dumps(payload or {}).encode()
+        req = urlrequest.Request(f"{self.url}/{endpoint}", data=body, method="POST",
+                                 headers={"Content-Type": "application/json" if data is None else "application/octet-stream"})
+        with urlrequest.urlopen(req, timeout=self.REQUEST_TIMEOUT) as response:
+            return json.loads(response.read())
+
+    async def post(self, endpoint, payload=None, data=None):
+        return await asyncio.to_thread(self.call, endpoint, payload, data)
+
+    async def send(self, endpoint, payload=None, data=None):
+        # post with retries, raises the last error once they are used up
+        for attempt in range(self.RETRIES):
+            try:
+                return await self.post(endpoint, payload, data)
+            except (URLError, OSError, ValueError) as e:
+                if attempt == self.RETRIES - 1:
+                    raise
+                logger.warning(f"Post of {endpoint} to {self.url} failed, retrying: {e}")
+                await asyncio.sleep(self.RETRY_DELAY * 2 ** attempt)
+
+    def holding(self):
+        return [payload["id"] for payload in self.backlog] + list(self.running.values())
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(self.HEARTBEAT_INTERVAL)
+            try:
+                await self.post("heartbeat", {"worker": self.name, "tasks": self.holding()})
+            except (URLError, OSError, ValueError) as e:
+                logger.warning(f"Heartbeat to {self.url} failed: {e}")
+
+    async def process(self, payload):
+        # a task given up on here is requeued by the coordinator once its
+        # lease expires
+        try:
+            started = (await self.send("start", {"worker": self.name, "task_id": payload["id"]}))["ok"]
+        except (URLError, OSError, ValueError) as e:
+            logger.error(f"Could not start task {payload['id']}: {e}")
+            return
+        if not started:
+            # stolen by another worker meanwhile
+            return
+        config = Task.config_from(payload)
+        self.started[payload["id"]] = time.time()
+        try:
+            result = await self.build_and_test(config, payload["timeout"])
+        except Exception as e:
+            result = TestResult(config, TestResult.ERROR, 0.0, detail=str(e))
+        finally:
+            del self.started[payload["id"]]
+        await asyncio.to_thread(self.enforce_budget)
+        for name in Coordinator.LOG_FILES:
+            path = os.path.join(config.log_file, name)
+            try:
+                if os.path.exists(path):
+                    with open(path, 'rb') as log:
+                        await self.send(f"log/{payload['id']}/{name}", data=log.read())
+            except (URLError, OSError, ValueError) as e:
+                # the result matters more than its log
+                logger.warning(f"Could not upload {name} of {config.identifier}: {e}")
+        try:
+            await self.send("result", {
+                "worker": self.name, "task_id": payload["id"], "status": result.status,
+                "elapsed": result.elapsed, "returncode": result.returncode,
+                "detail": result.detail, "matched": result.matched, "tail": result.tail,
+                "fingerprint": config.fingerprint})
+        except (URLError, OSError, ValueError) as e:
+            logger.error(f"Could not report {config.identifier} {result.status}, it will be requeued: {e}")
+            return
+        print(f"{config.identifier} {result.status} in {result.elapsed:.2f}s")
+
+    def enforce_budget(self):
+        # keeps STAND_TEST_ROOT within its budget between tasks, sparing
+        # everything accessed since the oldest task still in flight started
+        keep_since = min(self.started.values(), default=time.time())
+        try:
+            CacheManager().enforce(keep_since=keep_since)
+        except OSError as e:
+            logger.warning(f"Could not enforce cache budget: {e}")
+
+    async def build_and_test(self, config: Config, timeout):
+        start = time.time()
+        async with self.build_locks.setdefault(config.machine_combo, asyncio.Lock()):
+            try:
+                built = await asyncio.to_thread(self.build, config)
+            except Exception as e:
+                return TestResult(config, TestResult.ERROR, time.time() - start, detail=f"build failed: {e}")
+        if not built:
+            return TestResult(config, TestResult.ERROR, time.time() - start, detail="build failed")
+        engine = TestEngine(timeout=timeout, scheduler=self.scheduler, verdicts=self.verdicts, record=self.history.record)
+        return await engine.run_and_report(config)
+
+    def build(self, config: Config):
+        with file_lock(os.path.join(self.LOCK_DIR, f"{config.machine_combo}.lock")):
+            return BuildPipeline([config], max_workers=1).run()
+
+    async def run_async(self):
+        await self.post("register", {"worker": self.name, "slots": self.slots})
+        print(f"Worker {self.name} pulling from {self.url} with {self.slots} slots")
+        beat = asyncio.create_task(self.heartbeat())
+        failures = 0
+        try:
+            while True:
+                want = self.slots * self.PREFETCH - len(self.backlog) - len(self.running)
+                if want > 0 and not self.done:
+                    try:
+                        reply = await self.post("lease", {"worker": self.name, "count": want})
+                        self.backlog.extend(reply["tasks"])
+                        self.done = reply["done"]
+                        failures = 0
+                    except (URLError, OSError) as e:
+                        logger.warning(f"Lease from {self.url} failed: {e}")
+                        failures += 1
+                        if failures >= self.MAX_FAILURES and not self.running:
+                            print(f"Coordinator {self.url} is gone, stopping")
+                            break
+                while self.backlog and len(self.running) < self.slots:
+                    payload = self.backlog.pop(0)
+                    self.running[asyncio.create_task(self.process(payload))] = payload["id"]
+                if self.done and not self.running:
+                    break
+                if self.running:
+                    finished, _ = await asyncio.wait(list(self.running), timeout=self.POLL_INTERVAL,
+                                                     return_when=asyncio.FIRST_COMPLETED)
+                    for task in finished:
+                        self.running.pop(task, None)
+                        if task.exception():
+                            logger.error(f"Task failed on {self.name}: {task.exception()}")
+                else:
+                    await asyncio.sleep(self.POLL_INTERVAL)
+        finally:
+            beat.cancel()
+
+    def run(self):
+        asyncio.run(self.run_async())
@@ -0,0 +1,209 @@
+from src.core.configuration import Config
+from src.core.console import ConsoleMatcher
+from src.core.snapshot import FirmwareSnapshot
+from src.core.monitor import MonitorAllocator
+from src.utils.logstore import LogSink, LogReader
+from src.utils.tracing import tracer
+from src.utils.metrics import metrics
+import asyncio
+import tempfile
+import shutil
+import signal
+import time
+import os
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# TestResult is the outcome of booting a single config
+class TestResult:
+    PASSED = "passed"
+    FAILED = "failed"
+    TIMEOUT = "timeout"
+    ERROR = "error"
+    # passed before with identical inputs, not booted again
+    CACHED = "cached-pass"
+
+    def __init__(self, config: Config, status, elapsed, returncode=None, detail=None, matched=None, tail=None):
+        self.config = config
+        self.status = status
+        self.elapsed = elapsed
+        self.returncode = returncode
+        self.detail = detail
+        # console line the verdict was reached on
+        self.matched = matched
+        # last console lines of a failed run
+        self.tail = tail
+
+    @property
+    def passed(self):
+        return self.status in (self.PASSED, self.CACHED)
+
+    @property
+    def cached(self):
+        return self.status == self.CACHED
+
+    def __str__(self):
+        return f"TestResult({self.config.identifier}, {self.status}, {self.elapsed:.2f}s)"
+
+
+# TestEngine boots configs with asyncio subprocesses, at most max_workers at
+# a time or as admitted by a scheduler. Each guest runs in its own process
+# group so a timeout or a cancellation takes down qemu along with the
+# wrapper shell.
+class TestEngine:
+    # console lines kept with a failed result
+    TAIL_LINES = 10
+
+    def __init__(self, max_workers=1, timeout=90, scheduler=None, timeout_for=None, verdicts=None, record=None):
+        self.max_workers = max(1, max_workers)
+        self.timeout = timeout
+        self.scheduler = scheduler
+        # timeout_for(config) -> seconds, e.g. derived from run history
+        self.timeout_for = timeout_for
+        # verdicts.cached_pass(config) skips configs whose inputs passed before
+        self.verdicts = verdicts
+        # record(result) stores a result, e.g. in run history
+        self.record = record
+        self.semaphore = None
+
+    def run(self, configs: list[Config], on_result=None):
+        return asyncio.run(self.run_all(configs, on_result))
+
+    async def run_all(self, configs: list[Config], on_result=None):
+        self.semaphore = asyncio.Semaphore(self.max_workers)
+        if self.scheduler:
+            # ordering estimates every config from run history once, off the loop
+            configs = await asyncio.to_thread(self.scheduler.order, configs)
+        return await asyncio.gather(*(self.run_and_report(config, on_result) for config in configs))
+
+    async def run_stream(self, queue: asyncio.Queue, on_result=None):
+        # runs configs as they are put on queue, until None is put
+        self.semaphore = asyncio.Semaphore(self.max_workers)
+        tasks = []
+        while (config := await queue.get()) is not None:
+            tasks.append(asyncio.create_task(self.run_and_report(config, on_result)))
+        return await asyncio.gather(*tasks)
+
+    async def run_and_report(self, config: Config, on_result=None):
+        result = await self.run_one(config)
+        if self.record:
+            await asyncio.to_thread(self.record, result)
+        if on_result:
+            on_result(result)
+        return result
+
+    def slot(self, config: Config):
+        if self.scheduler:
+            return self.scheduler.slot(config)
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_workers)
+        return self.semaphore
+
+    async def run_one(self, config: Config):
+        if self.verdicts:
+            # history lookups are sqlite queries, they are kept off the loop
+            cached = await asyncio.to_thread(self.verdicts.cached_pass, config)
+            metrics.cache("verdict", cached)
+            if cached:
+                return TestResult(config, TestResult.CACHED, 0.0, detail="inputs unchanged since a passing run")
+        async with self.slot(config):
+            failure_patterns = config.failure_patterns
+            if FirmwareSnapshot.enabled(config):
+                failure_patterns = FirmwareSnapshot.failure_patterns(config)
+            matcher = ConsoleMatcher(config.target_string, config.success_patterns, failure_patterns)
+            start = time.time()
+            result = await self.boot(config, matcher)
+            self.trace(config, matcher, start, result)
+            return result
+
+    def trace(self, config: Config, matcher, start, result):
+        # spawn -> first output -> loader -> kernel -> rc reached
+        points = [("spawn", start), ("firmware", matcher.first_output),
+                  ("loader", matcher.milestones.get("loader")), ("kernel", matcher.milestones.get("kernel")),
+                  ("rc", matcher.verdict_at if result.passed else None)]
+        points = [(name, at) for name, at in points if at is not None]
+        end = start + result.elapsed
+        for i, (name, at) in enumerate(points):
+            if name == "rc":
+                break
+            until = points[i + 1][1] if i + 1 < len(points) else end
+            tracer.add(name, at, until, "test", tid=config.identifier,
+                       identifier=config.identifier, outcome=result.status)
+            metrics.observe("bootbaker_test_phase_seconds", until - at, phase=name)
+
+    async def boot(self, config: Config, matcher):
+        # per run scratch area for disk overlays and the monitor socket,
+        # discarded afterwards
+        os.makedirs(config.SCRATCH_DIR, exist_ok=True)
+        scratch = tempfile.mkdtemp(prefix=f"{config.identifier}.", dir=config.SCRATCH_DIR)
+        MonitorAllocator.prepare(config.monitor)
+        try:
+            result = await self.boot_in(config, matcher, scratch)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+            MonitorAllocator.cleanup(config.monitor)
+        if not result.passed and result.status != TestResult.ERROR:
+            result.tail = LogReader(config.log_file).tail(self.TAIL_LINES)
+        return result
+
+    async def boot_in(self, config: Config, matcher, scratch):
+        script = os.path.join(config.script_dir, config.script_file)
+        os.makedirs(config.log_path, exist_ok=True)
+        timeout = await asyncio.to_thread(self.timeout_for, config) if self.timeout_for else self.timeout
+        # warm started guests get the shell commands starting the loader on stdin
+        warm = FirmwareSnapshot.enabled(config)
+        start = time.time()
+        try:
+            # compressed, size capped and indexed, see LogSink
+            with LogSink(config.log_file) as log:
+                process = await asyncio.create_subprocess_exec(
+                    '/bin/sh', script, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+                    stdin=asyncio.subprocess.PIPE if warm else asyncio.subprocess.DEVNULL, start_new_session=True,
+                    env={**os.environ, "BOOTBAKER_SCRATCH": scratch, "BOOTBAKER_MONITOR": config.monitor})
+                resume = asyncio.create_task(FirmwareSnapshot.resume(config, process)) if warm else None
+                try:
+                    verdict = await asyncio.wait_for(self.watch(process, log, matcher), timeout)
+                except asyncio.TimeoutError:
+                    await self.kill(process)
+                    log.write(b"\n---Script execution timed out---\n")
+                    return TestResult(config, TestResult.TIMEOUT, time.time() - start)
+                except asyncio.CancelledError:
+                    await self.kill(process)
+                    raise
+                finally:
+                    if resume:
+                        resume.cancel()
+        except OSError as e:
+            return TestResult(config, TestResult.ERROR, time.time() - start, detail=str(e))
+
+        elapsed = time.time() - start
+        if verdict:
+            status = TestResult.PASSED if verdict.passed else TestResult.FAILED
+            detail = None if verdict.passed else f"matched {verdict.pattern!r}"
+            return TestResult(config, status, elapsed, process.returncode, detail, verdict.line)
+        if process.returncode != 0:
+            return TestResult(config, TestResult.FAILED, elapsed, process.returncode, f"exited with {process.returncode}")
+        return TestResult(config, TestResult.FAILED, elapsed, process.returncode, "RC COMMAND String not found!")
+
+    async def watch(self, process, log, matcher):
+        # streams the console into the log and stops the guest on a verdict
+        while chunk := await process.stdout.read(65536):
+            log.write(chunk)
+            verdict = matcher.feed(chunk)
+            if verdict:
+                log.write(f"\n---Verdict {'passed' if verdict.passed else 'failed'}: {verdict.line}---\n".encode())
+                await self.kill(process)
+                return verdict
+        await process.wait()
+        return None
+
+    @staticmethod
+    async def kill(process):
+        # kills the whole process group, qemu is a child of /bin/sh
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await process.wait()
@@ -0,0 +1,123 @@
+from src.config import STAND_TEST_ROOT
+from src.core.configuration import Config
+from contextlib import closing
+import threading
+import sqlite3
+import socket
+import math
+import time
+import os
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# RunHistory records every test run in a local SQLite database and derives
+# per config timeouts and duration estimates from past runs. Passing runs
+# are also remembered by the fingerprint of their inputs, so an unchanged
+# config can be reported as passed without booting it again
+class RunHistory:
+    HISTORY_FILE = f"{STAND_TEST_ROOT}/history.sqlite"
+    # timeout = quantile of passed durations * margin, clamped to [floor, ceiling]
+    TIMEOUT_QUANTILE = 0.99
+    TIMEOUT_MARGIN = 1.5
+    TIMEOUT_FLOOR = 30
+    TIMEOUT_CEILING = 600
+    # fewer samples than this falls back to the arch, then to the default
+    MIN_SAMPLES = 5
+    # only the most recent runs count, boot times drift with the sources
+    WINDOW = 100
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        identifier TEXT NOT NULL,
+        arch TEXT NOT NULL,
+        machine_arch TEXT NOT NULL,
+        duration REAL NOT NULL,
+        outcome TEXT NOT NULL,
+        host TEXT NOT NULL,
+        started_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS runs_identifier ON runs (identifier, outcome);
+    CREATE INDEX IF NOT EXISTS runs_machine_arch ON runs (machine_arch, outcome);
+    CREATE TABLE IF NOT EXISTS verdicts (
+        fingerprint TEXT PRIMARY KEY,
+        identifier TEXT NOT NULL,
+        outcome TEXT NOT NULL,
+        recorded_at REAL NOT NULL
+    );
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, path=None):
+        self.path = path or self.HISTORY_FILE
+        self.host = socket.gethostname()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock, closing(self.connect()) as conn:
+            conn.executescript(self.SCHEMA)
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def record(self, result):
+        config = result.config
+        if result.cached:
+            # nothing ran, there is no duration to learn from
+            return
+        with self._lock, closing(self.connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO runs (identifier, arch, machine_arch, duration, outcome, host, started_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (config.identifier, config.arch, config.machine_arch, result.elapsed,
+                 result.status, self.host, time.time() - result.elapsed))
+            if config.fingerprint:
+                # a failing run forgets an earlier pass of the same inputs
+                conn.execute(
+                    "INSERT OR REPLACE INTO verdicts (fingerprint, identifier, outcome, recorded_at) VALUES (?, ?, ?, ?)",
+                    (config.fingerprint, config.identifier, result.status, time.time()))
+
+    def cached_pass(self, config: Config):
+        # True when the exact same inputs passed before
+        if not config.fingerprint:
+            return False
+        with self._lock, closing(self.connect()) as conn:
+            row = conn.execute("SELECT outcome FROM verdicts WHERE fingerprint = ?", (config.fingerprint,)).fetchone()
+        return row is not None and row[0] == "passed"
+
+    def durations(self, column, value, outcome=None):
+        query = f"SELECT duration FROM runs WHERE {column} = ?"
+        params = [value]
+        if outcome:
+            query += " AND outcome = ?"
+            params.append(outcome)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(self.WINDOW)
+        with self._lock, closing(self.connect()) as conn:
+            return [row[0] for row in conn.execute(query, params)]
+
+    def samples(self, config: Config, outcome=None):
+        # the config's own history, or its arch's when there is too little
+        for column, value in [("identifier", config.identifier), ("machine_arch", config.machine_arch)]:
+            durations = self.durations(column, value, outcome)
+            if len(durations) >= self.MIN_SAMPLES:
+                return durations
+        return []
+
+    @staticmethod
+    def quantile(values, q):
+        ordered = sorted(values)
+        return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+    def timeout_for(self, config: Config, default):
+        durations = self.samples(config, outcome="passed")
+        if not durations:
+            return default
+        timeout = self.quantile(durations, self.TIMEOUT_QUANTILE) * self.TIMEOUT_MARGIN
+        return min(self.TIMEOUT_CEILING, max(self.TIMEOUT_FLOOR, timeout))
+
+    def estimate(self, config: Config):
+        # median duration of recent runs, None without enough history
+        durations = self.samples(config)
+        return self.quantile(durations, 0.5) if durations else None
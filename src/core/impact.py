@@ -0,0 +1,63 @@
+from src.config import SRCTOP, IMPACT_RULES
+from src.core.configuration import Config
+from src.core.parser import Parser
+from typing import Iterable
+import subprocess
+import fnmatch
+import yaml
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# ChangeImpact selects the configs a source change can affect. The paths
+# changed in SRCTOP over a revision range are mapped to matrix expressions
+# by the rules in IMPACT_RULES, first matching rule wins, and only configs
+# matched by one of the resulting expressions are kept
+class ChangeImpact:
+
+    def __init__(self, rev_range, srctop=None, rules_file=None):
+        self.rev_range = rev_range
+        self.srctop = srctop or SRCTOP
+        self.parser = Parser("*-*-*-*")
+        with open(rules_file or IMPACT_RULES, 'r') as f:
+            rules = yaml.safe_load(f)["rules"]
+        # (path globs, compiled expressions) in rule order
+        self.rules = [(rule["paths"], [self.parser.compile(expression) for expression in rule["affects"]])
+                      for rule in rules]
+
+    def changed_paths(self):
+        # a range (a..b) or a single revision compared to the working tree
+        result = subprocess.run(["git", "-C", self.srctop, "diff", "--name-only", self.rev_range],
+                                capture_output=True, check=True, text=True)
+        return [path for path in result.stdout.splitlines() if path]
+
+    def rule_for(self, path):
+        for globs, expressions in self.rules:
+            if any(fnmatch.fnmatchcase(path, glob) for glob in globs):
+                return globs, expressions
+        return None
+
+    def affected(self):
+        # the expressions hit by the change, deduplicated
+        expressions = {}
+        for path in self.changed_paths():
+            rule = self.rule_for(path)
+            if rule is None:
+                logger.debug(f"{path} does not affect the boot path")
+                continue
+            logger.debug(f"{path} matches {rule[0]}")
+            for expression in rule[1]:
+                expressions.setdefault(str(expression), expression)
+        return list(expressions.values())
+
+    def select(self, configs: Iterable[Config]):
+        # yields the configs affected by the change
+        expressions = self.affected()
+        logger.info(f"Changes in {self.rev_range} affect {', '.join(map(str, expressions)) or 'nothing'}")
+        for config in configs:
+            combination = (config.arch, config.filesystem, config.interface, config.encryption, config.version)
+            if any(expression.matches(combination) for expression in expressions):
+                yield config
+            else:
+                logger.debug(f"Skipping {config.identifier}, not affected by {self.rev_range}")
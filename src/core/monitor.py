@@ -0,0 +1,113 @@
+from src.config import STAND_TEST_ROOT, QEMU_MONITOR
+import threading
+import asyncio
+import socket
+import os
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# MonitorAllocator hands out a QEMU monitor endpoint per guest that is
+# unique across the whole run. By default every guest gets its own UNIX
+# socket under the run directory, with QEMU_MONITOR = "tcp" it gets a
+# telnet port that was free when it was handed out. Endpoints are specs
+# in -monitor syntax, e.g. unix:/path/4711-3.sock or telnet:127.0.0.1:4003
+class MonitorAllocator:
+    RUN_DIR = f"{STAND_TEST_ROOT}/run"
+    BASE_PORT = 4000
+    MAX_PORT = 65535
+    # sun_path is 104 bytes on FreeBSD, longer paths fall back to tcp
+    MAX_SOCKET_PATH = 100
+
+    def __init__(self, kind=None):
+        self.kind = kind or QEMU_MONITOR
+        self.lock = threading.Lock()
+        self.allocated = set()
+        self.next_port = self.BASE_PORT
+        self.next_socket = 0
+
+    def allocate(self, port=None):
+        # port pins a telnet port, it still has to be unused in this run
+        with self.lock:
+            if port is None and self.kind == "unix":
+                spec = self.allocate_socket()
+                if spec:
+                    return spec
+            return self.allocate_port(port)
+
+    def allocate_socket(self):
+        path = os.path.join(self.RUN_DIR, f"{os.getpid()}-{self.next_socket}.sock")
+        if len(path) > self.MAX_SOCKET_PATH:
+            logger.warning(f"{path} is too long for a UNIX socket, using a tcp monitor")
+            return None
+        self.next_socket += 1
+        spec = f"unix:{path}"
+        self.allocated.add(spec)
+        return spec
+
+    def allocate_port(self, port=None):
+        candidates = [port] if port else range(self.next_port, self.MAX_PORT + 1)
+        for candidate in candidates:
+            spec = f"telnet:127.0.0.1:{candidate}"
+            if spec in self.allocated or not self.port_free(candidate):
+                continue
+            self.allocated.add(spec)
+            if not port:
+                self.next_port = candidate + 1
+            return spec
+        raise RuntimeError(f"No free monitor port {'' if port else 'from '}{port or self.next_port}")
+
+    @staticmethod
+    def port_free(port):
+        # qemu listens on the loopback address
+        with socket.socket() as s:
+            try:
+                s.bind(("127.0.0.1", port))
+            except OSError:
+                return False
+        return True
+
+    def release(self, spec):
+        with self.lock:
+            self.allocated.discard(spec)
+        self.cleanup(spec)
+
+    @staticmethod
+    def cleanup(spec):
+        # a killed qemu leaves its socket file behind
+        kind, _, address = spec.partition(":")
+        if kind == "unix":
+            try:
+                os.remove(address)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def prepare(spec):
+        kind, _, address = spec.partition(":")
+        if kind == "unix":
+            os.makedirs(os.path.dirname(address), exist_ok=True)
+
+    @staticmethod
+    def connect(spec, timeout=None):
+        kind, _, address = spec.partition(":")
+        if kind == "unix":
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            sock.connect(address)
+            return sock
+        host, _, port = address.rpartition(":")
+        return socket.create_connection((host or "127.0.0.1", int(port)), timeout=timeout)
+
+    @staticmethod
+    async def open_connection(spec):
+        kind, _, address = spec.partition(":")
+        if kind == "unix":
+            return await asyncio.open_unix_connection(address)
+        host, _, port = address.rpartition(":")
+        return await asyncio.open_connection(host or "127.0.0.1", int(port))
+
+
+# run wide allocator, every Config takes its monitor from here
+monitors = MonitorAllocator()
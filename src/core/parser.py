@@ -1,115 +1,204 @@
 from src.core.configuration import Config
 import yaml
 import itertools
+import fnmatch
 from pathlib import Path
 import re
 
 import logging
 logger = logging.getLogger(__name__)
 
+
+# AxisPattern is one field of a matrix expression: a value, a glob, a
+# {a,b} alternation of either, or their negation with a leading "!". It is
+# compiled against the axis' known values once, so membership of a known
+# value is a set lookup
+class AxisPattern:
+    GLOB_CHARS = re.compile(r"[*?\[]")
+
+    def __init__(self, pattern, universe):
+        self.pattern = pattern
+        self.negate = pattern.startswith("!")
+        body = pattern[1:] if self.negate else pattern
+        if body.startswith("{") and body.endswith("}"):
+            alternatives = [a.strip() for a in body[1:-1].split(",")]
+        else:
+            alternatives = [body]
+        if not all(alternatives):
+            raise ValueError(f"Empty alternative in {pattern!r}")
+        self.alternatives = alternatives
+        self.universe = frozenset(universe)
+
+        matched = [value for value in universe if self.match(value)]
+        # literals outside the known values are taken as they are
+        literals = [a for a in alternatives if not self.GLOB_CHARS.search(a) and a not in self.universe]
+        self.values = tuple(matched if self.negate else matched + literals)
+        self.allowed = frozenset(self.values)
+
+    def match(self, value):
+        hit = any(fnmatch.fnmatchcase(value, a) for a in self.alternatives)
+        return hit != self.negate
+
+    def __contains__(self, value):
+        if value in self.allowed:
+            return True
+        if value in self.universe:
+            return False
+        return self.match(value)
+
+    def __str__(self):
+        return self.pattern
+
+
+# MatrixExpression is a compiled arch-filesystem-interface-encryption[@version]
+# expression, it yields its combinations lazily and tests single
+# combinations in constant time
+class MatrixExpression:
+    FIELDS = ["arch", "filesystem", "interface", "encryption"]
+
+    def __init__(self, expression, universes, versions=None):
+        self.expression = expression
+        fields, _, version = expression.partition("@")
+        parts = self.split(fields)
+        if len(parts) != len(self.FIELDS):
+            raise ValueError(f"Invalid expression {expression!r}, expected {'-'.join(self.FIELDS)}[@version]")
+        self.axes = [AxisPattern(part, universes[name]) for name, part in zip(self.FIELDS, parts)]
+        # the version axis, None when the expression does not constrain it
+        self.versions = None
+        if version:
+            self.versions = AxisPattern(version, versions or [])
+        elif versions:
+            self.versions = AxisPattern("*", versions)
+
+    @staticmethod
+    def split(fields):
+        # splits on "-" outside of {...}
+        parts, depth, current = [], 0, ""
+        for char in fields:
+            depth += {"{": 1, "}": -1}.get(char, 0)
+            if char == "-" and depth == 0:
+                parts.append(current)
+                current = ""
+            else:
+                current += char
+        parts.append(current)
+        return parts
+
+    def expand(self):
+        # yields (arch, filesystem, interface, encryption, version) tuples,
+        # version is None without a version axis
+        versions = self.versions.values if self.versions else (None,)
+        return itertools.product(*(axis.values for axis in self.axes), versions)
+
+    def matches(self, combination):
+        fields = combination[:len(self.FIELDS)]
+        version = combination[len(self.FIELDS)] if len(combination) > len(self.FIELDS) else None
+        if not all(value in axis for value, axis in zip(fields, self.axes)):
+            return False
+        return self.versions is None or version is None or version in self.versions
+
+    def __str__(self):
+        return self.expression
+
+
 class Parser:
     arches = ["amd64:amd64", "i386:i386", "arm:armv7", "arm64:aarch64", "riscv:riscv64", "powerpc:powerpc64", "powerpc:powerpc64le"]
     filesystems = ["zfs", "ufs"]
     interfaces = ["gpt", "mbr"]
     encryptions = ["geli", "none"]
+    versions = ["13.2"]
     blacklist_regexes = ["riscv:riscv64-*-mbr-*"]
     linuxboot_edk2_list = ["amd64:amd64-*-*-*","arm64:arm64-*-*-*"]
 
-    def __init__(self, config: str):
+    def __init__(self, config):
         logger.debug(f"config: {config}")
-
-        pattern = re.compile(r'^([\w:*]+)-([\w*]+)-([\w*]+)-([\w*]+)$')
-        match = pattern.match(config)
-        if match :
-            arch, fs, interface, encryption = match.groups()
-            recipe = {
-                'arch': arch,
-                'filesystem':fs,
-                'interface':interface,
-                'encryption':encryption,
-                'regex_combination': ["-".join(config.split("-")[1:])]
-            }
-            # yaml formatting
-            self.recipes = {'recipe':recipe}
-        
-        else :
-            # if its not an expression try to parse as config file
-            self.configfile = Path(config)
-            if not self.configfile.is_file():
-                raise FileNotFoundError(f"The specified config file '{config}' does not exist.")
-
-            # Load the YAML file
-            with open(self.configfile, 'r') as file:
+        self.universes = {
+            # globs only expand to arches a Config can be made for
+            "arch": [arch for arch in self.arches if arch in Config.VALID_ARCHES],
+            "filesystem": self.filesystems,
+            "interface": self.interfaces,
+            "encryption": self.encryptions,
+        }
+        # compiled once, checked for every combination
+        self.blacklist = [self.compile(regex) for regex in self.blacklist_regexes]
+
+        if hasattr(config, "read"):
+            # an already opened config file
+            self.recipes = yaml.safe_load(config)
+            return
+
+        config = str(config)
+        if Path(config).is_file():
+            with open(config, 'r') as file:
                 self.recipes = yaml.safe_load(file)
-        
-
+            return
+
+        # if it's not a config file try to parse it as an expression
+        try:
+            expression = self.compile(config)
+        except ValueError:
+            raise FileNotFoundError(f"The specified config file '{config}' does not exist.")
+        arch = MatrixExpression.split(config.partition("@")[0])[0]
+        rest = config[len(arch) + 1:]
+        recipe = {
+            'arch': arch,
+            'filesystem': str(expression.axes[1]),
+            'interface': str(expression.axes[2]),
+            'encryption': str(expression.axes[3]),
+            'regex_combination': [rest]
+        }
+        # yaml formatting
+        self.recipes = {'recipe': recipe}
+
+    def compile(self, expression, versions=None):
+        return MatrixExpression(expression, self.universes, versions)
+
+    def recipe_versions(self, recipe):
+        # a recipe's version is a single version, a list or a {a,b} set
+        version = recipe.get('version') or recipe.get('freebsd_version') or '13.2'
+        if isinstance(version, (list, tuple)):
+            return [str(v) for v in version]
+        return list(AxisPattern(str(version), self.versions).values)
 
     def generate_regex_from_combination(self, combination):
-        arch, fs, interface, encryption = combination
-        return f"{arch}-{fs}-{interface}-{encryption}"
-
-    def generate_combinations_from_regex(self, regex):
-        arch, fs, interface, encryption = regex.split('-')
-        params = [
-            self.arches if arch == '*' else [arch],
-            self.filesystems if fs == '*' else [fs],
-            self.interfaces if interface == '*' else [interface],
-            self.encryptions if encryption == '*' else [encryption]
-        ]
-        # returns list of tuple of (arch, fs, interface, encryption)
-        combinations = list(itertools.product(*params))
-
-        # map a function
-        regex_list = list(map(lambda c : self.generate_regex_from_combination(c), combinations))
-        return regex_list
-
-
-    def generate_valid_combinations_from_regex(self, regex):
-
-        # generate universe of combinations
-        universe = self.generate_combinations_from_regex('*-*-*-*')
-
-        blacklisted_combinations = []
-        for blacklist_regex in self.blacklist_regexes:
-            blacklisted_combinations.extend(self.generate_combinations_from_regex(blacklist_regex))
-
-        # generate requested combination
-        requested_combination = self.generate_combinations_from_regex(regex)
+        return "-".join(combination[:4]) + (f"@{combination[4]}" if len(combination) > 4 and combination[4] else "")
 
-        # create valid combination
-        universe_set = set(universe)
-        blacklisted_set = set(blacklisted_combinations)
-        valid_combination_set = universe_set - blacklisted_set
+    def generate_combinations_from_regex(self, regex, versions=None):
+        # yields the expression's combinations lazily
+        for combination in self.compile(regex, versions).expand():
+            yield self.generate_regex_from_combination(combination)
 
-        valid_combination = [combo for combo in requested_combination if combo in valid_combination_set]
+    def is_blacklisted(self, combination, blacklist=()):
+        return any(expression.matches(combination) for expression in itertools.chain(self.blacklist, blacklist))
 
-        return valid_combination
+    def generate_valid_combinations_from_regex(self, regex, versions=None):
+        for combination in self.compile(regex, versions).expand():
+            if not self.is_blacklisted(combination):
+                yield self.generate_regex_from_combination(combination)
 
     def generate_configs(self):
-        # create config from each recipe's config expression
-        configs = []
+        # yields a Config per valid combination of each recipe's expressions,
+        # nothing is expanded before it is consumed
         for _, recipe in self.recipes.items():
-            combinations = []
+            versions = self.recipe_versions(recipe)
+            # per recipe additions to the blacklist
+            exclude = [self.compile(regex, versions) for regex in recipe.get('exclude', [])]
+            seen = set()
             for regex in recipe['regex_combination']:
-                regex_str = f"{recipe['arch']}-{regex}"
-                combinations.extend(self.generate_combinations_from_regex(regex_str))
-            port = 4000
-            for combo in combinations:
-                # each combo call config class to create config objects and put them in the configs array
-                arch, fs, interface, encryption = combo.split('-')
-                config = Config(
-                    arch = arch,
-                    filesystem = fs,
-                    interface = interface,
-                    flavor = recipe.get('flavor') or None,
-                    img_file = recipe.get('img_file') or None,
-                    img_url = recipe.get('img_url') or None,
-                    port = port,
-                    encryption = encryption,
-                    version = recipe.get('version') or '13.2',
-                    recipe = recipe
-                )
-                # increase port
-                configs.append(config)
-                port += 1
-        return configs
\ No newline at end of file
+                for combination in self.compile(f"{recipe['arch']}-{regex}", versions).expand():
+                    if combination in seen or self.is_blacklisted(combination, exclude):
+                        continue
+                    seen.add(combination)
+                    # each combo call config class to create config objects
+                    arch, fs, interface, encryption, version = combination
+                    yield Config(
+                        arch = arch,
+                        filesystem = fs,
+                        interface = interface,
+                        flavor = recipe.get('flavor') or None,
+                        img_file = recipe.get('img_file') or None,
+                        img_url = recipe.get('img_url') or None,
+                        encryption = encryption,
+                        version = version or versions[0],
+                        recipe = recipe
+                    )
@@ -0,0 +1,198 @@
+from src.core.configuration import Config
+from src.core.builder import ConfigBuilder
+from src.core.cache_manager import CacheManager
+from src.utils.tracing import tracer
+from src.utils.metrics import metrics
+from typing import Iterable
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import os
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Stage is a single unit of build work, identified by a key that encodes
+# everything its output depends on, so equal keys mean equal work
+class Stage:
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+
+    def __init__(self, key, fn, deps=()):
+        self.key = key
+        self.fn = fn
+        self.deps = list(deps)
+        self.status = self.PENDING
+        self.error = None
+        self.elapsed = 0.0
+
+    def run(self):
+        start = time.time()
+        try:
+            with tracer.span(self.key.split(":")[0], "stage", key=self.key):
+                self.fn()
+        finally:
+            self.elapsed = time.time() - start
+
+    def __str__(self):
+        return f"Stage({self.key}, {self.status}, deps={self.deps})"
+
+
+# StageGraph is a deduplicated DAG of stages, adding a key twice returns the
+# already registered stage instead of scheduling the work again
+class StageGraph:
+    # seconds between re-checks of stages held back by admit
+    POLL_INTERVAL = 0.5
+
+    def __init__(self):
+        self.stages: dict[str, Stage] = {}
+
+    def add(self, key, fn, deps=()):
+        if key in self.stages:
+            return self.stages[key]
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"Stage {key} depends on unknown stage {dep}")
+        stage = Stage(key, fn, deps)
+        self.stages[key] = stage
+        return stage
+
+    def ready(self):
+        return [stage for stage in self.stages.values()
+                if stage.status == Stage.PENDING
+                and all(self.stages[dep].status == Stage.DONE for dep in stage.deps)]
+
+    def skip_blocked(self):
+        # a stage whose dependency failed or was skipped can never run
+        changed = True
+        while changed:
+            changed = False
+            for stage in self.stages.values():
+                if stage.status != Stage.PENDING:
+                    continue
+                if any(self.stages[dep].status in (Stage.FAILED, Stage.SKIPPED) for dep in stage.deps):
+                    stage.status = Stage.SKIPPED
+                    changed = True
+
+    def run(self, max_workers=None, on_stage_done=None, admit=None):
+        # admit(stage) -> False holds a ready stage back until a later check
+        max_workers = max_workers or os.cpu_count() or 1
+        running = {}
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stage") as executor:
+            while True:
+                held = False
+                for stage in self.ready():
+                    if admit and not admit(stage):
+                        held = True
+                        continue
+                    stage.status = Stage.RUNNING
+                    logger.debug(f"Starting stage {stage.key}")
+                    running[executor.submit(stage.run)] = stage
+                if not running:
+                    if not held:
+                        break
+                    time.sleep(self.POLL_INTERVAL)
+                    continue
+
+                done, _ = wait(running, timeout=self.POLL_INTERVAL if held else None, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    try:
+                        future.result()
+                        stage.status = Stage.DONE
+                        logger.debug(f"Stage {stage.key} done in {stage.elapsed:.2f}s")
+                    except Exception as e:
+                        stage.status = Stage.FAILED
+                        stage.error = e
+                        logger.error(f"Stage {stage.key} failed: {e}")
+                    kind = stage.key.split(":")[0]
+                    metrics.inc("bootbaker_stages_total", stage=kind, status=stage.status)
+                    metrics.observe("bootbaker_stage_seconds", stage.elapsed, stage=kind)
+                    if on_stage_done:
+                        on_stage_done(stage)
+                self.skip_blocked()
+        return self.stages
+
+
+# BuildPipeline turns a config matrix into a StageGraph, shared stages only
+# depend on the image/machine_combo/filesystem and are run once, per
+# identifier mkimg stages run in parallel in their own workspace
+class BuildPipeline:
+
+    def __init__(self, configs: Iterable[Config], max_workers=None):
+        # configs may be a generator, it is consumed while planning
+        self.configs = configs
+        self.max_workers = max_workers
+        self.builders: list[ConfigBuilder] = []
+        self.graph = StageGraph()
+        # identifier -> key of the last stage of that config
+        self.final_stages = {}
+
+    def plan(self):
+        for config in self.configs:
+            builder = ConfigBuilder(config)
+            self.builders.append(builder)
+            mc = builder.machine_combo
+
+            fetch = self.graph.add(f"fetch:{builder.img_file}",
+                                   self._chain(builder.setup_dirs, builder.update_freebsd_img_cache))
+            tree = self.graph.add(f"tree:{mc}:{config.version}",
+                                  builder.build_freebsd_minimal_trees, [fetch.key])
+            stand = self.graph.add(f"stand:{mc}",
+                                   self._chain(builder.setup_dirs, builder.build_freebsd_test_trees))
+            esp = self.graph.add(f"esp-tree:{mc}", builder.build_freebsd_esps, [stand.key])
+            firmware = self.graph.add(f"firmware:{mc}",
+                                      self._chain(builder.setup_dirs, builder.build_freebsd_firmware))
+
+            # partitions are shared by every interface/encryption variant,
+            # only mkimg runs per identifier
+            esp_part = self.graph.add(f"esp:{mc}", builder.build_freebsd_esp_partition, [esp.key])
+            fs_part = self.graph.add(f"fs:{mc}:{config.version}:{config.filesystem}",
+                                     builder.build_freebsd_fs_partition, [tree.key, stand.key])
+            image = self.graph.add(f"image:{config.identifier}", builder.build_freebsd_images,
+                                   [esp_part.key, fs_part.key])
+            snapshot = self.graph.add(f"snapshot:{mc}:{config.warm_start}", builder.build_freebsd_snapshot,
+                                      [firmware.key])
+            script = self.graph.add(f"script:{config.identifier}", builder.build_freebsd_scripts,
+                                    [image.key, snapshot.key])
+            self.final_stages[config.identifier] = script.key
+        return self.graph
+
+    def images_started(self):
+        # configs whose image is being or was built and whose build has not
+        # failed since, i.e. the ones that are or will be handed to tests
+        count = 0
+        for identifier, key in self.final_stages.items():
+            image = self.graph.stages[f"image:{identifier}"]
+            if image.status in (Stage.RUNNING, Stage.DONE) and \
+                    self.graph.stages[key].status not in (Stage.FAILED, Stage.SKIPPED):
+                count += 1
+        return count
+
+    def _chain(self, *fns):
+        def run():
+            for fn in fns:
+                fn()
+        return run
+
+    def run(self, on_stage_done=None, admit=None):
+        if not self.final_stages:
+            self.plan()
+        logger.info(f"Running {len(self.graph.stages)} build stages for {len(self.builders)} configs")
+        try:
+            self.graph.run(self.max_workers, on_stage_done, admit)
+        finally:
+            # the artifacts' accesses go to the cache index in one write
+            CacheManager().flush()
+
+        successful_builds = []
+        for builder in self.builders:
+            stage = self.graph.stages[self.final_stages[builder.identifier]]
+            if stage.status == Stage.DONE:
+                successful_builds.append(builder.config)
+            else:
+                logger.error(f"Build of {builder.identifier} {stage.status}")
+        return successful_builds
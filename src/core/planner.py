@@ -0,0 +1,213 @@
+from src.core.configuration import Config
+from src.core.pipeline import BuildPipeline
+from src.core.builder import ConfigBuilder
+from src.core.scheduler import AdmissionScheduler
+from src.core.stand_cache import StandBuildCache
+from src.core.snapshot import FirmwareSnapshot
+from src.core.history import RunHistory
+from src.utils.download import StreamingDownloader
+from src.utils.freebsd_utils import FreeBSDUtils
+from typing import Iterable
+import psutil
+import os
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# RunPlanner answers what a run would do without doing any of it. The
+# matrix is planned into the same stage graph a run builds, every stage is
+# looked up in the caches it would hit (hit), found missing (miss), always
+# run (run) or depends on inputs that do not exist yet (unknown), and the
+# build, test and peak memory cost is estimated from that. Nothing is
+# written: trees are only hashed when left by an earlier run and run
+# history is only read when it exists.
+class RunPlanner:
+    HIT = "hit"
+    MISS = "miss"
+    RUN = "run"
+    UNKNOWN = "unknown"
+    OFF = "off"
+    # seconds a stage takes when it has to do its work
+    STAGE_ESTIMATES = {"fetch": 180, "tree": 5, "stand": 240, "esp-tree": 1, "firmware": 1,
+                       "esp": 2, "fs": 15, "image": 3, "snapshot": 40, "script": 0.1}
+    # seconds a cache hit takes
+    HIT_ESTIMATE = 0.1
+
+    def __init__(self, configs: Iterable[Config], max_workers=None):
+        self.pipeline = BuildPipeline(configs, max_workers)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.history = RunHistory() if os.path.exists(RunHistory.HISTORY_FILE) else None
+        self.scheduler = AdmissionScheduler(estimator=self.history.estimate if self.history else None)
+        # stage key -> (status, detail)
+        self.stages = {}
+        # identifier -> cached-pass or boot
+        self.tests = {}
+        # machine_combo -> stand cache directory, keying stand runs git
+        self.stand_dirs = {}
+        self.downloads = []
+
+    def plan(self):
+        self.pipeline.plan()
+        for builder in self.pipeline.builders:
+            self.plan_builder(builder)
+        return self
+
+    def mark(self, key, status, detail=None):
+        self.stages.setdefault(key, (status, detail))
+        return self.stages[key][0]
+
+    def plan_builder(self, builder: ConfigBuilder):
+        config = builder.config
+        mc = builder.machine_combo
+        fetch = self.mark(f"fetch:{builder.img_file}", *self.plan_fetch(builder))
+        self.mark(f"tree:{mc}:{config.version}", self.RUN)
+        stand = self.mark(f"stand:{mc}", *self.plan_stand(builder))
+        self.mark(f"esp-tree:{mc}", self.RUN)
+        self.mark(f"firmware:{mc}", self.RUN)
+
+        # partition keys hash the trees, which only exist as left by an
+        # earlier run, and are only current when the stand and image are
+        current = stand == self.HIT and fetch == self.HIT and self.stand_installed(builder)
+        esp_key = fs_key = image_key = None
+        if current and os.path.isdir(builder.esp_dir):
+            esp_key = builder.get_esp_key(builder.esp_dir)
+        if current and self.fs_dirs_current(builder):
+            fs_key = builder.get_fs_key(*builder.get_fs_dirs())
+        esp = self.mark(f"esp:{mc}", *self.plan_artifact(builder, esp_key, "esp", stand))
+        fs = self.mark(f"fs:{mc}:{config.version}:{config.filesystem}",
+                       *self.plan_artifact(builder, fs_key, config.filesystem, stand))
+        if esp_key and fs_key:
+            image_key = builder.get_image_key(esp_key, fs_key)
+        image = self.mark(f"image:{config.identifier}",
+                          *self.plan_artifact(builder, image_key, "img", self.MISS if self.MISS in (esp, fs) else None))
+
+        warm = FirmwareSnapshot.enabled(config)
+        self.mark(f"snapshot:{mc}:{config.warm_start}", *(self.plan_snapshot(builder) if warm else (self.OFF,)))
+        self.mark(f"script:{config.identifier}", self.RUN)
+        self.tests[config.identifier] = self.plan_test(builder, image_key, image, warm)
+
+    def plan_fetch(self, builder: ConfigBuilder):
+        xz_file = os.path.join(builder.CACHE_DIR, f"{builder.img_file}.xz")
+        img_file = os.path.join(builder.CACHE_DIR, builder.img_file)
+        if StreamingDownloader(builder.CACHE_DIR).is_verified(xz_file) and \
+                (builder.config.flavor == "bootonly.iso" or os.path.exists(img_file)):
+            return self.HIT, xz_file
+        if builder.img_url not in self.downloads:
+            self.downloads.append(builder.img_url)
+        return self.MISS, builder.img_url
+
+    def plan_stand(self, builder: ConfigBuilder):
+        if builder.machine_combo not in self.stand_dirs:
+            stand = StandBuildCache(builder.config.machine, builder.config.machine_arch)
+            self.stand_dirs[builder.machine_combo] = os.path.join(stand.STAND_CACHE_DIR, stand.key())
+        cached = self.stand_dirs[builder.machine_combo]
+        return (self.HIT if os.path.isdir(cached) else self.MISS), cached
+
+    def stand_installed(self, builder: ConfigBuilder):
+        # the test-stand tree left behind is the one the cache would install
+        installed = os.path.join(builder.test_dir, "boot", "loader.efi")
+        cached = os.path.join(self.stand_dirs[builder.machine_combo], "boot", "loader.efi")
+        return os.path.exists(installed) and os.path.exists(cached) and \
+            builder.artifacts.hash_file(installed) == builder.artifacts.hash_file(cached)
+
+    def fs_dirs_current(self, builder: ConfigBuilder):
+        try:
+            with open(os.path.join(builder.fstab_dir, "etc/fstab"), 'r') as f:
+                fstab = f.read()
+            with open(os.path.join(builder.tree, "etc/rc"), 'r') as f:
+                rc = f.read()
+        except OSError:
+            return False
+        return fstab == builder.config.fstab_conf and rc == builder.rc_conf
+
+    def plan_artifact(self, builder: ConfigBuilder, key, name, upstream):
+        # without a key the artifact is a miss if what it is built from is
+        # rebuilt anyway, otherwise there is no telling
+        if key is None:
+            return (self.MISS if upstream == self.MISS else self.UNKNOWN), None
+        return (self.HIT if builder.artifacts.contains(key, name) else self.MISS), key
+
+    def plan_snapshot(self, builder: ConfigBuilder):
+        snapshot = builder.get_snapshot()
+        try:
+            _, state, _ = snapshot.paths(snapshot.key())
+        except (OSError, TypeError):
+            # no qemu binary to key the snapshot on
+            return self.UNKNOWN, None
+        return (self.HIT if os.path.exists(state) else self.MISS), state
+
+    def plan_test(self, builder: ConfigBuilder, image_key, image, warm):
+        # a boot is skipped when the fingerprint it would get last passed
+        if not self.history or image_key is None or image != self.HIT or warm:
+            return "boot"
+        config = builder.config
+        builder.image_key = image_key
+        bios_code, bios_var = builder.get_bios_files()
+        img_file = os.path.join(builder.IMAGE_DIR, builder.machine_combo, f"freebsd-{builder.identifier}.img")
+        recipe = FreeBSDUtils.get_qemu_recipe(config.machine, config.machine_arch, config.filesystem, img_file,
+                                              bios_code, bios_var, "{monitor}", config.disk_mode)
+        config.fingerprint = builder.get_test_fingerprint(recipe, bios_code, bios_var)
+        return "cached-pass" if self.history.cached_pass(config) else "boot"
+
+    def stage_seconds(self, key):
+        status = self.stages[key][0]
+        if status in (self.HIT, self.OFF):
+            return self.HIT_ESTIMATE
+        return self.STAGE_ESTIMATES.get(key.split(":")[0], 1)
+
+    def build_seconds(self):
+        # the critical path, or all the work spread over the workers
+        finish = {}
+        total = 0.0
+        for key, stage in self.pipeline.graph.stages.items():
+            seconds = self.stage_seconds(key)
+            total += seconds
+            finish[key] = seconds + max((finish[dep] for dep in stage.deps), default=0.0)
+        return max(max(finish.values(), default=0.0), total / self.max_workers)
+
+    def booted(self):
+        return [builder.config for builder in self.pipeline.builders
+                if self.tests[builder.identifier] == "boot"]
+
+    def test_seconds(self):
+        costs = [self.scheduler.cost(config) for config in self.booted()]
+        if not costs:
+            return 0.0
+        work = sum(cpus * duration for cpus, _, duration in costs)
+        return max(max(duration for _, _, duration in costs), work / self.scheduler.cpu_cores)
+
+    def peak_guests(self):
+        # (guests, bytes) admitted at once on an otherwise idle host
+        memory = psutil.virtual_memory().total * (1 - AdmissionScheduler.MEMORY_HEADROOM)
+        cpus = used = guests = 0
+        for cost in sorted(self.scheduler.cost(config) for config in self.booted()):
+            if guests and (cpus + cost[0] > self.scheduler.cpu_cores or used + cost[1] > memory):
+                break
+            cpus += cost[0]
+            used += cost[1]
+            guests += 1
+        return guests, used
+
+    def summary(self):
+        kinds = {}
+        for key, (status, _) in self.stages.items():
+            counts = kinds.setdefault(key.split(":")[0], {})
+            counts[status] = counts.get(status, 0) + 1
+        tests = {}
+        for outcome in self.tests.values():
+            tests[outcome] = tests.get(outcome, 0) + 1
+        build, test = self.build_seconds(), self.test_seconds()
+        guests, memory = self.peak_guests()
+        return {
+            "configs": len(self.pipeline.builders),
+            "stages": kinds,
+            "downloads": self.downloads,
+            "tests": tests,
+            "build_seconds": build,
+            "test_seconds": test,
+            "total_seconds": build + test,
+            "stream_seconds": max(build, test),
+            "peak_guests": guests,
+            "peak_memory": memory,
+        }
@@ -1,121 +1,152 @@
 import sys
-import queue
-import subprocess
-import threading
+import asyncio
 import time
 import psutil
 import logging
-import os
 from src.core.configuration import Config
+from src.core.engine import TestEngine, TestResult
+from src.core.scheduler import AdmissionScheduler
+from src.core.history import RunHistory
+from src.core.pipeline import BuildPipeline, Stage
+from src.utils.metrics import metrics
 
-logger = logging.basicConfig()
+logger = logging.getLogger(__name__)
 
 
 class ResourceManager():
 
-    def __init__(self, configs: list[Config]) -> None:
+    def __init__(self, configs: list[Config], reverify=False, max_jobs=None) -> None:
         self.cpu_cores = psutil.cpu_count(logical=True)     # Physical CPU
-        self.available_memory = psutil.virtual_memory().available     # available memory in bytes
-        # logger.info(f"Cores: {self.cpu_cores}\nMemory: {self.available_memory}")
-        self.memory = 0.75 * self.available_memory
-        self.max_workers = min(self.cpu_cores, int(self.memory / (512 * 1024 * 1024))) # Convert bytes to MB
+        # default timeout, replaced per config once there is run history
         self.timeout = 90
-        self.task_queue: queue.Queue[Config] = queue.Queue()
-        self.worker_threads = []
-        self.counters = {
-            'passed':0,
-            'failed':0,
-            'timeout':0
-        }
+        self.history = RunHistory()
+        # guests are admitted by their per arch cost and live host load
+        # max_jobs caps the guests running at once on top of that
+        self.scheduler = AdmissionScheduler(cpu_cores=self.cpu_cores, estimator=self.history.estimate, max_jobs=max_jobs)
+        self.results: list[TestResult] = []
         self.configs = configs
+        # reverify boots configs even when identical inputs passed before
+        self.verdicts = None if reverify else self.history
+        # configs built and waiting for a test, when streaming
+        self.queue = None
+        metrics.register("resources", self.collect)
+
+    @property
+    def counters(self):
+        counters = {'passed': 0, 'cached-pass': 0, 'failed': 0, 'timeout': 0}
+        for result in self.results:
+            status = result.status if result.status in counters else 'failed'
+            counters[status] += 1
+        return counters
+
+    # called on the event loop as each test finishes, no locking needed,
+    # the engine has already recorded the result in the history
+    def report(self, result: TestResult):
+        self.results.append(result)
+        metrics.inc("bootbaker_tests_total", arch=result.config.machine_arch, status=result.status)
+        if not result.cached:
+            metrics.observe("bootbaker_test_seconds", result.elapsed, arch=result.config.machine_arch)
+        sys.stdout.write("\r" + " " * 60 + "\r")  # Clear the line
+        script = result.config.script_file
+        if result.status == TestResult.PASSED:
+            print(f"{script} success in {result.elapsed:.2f}s")
+        elif result.status == TestResult.CACHED:
+            print(f"{script} cached pass, inputs unchanged")
+        elif result.status == TestResult.TIMEOUT:
+            print(f"{script} timed out in {result.elapsed:.2f}s")
+        else:
+            if result.detail:
+                print(f"{result.detail}: {result.matched}" if result.matched else result.detail)
+            print(f"{script} failed in {result.elapsed:.2f}s")
+        if result.tail:
+            print("\n".join(f"    {line}" for line in result.tail))
+
+    def collect(self):
+        # gauges for the metrics endpoint, read from the scrape thread
+        scheduler = self.scheduler
+        yield "bootbaker_configs", {}, len(self.configs)
+        yield "bootbaker_queue_depth", {"queue": "admission"}, len(scheduler.waiting)
+        if self.queue is not None:
+            yield "bootbaker_queue_depth", {"queue": "built"}, self.queue.qsize()
+        running = list(scheduler.running)
+        for arch in sorted({config.machine_arch for config in self.configs}):
+            yield "bootbaker_active_guests", {"arch": arch}, sum(job.config.machine_arch == arch for job in running)
+        capacity = scheduler.cpu_cores - min(scheduler.external_load(), scheduler.cpu_cores - 1)
+        yield "bootbaker_host_cpu_headroom", {}, capacity - sum(job.cpus for job in running)
+        yield "bootbaker_host_memory_headroom_bytes", {}, scheduler.memory_available()
+
+    async def progress(self):
+        # Interactive Wait :)
+        symbols = [".  ", ".. ", "...", " ..", "  ."]  # Rotating dot symbols
+        current_symbol = 0
+        while True:
+            fill = len(self.results)
+            print(f" [{'='*fill*2}>{' '*(20-fill)}]({fill} / {len(self.configs)}) Tasks Completed {symbols[current_symbol % len(symbols)]}", end='\r', flush=True)
+            current_symbol = (current_symbol + 1) % len(symbols)
+            await asyncio.sleep(0.5)
 
-    # recusive kill
-    def recursive_kill(self,process):
-        parent = psutil.Process(process.pid)
-        for child in parent.children(recursive=True):
-            child.kill()
-        parent.kill()
-
-    # producer
-    def produce_tasks(self):
-        for config in self.configs:
-            self.task_queue.put(config)
+    def engine(self):
+        return TestEngine(timeout=self.timeout, scheduler=self.scheduler,
+                          timeout_for=lambda config: self.history.timeout_for(config, self.timeout),
+                          verdicts=self.verdicts, record=self.history.record)
 
-    # consumer
-    def consume_tasks(self):
-        while True:
-            process = None
-            try:
-                config = self.task_queue.get(timeout=2)
-                script = os.path.join(config.script_dir, config.script_file)
-                log_file = config.log_file
-                start = time.time()
-                process = subprocess.Popen(['/bin/sh', script], stdout=open(log_file, "w"), stderr=subprocess.STDOUT, shell=False)
-                process.communicate(timeout=self.timeout)  # Execute the task
-                sys.stdout.write("\r" + " " * 60 + "\r")  # Clear the line
-                els_time = time.time() - start
-                # check if process was success or not
-                if process.returncode == 0:
-                    with open(log_file, 'r', errors='replace') as f:
-                        contents = f.read()
-                        if config.target_string in contents:
-                            print(f"{script.split('/')[-1]} success in {els_time:.2f}s")
-                            # add more checks like whether file even has the required text :)
-                            self.counters['passed'] += 1
-                        else:
-                            print("RC COMMAND String not found!")
-                            print(f"{script.split('/')[-1]} failed in {els_time:.2f}s")
-                            self.counters['failed'] += 1
-                            return False
-                else:
-                    print(f"{script.split('/')[-1]} failed in {els_time:.2f}s")
-                    self.counters['failed'] += 1
-                self.task_queue.task_done()  # Signaling task completion
-            except subprocess.TimeoutExpired:
-                self.recursive_kill(process)
-                els_time = time.time() - start
-                sys.stdout.write("\r" + " " * 50 + "\r")  # Clear the line
-                print(f"{script.split('/')[-1]} timed out in {els_time:.2f}s")
-                self.counters['timeout'] += 1
-                with open(log_file, 'w') as log:
-                    log.write("\n---Script execution timed out---\n")
-            except queue.Empty:
-                # print(f"Worker {threading.current_thread().name} has no task to execute")
-                break  # No tasks left, exit loop        
+    async def work_async(self):
+        spinner = asyncio.create_task(self.progress())
+        try:
+            return await self.engine().run_all(self.configs, on_result=self.report)
+        finally:
+            spinner.cancel()
 
     def work(self):
-        # producer keeps putting tasks in the queue
-        self.producer_thread = threading.Thread(target=self.produce_tasks, args=())
-        self.producer_thread.start()
-
         start_time = time.time()
-        # list of worker threads
-        for i in range(self.max_workers):
-            worker = threading.Thread(target=self.consume_tasks, args=(), name=f"Worker-{i+1}")
-            worker.start()
-            self.worker_threads.append(worker)
-
-        # wait for producer to finish processing jobs
-        self.producer_thread.join()
-
-        # Interactive Wait :)
-        symbols = [".  ", ".. ", "...", " ..", "  ."]  # Rotating dot symbols
-        current_symbol = 0
-        while any(worker.is_alive() for worker in self.worker_threads):
-            # print(f" [{sum(worker.is_alive() for worker in worker_threads)} / {len(worker_threads)}] Workers Active | [{sum(c for c in counters.values())} / {len(scripts)}] Tasks Completed {symbols[current_symbol % len(symbols)]}", end='\r', flush=True) 
-            fill = sum(c for c in self.counters.values())
-            # percent = int(fill/(len(script_dir)*10))
-            print(f" [{'='*fill*2}>{' '*(20-fill)}]({fill} / {len(self.configs)}) Tasks Completed {symbols[current_symbol % len(symbols)]}", end='\r', flush=True) 
-            current_symbol = (current_symbol + 1) % len(symbols)
-            time.sleep(0.5)
+        asyncio.run(self.work_async())
+        self.summarize(time.time() - start_time)
+        return self.results
+
+    async def stream_async(self, pipeline: BuildPipeline, max_backlog):
+        # tests each config as soon as its build is done instead of after
+        # the whole matrix is built, mkimg only starts while fewer than
+        # max_backlog built or building images are waiting for a test
+        loop = asyncio.get_running_loop()
+        queue = self.queue = asyncio.Queue()
+        pipeline.plan()
+        self.configs = [builder.config for builder in pipeline.builders]
+        final_stages = {pipeline.final_stages[builder.identifier]: builder.config for builder in pipeline.builders}
+
+        def on_stage_done(stage):
+            # called on a build thread, a failed build never reaches the queue
+            config = final_stages.get(stage.key)
+            if config and stage.status == Stage.DONE:
+                loop.call_soon_threadsafe(queue.put_nowait, config)
+
+        def admit(stage):
+            if not stage.key.startswith("image:"):
+                return True
+            return pipeline.images_started() - len(self.results) < max_backlog
+
+        async def build():
+            try:
+                return await asyncio.to_thread(pipeline.run, on_stage_done, admit)
+            finally:
+                queue.put_nowait(None)
+
+        spinner = asyncio.create_task(self.progress())
+        try:
+            built, results = await asyncio.gather(build(), self.engine().run_stream(queue, on_result=self.report))
+        finally:
+            spinner.cancel()
+        logger.info(f"Built {len(built)} / {len(self.configs)} configs")
+        return results
+
+    def stream(self, pipeline: BuildPipeline, max_backlog=None):
+        start_time = time.time()
+        asyncio.run(self.stream_async(pipeline, max_backlog or 2 * self.cpu_cores))
+        self.summarize(time.time() - start_time)
+        return self.results
 
-        elapsed_time = time.time() - start_time
+    def summarize(self, elapsed_time):
         sys.stdout.write("\r" + " " * 60 + "\r")  # Clear the line
         print(f"Total Time Elapsed: {elapsed_time:.2f}s")
         # print summary
-        print(f"\nSummary : \n{self.counters['passed']} Passed\n{self.counters['failed']} Failed\n{self.counters['timeout']} Timed-out")
-
-
-
-
-
+        counters = self.counters
+        print(f"\nSummary : \n{counters['passed']} Passed\n{counters['cached-pass']} Cached-pass\n{counters['failed']} Failed\n{counters['timeout']} Timed-out")
@@ -0,0 +1,152 @@
+from src.core.configuration import Config
+import contextlib
+import asyncio
+import bisect
+import itertools
+import time
+import os
+import psutil
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Job:
+
+    def __init__(self, config: Config, cpus, memory, duration, seq):
+        self.config = config
+        self.cpus = cpus
+        self.memory = memory
+        self.duration = duration
+        self.seq = seq
+        self.admitted = asyncio.Event()
+        self.admitted_at = None
+
+    def priority(self):
+        # longest expected job first, file order among equals
+        return (-self.duration, self.seq)
+
+    def __lt__(self, other):
+        return self.priority() < other.priority()
+
+
+# AdmissionScheduler admits guests based on what they cost the host instead
+# of a fixed pool size. Every arch has a cpu/memory/duration cost model,
+# jobs are admitted longest-expected-first so slow emulated arches do not
+# become the tail of the run, and live memory and load are re-checked while
+# jobs are waiting.
+class AdmissionScheduler:
+    MB = 1024 * 1024
+    # cpus: host threads the guest keeps busy (TCG runs one per vcpu)
+    # memory: guest RAM plus qemu overhead, duration: expected seconds
+    COST_MODELS = {
+        "amd64":     {"cpus": 1, "memory": 640 * MB, "duration": 20},
+        "i386":      {"cpus": 1, "memory": 640 * MB, "duration": 20},
+        "aarch64":   {"cpus": 1, "memory": 640 * MB, "duration": 45},
+        "armv7":     {"cpus": 2, "memory": 640 * MB, "duration": 90},
+        "riscv64":   {"cpus": 2, "memory": 640 * MB, "duration": 120},
+        "powerpc64": {"cpus": 2, "memory": 640 * MB, "duration": 60},
+    }
+    DEFAULT_COST = {"cpus": 1, "memory": 640 * MB, "duration": 60}
+    # memory kept free for the host
+    MEMORY_HEADROOM = 0.25
+    # seconds before an admitted guest is assumed to show up in available memory
+    WARMUP = 10
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, cpu_cores=None, estimator=None, max_jobs=None):
+        self.cpu_cores = cpu_cores or psutil.cpu_count(logical=True) or 1
+        # estimator(config) -> expected seconds or None, e.g. from run history
+        self.estimator = estimator
+        # identifier -> estimator result, history is queried once per config
+        self.estimates = {}
+        self.max_jobs = max_jobs
+        self.waiting: list[Job] = []
+        self.running: list[Job] = []
+        self.seq = itertools.count()
+        self.monitor = None
+
+    def estimate(self, config: Config):
+        if config.identifier not in self.estimates:
+            self.estimates[config.identifier] = self.estimator(config) if self.estimator else None
+        return self.estimates[config.identifier]
+
+    def cost(self, config: Config):
+        model = self.COST_MODELS.get(config.machine_arch, self.DEFAULT_COST)
+        return model["cpus"], model["memory"], self.estimate(config) or model["duration"]
+
+    def order(self, configs: list[Config]):
+        return sorted(configs, key=lambda config: -self.cost(config)[2])
+
+    def reserved_cpus(self):
+        return sum(job.cpus for job in self.running)
+
+    def external_load(self):
+        # load not caused by our own guests
+        try:
+            return max(0.0, os.getloadavg()[0] - self.reserved_cpus())
+        except (AttributeError, OSError):
+            return 0.0
+
+    def memory_available(self):
+        # recently admitted guests have not faulted in their memory yet
+        now = time.time()
+        unrealized = sum(job.memory for job in self.running if now - job.admitted_at < self.WARMUP)
+        mem = psutil.virtual_memory()
+        return mem.available - self.MEMORY_HEADROOM * mem.total - unrealized
+
+    def fits(self, job: Job):
+        if not self.running:
+            # never stall, a single job always runs even if it is too large
+            return True
+        if self.max_jobs and len(self.running) >= self.max_jobs:
+            return False
+        cpu_capacity = self.cpu_cores - min(self.external_load(), self.cpu_cores - 1)
+        if self.reserved_cpus() + job.cpus > cpu_capacity:
+            return False
+        return job.memory <= self.memory_available()
+
+    def admit(self):
+        # admits waiting jobs strictly in priority order while they fit
+        while self.waiting and self.fits(self.waiting[0]):
+            job = self.waiting.pop(0)
+            job.admitted_at = time.time()
+            self.running.append(job)
+            job.admitted.set()
+
+    async def watch(self):
+        # host memory and load change while jobs wait, re-check periodically
+        while self.waiting:
+            await asyncio.sleep(self.POLL_INTERVAL)
+            self.admit()
+        self.monitor = None
+
+    @contextlib.asynccontextmanager
+    async def slot(self, config: Config):
+        if self.estimator and config.identifier not in self.estimates:
+            # configs not ordered up front, e.g. streamed ones, are estimated
+            # off the event loop
+            await asyncio.to_thread(self.estimate, config)
+        cpus, memory, duration = self.cost(config)
+        job = Job(config, cpus, memory, duration, next(self.seq))
+        bisect.insort(self.waiting, job)
+        self.admit()
+        if self.waiting and self.monitor is None:
+            self.monitor = asyncio.create_task(self.watch())
+        try:
+            await job.admitted.wait()
+        except asyncio.CancelledError:
+            if job in self.waiting:
+                self.waiting.remove(job)
+            else:
+                self.release(job)
+            raise
+        try:
+            yield job
+        finally:
+            self.release(job)
+
+    def release(self, job: Job):
+        if job in self.running:
+            self.running.remove(job)
+        self.admit()
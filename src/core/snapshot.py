@@ -0,0 +1,199 @@
+from src.config import STAND_TEST_ROOT
+from src.core.configuration import Config
+from src.core.artifact_cache import ArtifactCache
+from src.core.console import ConsoleMatcher
+from src.core.monitor import MonitorAllocator, monitors
+from src.utils.freebsd_utils import FreeBSDUtils
+from src.utils.tracing import tracer
+import subprocess
+import tempfile
+import asyncio
+import selectors
+import shutil
+import signal
+import time
+import os
+import re
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# FirmwareSnapshot lets tests skip EDK2's initialization. A template guest
+# with a blank disk is booted once per machine_combo and firmware until the
+# firmware gives up and starts the UEFI shell, its state is then migrated to
+# a file through the monitor. Tests start qemu with -incoming from that file
+# and their own disk, and once the monitor reports the guest running the
+# shell is told to rescan the disks and start the loader from the ESP.
+class FirmwareSnapshot:
+    SNAPSHOT_DIR = f"{STAND_TEST_ROOT}/snapshots"
+    # arches booting EDK2 from pflash, the others start u-boot/opensbi
+    SUPPORTED_ARCHES = ["amd64", "aarch64"]
+    # the fixed point the template is saved at
+    READY_PATTERN = re.compile(r"Shell> ")
+    # the template's disk, blank so the firmware finds nothing to boot
+    BLANK_DISK_SIZE = 64 * 1024 * 1024
+    TEMPLATE_TIMEOUT = 300
+    MIGRATE_TIMEOUT = 60
+    POLL_INTERVAL = 0.2
+    # typed into the restored shell, reconnect picks up the test's disk
+    RESUME_COMMANDS = ["reconnect -r", "map -r", "fs0:\\efi\\boot\\{boot_efi}"]
+    # the restored shell prints its prompt, so it is no failure any more,
+    # a missing loader is reported by the shell instead
+    SHELL_PATTERNS = [r"Shell> ", r"UEFI Interactive Shell"]
+    RESUME_FAILURE = r"is not recognized as an internal or external command"
+
+    def __init__(self, machine, machine_arch, bios_code, bios_vars):
+        self.machine = machine
+        self.machine_arch = machine_arch
+        self.bios_code = bios_code
+        self.bios_vars = bios_vars
+        self.machine_combo = f"{machine}-{machine_arch}" if machine != machine_arch else machine_arch
+
+    @classmethod
+    def enabled(cls, config: Config):
+        return bool(config.warm_start) and config.machine_arch in cls.SUPPORTED_ARCHES
+
+    def key(self):
+        # the state only loads into the same qemu with the same firmware and
+        # device layout, a recipe change or a qemu upgrade means a new template
+        qemu_bin = FreeBSDUtils.get_qemu_bin(self.machine_arch)
+        st = os.stat(qemu_bin)
+        files = [path for path in [self.bios_code, self.bios_vars] if os.path.exists(path)]
+        return ArtifactCache.hash_inputs(
+            kind="snapshot",
+            recipe=FreeBSDUtils.get_qemu_recipe(self.machine, self.machine_arch, "ufs", "{disk}",
+                                                self.bios_code, "{vars}", "{monitor}", "direct"),
+            qemu=f"{qemu_bin} {st.st_size} {st.st_mtime_ns}",
+            firmware=[ArtifactCache.hash_file(path) for path in files])
+
+    def paths(self, key):
+        snapshot_dir = os.path.join(self.SNAPSHOT_DIR, key)
+        return snapshot_dir, os.path.join(snapshot_dir, "state"), os.path.join(snapshot_dir, "vars.fd")
+
+    def ensure(self):
+        # returns (state file, vars file), taking the template snapshot when
+        # there is none for this qemu and firmware yet
+        snapshot_dir, state, vars_file = self.paths(self.key())
+        if os.path.exists(state):
+            print(f"firmware snapshot for {self.machine_combo} reused")
+            return state, vars_file
+
+        print(f"Taking firmware snapshot for {self.machine_combo} ...")
+        os.makedirs(self.SNAPSHOT_DIR, exist_ok=True)
+        staging = tempfile.mkdtemp(prefix=f"{os.path.basename(snapshot_dir)}.", suffix=".tmp", dir=self.SNAPSHOT_DIR)
+        try:
+            with tracer.span("snapshot", machine_combo=self.machine_combo):
+                self.take(staging)
+            try:
+                os.rename(staging, snapshot_dir)
+            except OSError:
+                # another run took the same snapshot first
+                shutil.rmtree(staging, ignore_errors=True)
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        return state, vars_file
+
+    def take(self, staging):
+        disk = os.path.join(staging, "blank.img")
+        with open(disk, 'wb') as f:
+            f.truncate(self.BLANK_DISK_SIZE)
+        vars_file = os.path.join(staging, "vars.fd")
+        if os.path.exists(self.bios_vars):
+            shutil.copy(self.bios_vars, vars_file)
+        spec = monitors.allocate()
+        MonitorAllocator.prepare(spec)
+        recipe = FreeBSDUtils.get_qemu_recipe(self.machine, self.machine_arch, "ufs", disk,
+                                              self.bios_code, vars_file, spec, "direct")
+        process = subprocess.Popen(["/bin/sh", "-c", recipe], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   stdin=subprocess.DEVNULL, start_new_session=True,
+                                   env={**os.environ, "BOOTBAKER_MONITOR": spec})
+        try:
+            self.wait_ready(process)
+            with MonitorAllocator.connect(spec, timeout=self.MIGRATE_TIMEOUT) as monitor:
+                self.monitor(monitor, "stop")
+                self.monitor(monitor, f'migrate "exec:cat > {os.path.join(staging, "state")}"')
+                deadline = time.time() + self.MIGRATE_TIMEOUT
+                while "completed" not in (status := self.monitor(monitor, "info migrate")):
+                    if "failed" in status or time.time() > deadline:
+                        raise Exception(f"Could not save firmware snapshot for {self.machine_combo}: {status.strip()}")
+                    time.sleep(self.POLL_INTERVAL)
+                self.monitor(monitor, "quit", reply=False)
+        finally:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            process.wait()
+            monitors.release(spec)
+        os.remove(disk)
+
+    def wait_ready(self, process):
+        # reads the console until the firmware has reached the shell
+        deadline = time.time() + self.TEMPLATE_TIMEOUT
+        output = ""
+        with selectors.DefaultSelector() as selector:
+            selector.register(process.stdout, selectors.EVENT_READ)
+            while not self.READY_PATTERN.search(output):
+                remaining = deadline - time.time()
+                if remaining <= 0 or not selector.select(remaining):
+                    raise Exception(f"Firmware for {self.machine_combo} did not reach the shell")
+                chunk = os.read(process.stdout.fileno(), 65536)
+                if not chunk:
+                    raise Exception(f"qemu exited before the firmware for {self.machine_combo} was ready")
+                output = (output + chunk.decode(errors='replace'))[-4096:]
+
+    @staticmethod
+    def monitor(sock, command, reply=True):
+        # runs a human monitor command, returns its output up to the prompt
+        sock.sendall(f"{command}\n".encode())
+        if not reply:
+            return ""
+        output = b""
+        while not output.rstrip().endswith(b"(qemu)") or command.encode() not in output:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            output += chunk
+        return output.decode(errors='ignore')
+
+    @classmethod
+    def failure_patterns(cls, config: Config):
+        if config.failure_patterns is not None:
+            return config.failure_patterns
+        return [p for p in ConsoleMatcher.FAILURE_PATTERNS if p not in cls.SHELL_PATTERNS] + [cls.RESUME_FAILURE]
+
+    @classmethod
+    async def resume(cls, config: Config, process):
+        # waits until the migration is loaded, then starts the loader
+        while True:
+            try:
+                reader, writer = await MonitorAllocator.open_connection(config.monitor)
+                break
+            except OSError:
+                await asyncio.sleep(cls.POLL_INTERVAL)
+        try:
+            while True:
+                writer.write(b"info status\n")
+                await writer.drain()
+                output = b""
+                while b"VM status" not in output or not output.rstrip().endswith(b"(qemu)"):
+                    chunk = await reader.read(4096)
+                    if not chunk:
+                        return
+                    output += chunk
+                if b"running" in output:
+                    break
+                await asyncio.sleep(cls.POLL_INTERVAL)
+        finally:
+            writer.close()
+
+        boot_efi = FreeBSDUtils.get_boot_ufi(config.machine_arch)
+        commands = "".join(f"{command.format(boot_efi=boot_efi)}\r" for command in cls.RESUME_COMMANDS)
+        try:
+            process.stdin.write(commands.encode())
+            await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # the guest is already gone, the engine reports why
+            pass
@@ -0,0 +1,126 @@
+from src.config import STAND_TEST_ROOT, SRCTOP, STAND_MAKE_JOBS
+from src.utils.tracing import tracer
+from src.utils.metrics import metrics
+import subprocess
+import hashlib
+import fnmatch
+import shutil
+import os
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# StandBuildCache builds and installs $SRCTOP/stand once per source state
+# and target, the installed tree is stored under a fingerprint of the stand
+# sources, TARGET/TARGET_ARCH and the make variables and reused on a hit
+class StandBuildCache:
+    STAND_CACHE_DIR = f"{STAND_TEST_ROOT}/stand-cache"
+    # source paths whose state decides whether the loader has to be rebuilt
+    SOURCE_PATHS = ["stand", "etc/mtree/BSD.root.dist"]
+    INSTALL_VARS = ["MK_MAN=no", "MK_INSTALL_AS_USER=yes", "WITHOUT_DEBUG_FILES=yes"]
+
+    def __init__(self, machine, machine_arch, srctop=None, jobs=None):
+        self.machine = machine
+        self.machine_arch = machine_arch
+        self.srctop = srctop or SRCTOP
+        self.jobs = jobs or STAND_MAKE_JOBS or os.cpu_count() or 1
+
+    def source_fingerprint(self):
+        # the git tree hash covers committed state, the diff and untracked
+        # files cover local edits, without git fall back to a stat manifest
+        h = hashlib.sha256()
+        try:
+            for path in self.SOURCE_PATHS:
+                tree = self.git("rev-parse", f"HEAD:{path}")
+                h.update(f"{path} {tree}\n".encode())
+            h.update(self.git("diff", "HEAD", "--", *self.SOURCE_PATHS, text=False))
+            untracked = self.git("ls-files", "--others", "--exclude-standard", "--", *self.SOURCE_PATHS)
+            self.update_manifest(h, untracked.splitlines())
+        except (subprocess.CalledProcessError, FileNotFoundError):
+            h = hashlib.sha256()
+            for path in self.SOURCE_PATHS:
+                full_path = os.path.join(self.srctop, path)
+                if os.path.isdir(full_path):
+                    files = [os.path.relpath(os.path.join(d, f), self.srctop)
+                             for d, _, names in os.walk(full_path) for f in names]
+                else:
+                    files = [path]
+                self.update_manifest(h, files)
+        return h.hexdigest()
+
+    def git(self, *args, text=True):
+        result = subprocess.run(["git", "-C", self.srctop, *args], capture_output=True, check=True)
+        return result.stdout.decode().strip() if text else result.stdout
+
+    def update_manifest(self, h, rel_paths):
+        for rel_path in sorted(rel_paths):
+            try:
+                st = os.stat(os.path.join(self.srctop, rel_path))
+            except FileNotFoundError:
+                continue
+            h.update(f"{rel_path} {st.st_size} {st.st_mtime_ns}\n".encode())
+
+    def key(self):
+        h = hashlib.sha256()
+        h.update(self.source_fingerprint().encode())
+        h.update(f"TARGET={self.machine} TARGET_ARCH={self.machine_arch}\n".encode())
+        h.update(" ".join(self.INSTALL_VARS).encode())
+        return h.hexdigest()
+
+    def install(self, test_dir):
+        # populates test_dir with the installed stand tree, returns True on a hit
+        key = self.key()
+        cached = os.path.join(self.STAND_CACHE_DIR, key)
+        hit = os.path.isdir(cached)
+        metrics.cache("stand", hit)
+        if hit:
+            print(f"stand for {self.machine}/{self.machine_arch} reused from cache")
+        else:
+            self.build(cached)
+
+        # the tree is only read afterwards, so hardlinks are enough
+        shutil.rmtree(test_dir, ignore_errors=True)
+        shutil.copytree(cached, test_dir, symlinks=True, copy_function=self.link_or_copy)
+        return hit
+
+    @staticmethod
+    def link_or_copy(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+    def build(self, cached):
+        staging = f"{cached}.{os.getpid()}.tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+
+        mtree_cmd = ["mtree", "-deUW", "-f", f"{self.srctop}/etc/mtree/BSD.root.dist", "-p", staging]
+        with tracer.span("mtree", machine_combo=f"{self.machine}-{self.machine_arch}"):
+            subprocess.run(mtree_cmd, check=True)
+
+        # buildenv runs $SHELL inside the cross build environment
+        make_args = ["make", "buildenv", f"TARGET={self.machine}", f"TARGET_ARCH={self.machine_arch}"]
+        install_shell = " ".join(["make", "install", f"DESTDIR='{staging}'", *self.INSTALL_VARS])
+        cwd = os.path.join(self.srctop, "stand")
+        for stage, shell in [("stand-make", f"make -j {self.jobs} all"), ("stand-install", install_shell)]:
+            logger.debug(f"Running {shell} for {self.machine}/{self.machine_arch}")
+            try:
+                with tracer.span(stage, machine_combo=f"{self.machine}-{self.machine_arch}"):
+                    subprocess.run(make_args, cwd=cwd, env={**os.environ, "SHELL": shell}, check=True)
+            except subprocess.CalledProcessError as e:
+                shutil.rmtree(staging, ignore_errors=True)
+                raise Exception(f"Could not build stand for {self.machine}/{self.machine_arch}: {shell} exited {e.returncode}")
+
+        # only /boot is needed from the installed tree
+        for name in os.listdir(staging):
+            if name == "bin" or fnmatch.fnmatch(name, "[ac-z]*"):
+                shutil.rmtree(os.path.join(staging, name), ignore_errors=True)
+
+        os.makedirs(self.STAND_CACHE_DIR, exist_ok=True)
+        try:
+            os.rename(staging, cached)
+        except OSError:
+            # another run finished the same build first
+            shutil.rmtree(staging, ignore_errors=True)
@@ -1,15 +1,16 @@
 from src.config import STAND_TEST_ROOT
 from src.core.configuration import Config
+from src.core.engine import TestEngine, TestResult
+from src.core.history import RunHistory
 import os
-import subprocess
-import time
 
 class ConfigTester:
     target_string = "RC COMMAND RUNNING -- SUCCESS!!!"
     timeout = 60
 
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, reverify=False):
         self.config = config
+        self.reverify = reverify
         self.script_file = self.config.script_file
         self.script_dir = self.config.script_dir
         self.machine_combo = config.machine_combo
@@ -18,43 +19,33 @@ class ConfigTester:
         self.setup()
 
     def setup(self):
-        # os.makedirs(self.LOG_DIR,exist_ok=True) done in configuration file
         os.makedirs(self.log_path, exist_ok=True)
     
-    def run_qemu_script(self):
-        script = os.path.join(self.script_dir, self.script_file)
-        start = time.time()
-        process = subprocess.Popen(['/bin/sh', script], stdout=open(self.log_file, "w"), stderr=subprocess.STDOUT, shell=False)
-        process.communicate(timeout=self.timeout)  # Execute the task
-        return process, time.time() - start
-
-
     def run_test(self):
-        try:
-            process, els_time = self.run_qemu_script()
-            if process.returncode == 0:
-                # validate log file contains validation string
-                with open(self.log_file, 'r', errors='replace') as f:
-                    contents = f.read()
-                    if self.target_string in contents:
-                        print(f"{self.script_file.split('/')[-1]} success in {els_time:.2f}s")
-                    else:
-                        print("RC COMMAND String not found!")
-                        return False
-            else:
-                print(f"{self.script_file.split('/')[-1]} failed in {els_time:.2f}s")
-                return False
-            # test passed
+        # sequential mode is the engine with a single worker
+        history = RunHistory()
+        engine = TestEngine(max_workers=1, timeout=history.timeout_for(self.config, self.timeout),
+                            verdicts=None if self.reverify else history)
+        result = engine.run([self.config])[0]
+        history.record(result)
+        self.result = result
+        if result.status == TestResult.PASSED:
+            print(f"{self.script_file.split('/')[-1]} success in {result.elapsed:.2f}s")
+            return True
+        if result.status == TestResult.CACHED:
+            print(f"{self.script_file.split('/')[-1]} cached pass, inputs unchanged")
             return True
-        except UnicodeDecodeError as e:
-            # this should not occur if errors='replace' selected while opening
-            print(f"Error decoding file: {e}")
-        except FileNotFoundError:
-            print(f"Error: Log file '{self.log_file}' not found.")
-            return False
-        except Exception as e:
-            print(f"Error: {e}")
-            return False
+        if result.status == TestResult.TIMEOUT:
+            print(f"{self.script_file.split('/')[-1]} timed out in {result.elapsed:.2f}s")
+        elif result.status == TestResult.ERROR:
+            print(f"Error: {result.detail}")
+        else:
+            if result.detail:
+                print(f"{result.detail}: {result.matched}" if result.matched else result.detail)
+            print(f"{self.script_file.split('/')[-1]} failed in {result.elapsed:.2f}s")
+        if result.tail:
+            print("\n".join(f"    {line}" for line in result.tail))
+        return False
 
     def __str__(self):
         return f"Config({', '.join(f'{attr}={value}' for attr, value in vars(self).items())})"
\ No newline at end of file
@@ -0,0 +1,269 @@
+from src.utils.tracing import tracer
+import urllib.request
+import urllib.error
+import threading
+import hashlib
+import lzma
+import json
+import os
+import re
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+# StreamingDownloader fetches a release .xz once, hashing and decompressing
+# it while the bytes arrive. Partial downloads are resumed with an HTTP
+# Range request and nothing is renamed into place before it is verified.
+class StreamingDownloader:
+    CHUNK_SIZE = 1024 * 1024
+    VERIFY_INDEX = ".verified.json"
+    CHECKSUM_PATTERN = re.compile(r'^SHA512 \((?P<name>[^)]+)\) = (?P<digest>[0-9a-fA-F]{128})$')
+
+    # guards the verify index, fetches for different images run in parallel
+    _index_lock = threading.Lock()
+
+    def __init__(self, cache_dir, timeout=60):
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.index_file = os.path.join(cache_dir, self.VERIFY_INDEX)
+
+    def fetch_checksums(self, checksum_url):
+        # parses a release CHECKSUM.SHA512 file into {file name: digest}
+        checksums = {}
+        try:
+            with urllib.request.urlopen(checksum_url, timeout=self.timeout) as response:
+                for line in response.read().decode(errors='replace').splitlines():
+                    match = self.CHECKSUM_PATTERN.match(line.strip())
+                    if match:
+                        checksums[match.group('name')] = match.group('digest').lower()
+        except (urllib.error.URLError, OSError) as e:
+            logger.warning(f"Could not fetch checksums from {checksum_url}: {e}")
+        return checksums
+
+    def fetch(self, url, xz_path, img_path=None, expected_sha512=None):
+        # returns once xz_path (and img_path if given) exist and are verified
+        if self.is_verified(xz_path, expected_sha512):
+            if img_path and not os.path.exists(img_path):
+                self.decompress(xz_path, img_path)
+            return
+
+        if os.path.exists(xz_path):
+            # present but never verified, hash it once and keep it on a match
+            digest = self.hash_file(xz_path)
+            if digest == expected_sha512 or (expected_sha512 is None and self.is_complete(xz_path, img_path)):
+                self.mark_verified(xz_path, digest)
+                if img_path and not os.path.exists(img_path):
+                    self.decompress(xz_path, img_path)
+                return
+            # most likely a truncated download, resume from it
+            logger.warning(f"{os.path.basename(xz_path)} failed verification, resuming download")
+            os.replace(xz_path, f"{xz_path}.part")
+
+        try:
+            digest = self.stream(url, xz_path, img_path, expected_sha512)
+        except ChecksumMismatch:
+            # the partial file we resumed from may have been bad, retry once from scratch
+            logger.warning(f"Checksum mismatch for {url}, restarting download")
+            digest = self.stream(url, xz_path, img_path, expected_sha512)
+        self.mark_verified(xz_path, digest)
+
+    def stream(self, url, xz_path, img_path, expected_sha512):
+        part = f"{xz_path}.part"
+        img_part = f"{img_path}.part" if img_path else None
+        sha512 = hashlib.sha512()
+        decompressor = _StreamDecompressor()
+        # a corrupt stream stops decompression but not hashing, so the
+        # checksum decides and a mismatch is retried from scratch
+        corrupt = None
+
+        def consume(chunk):
+            nonlocal corrupt
+            sha512.update(chunk)
+            if out and corrupt is None:
+                try:
+                    for piece in decompressor.decompress(chunk):
+                        out.write(piece)
+                except lzma.LZMAError as e:
+                    corrupt = e
+
+        # replay what is already on disk through the hash and decompressor
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        out = open(img_part, 'wb') if img_part else None
+        try:
+            if offset:
+                with open(part, 'rb') as f:
+                    while chunk := f.read(self.CHUNK_SIZE):
+                        consume(chunk)
+
+            request = urllib.request.Request(url)
+            if offset:
+                request.add_header("Range", f"bytes={offset}-")
+            try:
+                response = urllib.request.urlopen(request, timeout=self.timeout)
+            except urllib.error.HTTPError as e:
+                if e.code != 416:
+                    raise
+                # range not satisfiable, the part file is already complete
+                response = None
+
+            if response is not None:
+                with response:
+                    if offset and response.status != 206:
+                        # server ignored the range, start over
+                        logger.debug(f"Server does not support resume for {url}")
+                        offset = 0
+                        sha512 = hashlib.sha512()
+                        decompressor = _StreamDecompressor()
+                        corrupt = None
+                        if out:
+                            out.seek(0)
+                            out.truncate()
+                    elif offset:
+                        print(f"Resuming {os.path.basename(xz_path)} at {offset} bytes")
+                    with open(part, 'ab' if offset else 'wb') as fpart:
+                        while chunk := response.read(self.CHUNK_SIZE):
+                            fpart.write(chunk)
+                            consume(chunk)
+                        fpart.flush()
+                        os.fsync(fpart.fileno())
+            if out:
+                out.flush()
+                os.fsync(out.fileno())
+        finally:
+            if out:
+                out.close()
+
+        digest = sha512.hexdigest()
+        if expected_sha512 and digest != expected_sha512:
+            self.discard(part, img_part)
+            raise ChecksumMismatch(f"{url}: expected {expected_sha512}, got {digest}")
+        if corrupt:
+            # resuming would replay the same bad bytes
+            self.discard(part, img_part)
+            raise lzma.LZMAError(f"{url}: {corrupt}")
+        if img_part and not decompressor.eof:
+            raise lzma.LZMAError(f"{url}: compressed stream ended early")
+
+        os.replace(part, xz_path)
+        if img_part:
+            os.replace(img_part, img_path)
+        return digest
+
+    @staticmethod
+    def discard(*paths):
+        for path in paths:
+            if path and os.path.exists(path):
+                os.remove(path)
+
+    def decompress(self, xz_path, img_path):
+        img_part = f"{img_path}.part"
+        decompressor = _StreamDecompressor()
+        with tracer.span("decompress", image=os.path.basename(img_path)), \
+                open(xz_path, 'rb') as f, open(img_part, 'wb') as out:
+            while chunk := f.read(self.CHUNK_SIZE):
+                for piece in decompressor.decompress(chunk):
+                    out.write(piece)
+            out.flush()
+            os.fsync(out.fileno())
+        if not decompressor.eof:
+            os.remove(img_part)
+            raise lzma.LZMAError(f"{xz_path}: compressed stream ended early")
+        os.replace(img_part, img_path)
+
+    def is_complete(self, xz_path, img_path=None):
+        # without a checksum the xz container's own integrity checks are the
+        # best we have, a full decode catches truncated and corrupt files
+        try:
+            if img_path:
+                self.decompress(xz_path, img_path)
+            else:
+                decompressor = _StreamDecompressor()
+                with open(xz_path, 'rb') as f:
+                    while chunk := f.read(self.CHUNK_SIZE):
+                        for _ in decompressor.decompress(chunk):
+                            pass
+                if not decompressor.eof:
+                    return False
+        except lzma.LZMAError:
+            return False
+        return True
+
+    def hash_file(self, path):
+        sha512 = hashlib.sha512()
+        with open(path, 'rb') as f:
+            while chunk := f.read(self.CHUNK_SIZE):
+                sha512.update(chunk)
+        return sha512.hexdigest()
+
+    def load_index(self):
+        try:
+            with open(self.index_file, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def is_verified(self, path, expected_sha512=None):
+        # a file is trusted while its size and mtime match the verified entry
+        if not os.path.exists(path):
+            return False
+        with self._index_lock:
+            entry = self.load_index().get(os.path.basename(path))
+        if not entry:
+            return False
+        st = os.stat(path)
+        if entry['size'] != st.st_size or entry['mtime_ns'] != st.st_mtime_ns:
+            return False
+        return expected_sha512 is None or entry['sha512'] == expected_sha512
+
+    def mark_verified(self, path, digest):
+        st = os.stat(path)
+        with self._index_lock:
+            index = self.load_index()
+            index[os.path.basename(path)] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha512': digest}
+            tmp = f"{self.index_file}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(index, f, indent=2)
+            os.replace(tmp, self.index_file)
+
+
+# xz files may hold several concatenated streams, lzma.LZMADecompressor only
+# handles one so a fresh one is started whenever a stream ends
+class _StreamDecompressor:
+    # most bytes decompressed at once, a run of zeros in an image expands
+    # a small chunk to any size
+    MAX_OUTPUT = 4 * 1024 * 1024
+
+    def __init__(self):
+        self.decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+        # set between streams, where only null stream padding may follow
+        self.between_streams = False
+
+    @property
+    def eof(self):
+        return self.between_streams or self.decompressor.eof
+
+    def decompress(self, data):
+        # yields the output in pieces of at most MAX_OUTPUT bytes
+        while True:
+            if self.between_streams:
+                data = data.lstrip(b"\0")
+                if not data:
+                    return
+                self.decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+                self.between_streams = False
+            piece = self.decompressor.decompress(data, self.MAX_OUTPUT)
+            data = b""
+            if piece:
+                yield piece
+            if self.decompressor.eof:
+                data = self.decompressor.unused_data
+                self.between_streams = True
+                if not data:
+                    return
+            elif self.decompressor.needs_input:
+                return
@@ -0,0 +1,17 @@
+import contextlib
+import fcntl
+import os
+
+
+# file_lock holds an exclusive flock on path for the duration of the block.
+# Every open of the file gets its own lock, so it serializes processes
+# sharing STAND_TEST_ROOT as well as threads of one process
+@contextlib.contextmanager
+def file_lock(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
@@ -1,4 +1,12 @@
+import os
+
+
 class FreeBSDUtils:
+    QEMU_IMG = "/usr/local/bin/qemu-img"
+    # direct: boot the built image read-write
+    # snapshot: qemu -snapshot, writes go to a temporary file qemu discards
+    # overlay: a qcow2 overlay backed by the image in the run's scratch area
+    DISK_MODES = ["direct", "snapshot", "overlay"]
 
     def __init__(self):
         pass
@@ -35,57 +43,103 @@ class FreeBSDUtils:
         return boot_efi_name[machine_arch]
 
     @staticmethod
-    def get_qemu_recipe(m, ma, fs, img, bios_code, bios_vars, port):
+    def get_disk(img, bios_vars, disk_mode, private_vars=False):
+        # returns (shell prelude, drive file, drive format, extra qemu args, vars file)
+        # private_vars copies the firmware vars per run even in direct mode,
+        # for vars shared by every guest restored from a firmware snapshot
+        if disk_mode == "direct":
+            if private_vars:
+                return FreeBSDUtils.scratch_prelude() + FreeBSDUtils.copy_vars(bios_vars), img, "raw", "", '"$vars"'
+            return "", img, "raw", "", bios_vars
+        if disk_mode == "snapshot":
+            # -snapshot covers the firmware vars drive as well
+            return "", img, "raw", "-snapshot ", bios_vars
+        if disk_mode == "overlay":
+            # firmware vars are per run too, guests sharing them would clash
+            prelude = FreeBSDUtils.scratch_prelude() + f"""overlay="$scratch/{os.path.basename(img)}.qcow2"
+{FreeBSDUtils.QEMU_IMG} create -q -f qcow2 -F raw -b {img} "$overlay" || exit 1
+""" + FreeBSDUtils.copy_vars(bios_vars)
+            return prelude, '"$overlay"', "qcow2", "", '"$vars"'
+        raise ValueError(f"Invalid disk mode: {disk_mode}. Valid disk modes are: {', '.join(FreeBSDUtils.DISK_MODES)}")
+
+    @staticmethod
+    def scratch_prelude():
+        # the engine sets BOOTBAKER_SCRATCH and removes it after the run,
+        # standalone runs get a temporary directory cleaned up on exit
+        return """
+if [ -n "$BOOTBAKER_SCRATCH" ]; then
+    scratch="$BOOTBAKER_SCRATCH"
+else
+    scratch=$(mktemp -d) && trap 'rm -rf "$scratch"' EXIT
+fi
+"""
+
+    @staticmethod
+    def copy_vars(bios_vars):
+        return f"""vars="$scratch/{os.path.basename(bios_vars)}"
+[ -f {bios_vars} ] && cp {bios_vars} "$vars"
+"""
+
+    @staticmethod
+    def get_qemu_recipe(m, ma, fs, img, bios_code, bios_vars, monitor, disk_mode="direct", incoming=None):
+        # monitor is a -monitor spec, e.g. unix:/path.sock, the engine may
+        # override it per run through BOOTBAKER_MONITOR
         qemu_bin = FreeBSDUtils.get_qemu_bin(ma)
+        # a restored guest writes to the vars the snapshot was saved with
+        prelude, disk, fmt, extra, bios_vars = FreeBSDUtils.get_disk(img, bios_vars, disk_mode, private_vars=bool(incoming))
+        if incoming:
+            # resume from a saved machine state instead of powering on
+            extra += f'-incoming "exec:cat {incoming}" '
         if ma == "amd64":
             script = f"""
-{qemu_bin} -nographic -m 512M \
--drive file={img},if=none,id=drive0,cache=writeback,format=raw \
+{qemu_bin} -nographic -m 512M {extra}\
+-drive file={disk},if=none,id=drive0,cache=writeback,format={fmt} \
 -device virtio-blk,drive=drive0,bootindex=0 \
--drive file={bios_code},format=raw,if=pflash \
--monitor telnet::{port},server,nowait \
+-drive file={bios_code},format=raw,if=pflash,readonly=on \
+-drive file={bios_vars},format=raw,if=pflash \
+-monitor "${{BOOTBAKER_MONITOR:-{monitor}}}",server,nowait \
 -serial stdio $*
 """
         elif ma == "aarch64":
             script = f"""
-{qemu_bin} -m 512M -cpu cortex-a57 -M virt,gic-version=3 -nographic  \
--drive file={img},if=none,id=drive0 \
+{qemu_bin} -m 512M -cpu cortex-a57 -M virt,gic-version=3 -nographic {extra}\
+-drive file={disk},if=none,id=drive0,format={fmt} \
 -drive file={bios_code},format=raw,if=pflash,readonly=on \
 -drive file={bios_vars},format=raw,if=pflash \
 -device virtio-blk-device,drive=drive0 \
--monitor telnet::{port},server,nowait \
+-monitor "${{BOOTBAKER_MONITOR:-{monitor}}}",server,nowait \
 -serial stdio $*
 """
         elif ma == "riscv64":
             # https://wiki.freebsd.org/riscv/QEMU
             script = f"""
-{qemu_bin} -m 512M -smp 2 -nographic -machine virt \
+{qemu_bin} -m 512M -smp 2 -nographic -machine virt {extra}\
 -bios /usr/local/share/opensbi/lp64/generic/firmware/fw_jump.elf \
 -kernel /usr/local/share/u-boot/u-boot-qemu-riscv64/u-boot.bin \
--drive file={img},format=raw,id=hd0 \
+-drive file={disk},format={fmt},id=hd0 \
 -device virtio-blk-device,drive=hd0,bootindex=0 \
--monitor telnet::{port},server,nowait \
+-monitor "${{BOOTBAKER_MONITOR:-{monitor}}}",server,nowait \
 -serial stdio $*
 """
         elif ma == "armv7":
             script = f"""
-{qemu_bin} -machine virt -m 512M -smp 2 -nographic \
+{qemu_bin} -machine virt -m 512M -smp 2 -nographic {extra}\
 -bios /usr/local/share/u-boot/u-boot-qemu-arm/u-boot.bin \
--drive if=none,file={img},id=hd0 \
+-drive if=none,file={disk},id=hd0,format={fmt} \
 -device virtio-blk-device,drive=hd0 \
--monitor telnet::{port},server,nowait \
+-monitor "${{BOOTBAKER_MONITOR:-{monitor}}}",server,nowait \
 -serial stdio $*
 """
         elif ma == "powerpc64":
             script = f"""
 {qemu_bin} -machine pseries,accel=kvm,cap-cfpc=broken,cap-sbbc=broken,cap-ibs=broken \
--m 512M -smp 2 -nographic -enable-kvm \
--drive if=none,file={img},id=hd0 \
+-m 512M -smp 2 -nographic -enable-kvm {extra}\
+-drive if=none,file={disk},id=hd0,format={fmt} \
 -device virtio-blk-device,drive=hd0 \
--monitor telnet::{port},server,nowait \
+-monitor "${{BOOTBAKER_MONITOR:-{monitor}}}",server,nowait \
 -serial stdio $*
 """
         else:
-            script = ""
+            return ""
 
-        return script
+        return prelude + script
@@ -0,0 +1,254 @@
+import stat
+import json
+import os
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ISO9660Entry:
+
+    def __init__(self, path, extent, size, mode, is_dir, symlink=None):
+        self.path = path
+        self.extent = extent
+        self.size = size
+        self.mode = mode
+        self.is_dir = is_dir
+        self.symlink = symlink
+
+    def to_dict(self):
+        return vars(self)
+
+    def __str__(self):
+        return f"ISO9660Entry({', '.join(f'{attr}={value}' for attr, value in vars(self).items())})"
+
+
+# ISO9660Reader indexes the directory tree of an ISO9660 (+ Rock Ridge) image
+# once and extracts members from any seekable file object, which includes
+# the random access file returned by xz.open() so the image never has to be
+# decompressed to disk
+class ISO9660Reader:
+    SECTOR_SIZE = 2048
+    CHUNK_SIZE = 1024 * 1024
+    FLAG_DIRECTORY = 0x02
+
+    def __init__(self, fileobj, index_file=None, index_key=None):
+        self.f = fileobj
+        self.index_file = index_file
+        self.index_key = index_key
+        self.entries: dict[str, ISO9660Entry] = {}
+        self.susp_skip = 0
+        self.load_index() or self.build_index()
+
+    @classmethod
+    def open(cls, path):
+        # .xz images are read through the block indexed random access reader
+        if path.endswith(".xz"):
+            import xz
+            fileobj = xz.open(path)
+        else:
+            fileobj = open(path, 'rb')
+        st = os.stat(path)
+        return cls(fileobj, index_file=f"{path}.index.json", index_key=[st.st_size, st.st_mtime_ns])
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read_at(self, offset, size):
+        self.f.seek(offset)
+        return self.f.read(size)
+
+    def load_index(self):
+        if not self.index_file or not os.path.exists(self.index_file):
+            return False
+        try:
+            with open(self.index_file, 'r') as f:
+                index = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return False
+        if index.get('key') != self.index_key:
+            return False
+        self.entries = {path: ISO9660Entry(**entry) for path, entry in index['entries'].items()}
+        return True
+
+    def save_index(self):
+        if not self.index_file:
+            return
+        tmp = f"{self.index_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'key': self.index_key,
+                           'entries': {path: e.to_dict() for path, e in self.entries.items()}}, f)
+            os.replace(tmp, self.index_file)
+        except OSError as e:
+            logger.debug(f"Could not save iso index {self.index_file}: {e}")
+
+    def build_index(self):
+        root = self.read_root_record()
+        self.entries[""] = root
+
+        # read directories in extent order so the underlying stream mostly
+        # moves forward, seeking backwards in an xz block is expensive
+        pending = [root]
+        while pending:
+            pending.sort(key=lambda e: e.extent)
+            directory = pending.pop(0)
+            for entry in self.read_directory(directory):
+                self.entries[entry.path] = entry
+                if entry.is_dir:
+                    pending.append(entry)
+        self.save_index()
+
+    def read_root_record(self):
+        sector = 16
+        while True:
+            descriptor = self.read_at(sector * self.SECTOR_SIZE, self.SECTOR_SIZE)
+            if len(descriptor) < self.SECTOR_SIZE or descriptor[1:6] != b"CD001":
+                raise ValueError("Not an ISO9660 image")
+            if descriptor[0] == 1:
+                break
+            if descriptor[0] == 255:
+                raise ValueError("ISO9660 image has no primary volume descriptor")
+            sector += 1
+
+        record = descriptor[156:156 + 34]
+        root = ISO9660Entry("", self.le32(record, 2), self.le32(record, 10), stat.S_IFDIR | 0o755, True)
+
+        # the "." record of the root carries the SUSP "SP" entry, which tells
+        # how many bytes to skip before the system use entries of each record
+        first = self.read_at(root.extent * self.SECTOR_SIZE, self.SECTOR_SIZE)
+        system_use = self.system_use_area(first[:first[0]], skip=0)
+        if system_use[:2] == b"SP" and system_use[4:6] == b"\xbe\xef":
+            self.susp_skip = system_use[6]
+        return root
+
+    def read_directory(self, directory):
+        data = self.read_at(directory.extent * self.SECTOR_SIZE, directory.size)
+        offset = 0
+        while offset < len(data):
+            length = data[offset]
+            if length == 0:
+                # records never cross sectors, the rest of this sector is padding
+                offset = (offset // self.SECTOR_SIZE + 1) * self.SECTOR_SIZE
+                continue
+            record = data[offset:offset + length]
+            offset += length
+
+            name_len = record[32]
+            raw_name = record[33:33 + name_len]
+            if raw_name in (b"\x00", b"\x01"):
+                continue
+            is_dir = bool(record[25] & self.FLAG_DIRECTORY)
+            name, mode, symlink = self.parse_rock_ridge(record)
+            if name is None:
+                name = self.plain_name(raw_name, is_dir)
+            if mode is None:
+                mode = (stat.S_IFDIR | 0o755) if is_dir else (stat.S_IFREG | 0o444)
+            if symlink is not None:
+                mode = stat.S_IFLNK | (mode & 0o7777)
+                is_dir = False
+
+            path = f"{directory.path}/{name}" if directory.path else name
+            yield ISO9660Entry(path, self.le32(record, 2), self.le32(record, 10), mode, is_dir, symlink)
+
+    def system_use_area(self, record, skip=None):
+        name_len = record[32]
+        start = 33 + name_len + (0 if name_len % 2 else 1)
+        return record[start + (self.susp_skip if skip is None else skip):]
+
+    def parse_rock_ridge(self, record):
+        name, mode, symlink = None, None, None
+        area = self.system_use_area(record)
+        while area:
+            offset = 0
+            continuation = None
+            while offset + 4 <= len(area):
+                signature = area[offset:offset + 2]
+                length = area[offset + 2]
+                if length < 4:
+                    break
+                data = area[offset + 4:offset + length]
+                if signature == b"NM":
+                    if not data[0] & 0x06:
+                        name = (name or "") + data[1:].decode(errors='replace')
+                elif signature == b"PX":
+                    mode = self.le32(data, 0)
+                elif signature == b"SL":
+                    symlink = (symlink + "/" if symlink else "") + self.parse_symlink(data)
+                elif signature == b"CE":
+                    continuation = (self.le32(data, 0), self.le32(data, 8), self.le32(data, 16))
+                elif signature == b"ST":
+                    break
+                offset += length
+            area = b""
+            if continuation:
+                block, cont_offset, cont_len = continuation
+                area = self.read_at(block * self.SECTOR_SIZE + cont_offset, cont_len)
+        return name, mode, symlink
+
+    def parse_symlink(self, data):
+        components = []
+        offset = 1
+        while offset + 2 <= len(data):
+            flags, length = data[offset], data[offset + 1]
+            content = data[offset + 2:offset + 2 + length]
+            if flags & 0x02:
+                components.append(".")
+            elif flags & 0x04:
+                components.append("..")
+            elif flags & 0x08:
+                components.append("")
+            else:
+                components.append(content.decode(errors='replace'))
+            offset += 2 + length
+        link = "/".join(components)
+        return link if link else "/"
+
+    def plain_name(self, raw_name, is_dir):
+        # without Rock Ridge fall back to the ISO9660 "NAME.EXT;1" form
+        name = raw_name.decode(errors='replace')
+        if not is_dir:
+            name = name.split(";")[0].rstrip(".")
+        return name.lower()
+
+    @staticmethod
+    def le32(data, offset):
+        return int.from_bytes(data[offset:offset + 4], "little")
+
+    def get(self, path):
+        return self.entries.get(path.strip("/"))
+
+    def extract(self, members, dest):
+        # extracts members in extent order, returns the ones not found
+        found, missing = [], []
+        for member in members:
+            entry = self.get(member)
+            (found if entry else missing).append(entry or member)
+
+        for entry in sorted(found, key=lambda e: e.extent):
+            target = os.path.join(dest, entry.path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if os.path.lexists(target) and not os.path.isdir(target):
+                os.remove(target)
+            if entry.is_dir:
+                os.makedirs(target, exist_ok=True)
+            elif entry.symlink is not None:
+                os.symlink(entry.symlink, target)
+            else:
+                self.f.seek(entry.extent * self.SECTOR_SIZE)
+                remaining = entry.size
+                with open(target, 'wb') as out:
+                    while remaining > 0:
+                        chunk = self.f.read(min(self.CHUNK_SIZE, remaining))
+                        if not chunk:
+                            raise EOFError(f"Image ended while extracting {entry.path}")
+                        out.write(chunk)
+                        remaining -= len(chunk)
+                os.chmod(target, stat.S_IMODE(entry.mode))
+        return missing
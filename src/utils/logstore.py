@@ -0,0 +1,193 @@
+from collections import deque
+import json
+import time
+import zlib
+import os
+import re
+
+
+# LogSink stores a console stream as independently gzipped chunks of one
+# file (so plain zcat reads it), an index of the chunks' offsets and line
+# numbers, and the uncompressed tail of the stream. Chunks end on a line
+# boundary where the stream has one. The index and tail are rewritten with
+# every chunk, so a log can be read while the guest runs and survives a
+# killed run up to its last chunk. Past max_bytes chunks are no longer
+# stored, the tail keeps following the stream so the end of a runaway log
+# is still there.
+class LogSink:
+    DATA = "console.gz"
+    INDEX = "index.json"
+    TAIL = "tail.log"
+    CHUNK_SIZE = 256 * 1024
+    # seconds a slow stream is buffered before a chunk is cut anyway
+    FLUSH_INTERVAL = 5
+    MAX_BYTES = 16 * 1024 * 1024
+    TAIL_BYTES = 64 * 1024
+
+    def __init__(self, path, max_bytes=None, tail_bytes=None):
+        # path is a directory holding the three files
+        self.path = path
+        self.max_bytes = max_bytes or self.MAX_BYTES
+        self.tail_bytes = tail_bytes or self.TAIL_BYTES
+        if os.path.isfile(path):
+            # a plain log left by an older version
+            os.remove(path)
+        os.makedirs(path, exist_ok=True)
+        self.data = open(os.path.join(path, self.DATA), 'wb')
+        self.pending = bytearray()
+        self.tail = deque()
+        self.tail_size = 0
+        self.chunks = []
+        self.total = 0
+        self.stored = 0
+        self.lines = 0
+        self.flushed = time.monotonic()
+        self.write_index()
+
+    def write(self, data: bytes):
+        self.total += len(data)
+        self.remember(data)
+        room = self.max_bytes - self.stored - len(self.pending)
+        if room > 0:
+            self.pending += data[:room]
+        if len(self.pending) >= self.CHUNK_SIZE or time.monotonic() - self.flushed >= self.FLUSH_INTERVAL:
+            self.flush_chunk(whole_lines=True)
+            self.write_index()
+        return len(data)
+
+    def remember(self, data):
+        # ring buffer of the last tail_bytes of the stream
+        self.tail.append(bytes(data))
+        self.tail_size += len(data)
+        while self.tail and self.tail_size - len(self.tail[0]) >= self.tail_bytes:
+            self.tail_size -= len(self.tail.popleft())
+
+    def tail_data(self):
+        return b"".join(self.tail)[-self.tail_bytes:]
+
+    def flush_chunk(self, whole_lines=False):
+        # with whole_lines a partial last line stays pending, unless it
+        # alone fills a chunk
+        self.flushed = time.monotonic()
+        end = len(self.pending)
+        if whole_lines:
+            end = self.pending.rfind(b"\n") + 1
+            if not end and len(self.pending) >= self.CHUNK_SIZE:
+                end = len(self.pending)
+        if not end:
+            return
+        chunk = bytes(self.pending[:end])
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        compressed = compressor.compress(chunk) + compressor.flush()
+        lines = chunk.count(b"\n")
+        self.chunks.append({
+            "offset": self.data.tell(),
+            "length": len(compressed),
+            "raw_offset": self.stored,
+            "raw_length": len(chunk),
+            "first_line": self.lines + 1,
+            "lines": lines,
+        })
+        self.data.write(compressed)
+        self.data.flush()
+        self.stored += len(chunk)
+        self.lines += lines
+        del self.pending[:end]
+
+    def write_index(self):
+        # tail first, a reader never sees an index newer than the tail
+        self.replace(self.TAIL, self.tail_data())
+        self.replace(self.INDEX, json.dumps({
+            "chunks": self.chunks, "total": self.total, "stored": self.stored,
+            "truncated": self.total > self.stored + len(self.pending),
+            "tail": min(self.total, self.tail_bytes)}).encode())
+
+    def replace(self, name, data):
+        tmp = os.path.join(self.path, f".{name}.tmp")
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(self.path, name))
+
+    def close(self):
+        if self.data.closed:
+            return
+        self.flush_chunk()
+        self.data.close()
+        self.write_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# LogReader answers tail and grep queries on a LogSink directory, finished
+# or still being written. A tail is served from the uncompressed tail
+# file, grep searches each chunk as a whole and only splits the ones that
+# match into lines, numbered from the index
+class LogReader:
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, LogSink.INDEX), 'r') as f:
+            self.index = json.load(f)
+
+    def tail(self, lines=50):
+        with open(os.path.join(self.path, LogSink.TAIL), 'rb') as f:
+            data = f.read()
+        text = data.decode(errors='replace').rstrip("\n")
+        return text.split("\n")[-lines:] if text else []
+
+    def chunk(self, entry, f):
+        f.seek(entry["offset"])
+        return zlib.decompress(f.read(entry["length"]), 31)
+
+    def grep(self, pattern, ignore_case=False):
+        # yields (line number, line), chunks hold whole lines so each one is
+        # searched on its own, a line longer than a chunk is searched in parts
+        flags = re.IGNORECASE if ignore_case else 0
+        regex = re.compile(pattern, flags)
+        # every line match is a match in its chunk, \A and \Z anchor lines
+        # only when searched line by line
+        prefilter = None if re.search(r"\\[AZ]", pattern) else re.compile(pattern, flags | re.MULTILINE)
+        with open(os.path.join(self.path, LogSink.DATA), 'rb') as f:
+            for entry in self.index["chunks"]:
+                text = self.chunk(entry, f).decode(errors='replace')
+                if prefilter and not prefilter.search(text):
+                    continue
+                lines = text.split("\n")
+                if lines[-1] == "":
+                    lines.pop()
+                for line_no, line in enumerate(lines, entry["first_line"]):
+                    if regex.search(line):
+                        yield line_no, line
+        for line in self.past_chunks():
+            if regex.search(line):
+                yield None, line
+
+    def lost(self):
+        # bytes past the stored chunks that the tail no longer holds
+        return max(0, self.index["total"] - self.index["tail"] - self.index["stored"])
+
+    def past_chunks(self):
+        # whole lines of the tail that are not in a chunk, i.e. past the cap
+        # or not flushed yet
+        total, stored = self.index["total"], self.index["stored"]
+        if total <= stored:
+            return []
+        with open(os.path.join(self.path, LogSink.TAIL), 'rb') as f:
+            data = f.read()
+        # the tail holds the stream from tail_start on
+        tail_start = total - len(data)
+        start = max(stored, tail_start) - tail_start
+        if tail_start + start and (start == 0 or data[start - 1:start] != b"\n"):
+            # a line started before the tail or in the last chunk
+            newline = data.find(b"\n", start)
+            if newline < 0:
+                return []
+            start = newline + 1
+        lines = data[start:].decode(errors='replace').split("\n")
+        if lines[-1] == "":
+            lines.pop()
+        return lines
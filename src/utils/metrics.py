@@ -0,0 +1,186 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import bisect
+import json
+import math
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    # seconds, from a cached stage up to a slow emulated boot
+    BUCKETS = [0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800]
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or self.BUCKETS
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        # (upper bound, observations <= bound), the last bound is +Inf
+        total = 0
+        for bound, count in zip(self.buckets + [math.inf], self.counts):
+            total += count
+            yield bound, total
+
+
+# Metrics holds the run's counters and histograms, which are updated where
+# things happen, and gauges, which are read from collectors when scraped.
+# It renders them in the Prometheus text format or as a JSON snapshot
+class Metrics:
+    FAMILIES = {
+        "bootbaker_configs": ("gauge", "Configs in the run"),
+        "bootbaker_queue_depth": ("gauge", "Configs waiting, by queue"),
+        "bootbaker_active_guests": ("gauge", "Guests running, by arch"),
+        "bootbaker_tests_total": ("counter", "Finished tests, by arch and status"),
+        "bootbaker_test_seconds": ("histogram", "Boot duration, by arch"),
+        "bootbaker_test_phase_seconds": ("histogram", "Time spent per boot phase"),
+        "bootbaker_stages_total": ("counter", "Finished build stages, by stage and status"),
+        "bootbaker_stage_seconds": ("histogram", "Build stage duration, by stage"),
+        "bootbaker_cache_requests_total": ("counter", "Cache lookups, by cache and result"),
+        "bootbaker_cache_hit_ratio": ("gauge", "Share of cache lookups that hit, by cache"),
+        "bootbaker_host_cpu_headroom": ("gauge", "CPUs the admission scheduler could still hand out"),
+        "bootbaker_host_memory_headroom_bytes": ("gauge", "Memory the admission scheduler could still hand out"),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, sorted label items) -> value or Histogram
+        self.counters = {}
+        self.histograms = {}
+        # name -> fn() yielding (metric, labels, value), the latest per name wins
+        self.collectors = {}
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.histograms.setdefault(key, Histogram()).observe(value)
+
+    def cache(self, cache, hit):
+        self.inc("bootbaker_cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+    def register(self, name, collector):
+        self.collectors[name] = collector
+
+    def gauges(self):
+        gauges = {}
+        for name, collector in list(self.collectors.items()):
+            try:
+                for metric, labels, value in collector():
+                    gauges[self.key(metric, labels)] = value
+            except Exception as e:
+                logger.debug(f"Metrics collector {name} failed: {e}")
+        # hit ratios follow from the lookup counters
+        lookups = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                if name == "bootbaker_cache_requests_total":
+                    labels = dict(labels)
+                    hits, total = lookups.get(labels["cache"], (0, 0))
+                    lookups[labels["cache"]] = (hits + (value if labels["result"] == "hit" else 0), total + value)
+        for cache, (hits, total) in lookups.items():
+            gauges[self.key("bootbaker_cache_hit_ratio", {"cache": cache})] = hits / total
+        return gauges
+
+    def snapshot(self):
+        # {name: {type, help, samples: [{labels, value} or {labels, count, sum, buckets}]}}
+        families = {name: {"type": kind, "help": text, "samples": []} for name, (kind, text) in self.FAMILIES.items()}
+        gauges = self.gauges()
+        with self.lock:
+            for (name, labels), value in list(self.counters.items()) + list(gauges.items()):
+                families[name]["samples"].append({"labels": dict(labels), "value": value})
+            for (name, labels), histogram in self.histograms.items():
+                families[name]["samples"].append({
+                    "labels": dict(labels), "count": histogram.count, "sum": histogram.sum,
+                    "buckets": {("+Inf" if bound == math.inf else str(bound)): count
+                                for bound, count in histogram.cumulative()}})
+        return families
+
+    def prometheus(self):
+        lines = []
+        for name, family in self.snapshot().items():
+            lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {family['type']}")
+            for sample in family["samples"]:
+                if family["type"] != "histogram":
+                    lines.append(f"{name}{self.labels(sample['labels'])} {sample['value']}")
+                    continue
+                for bound, count in sample["buckets"].items():
+                    lines.append(f"{name}_bucket{self.labels({**sample['labels'], 'le': bound})} {count}")
+                lines.append(f"{name}_sum{self.labels(sample['labels'])} {sample['sum']}")
+                lines.append(f"{name}_count{self.labels(sample['labels'])} {sample['count']}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def labels(labels):
+        if not labels:
+            return ""
+        escaped = {k: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for k, v in labels.items()}
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped.items()) + "}"
+
+
+# MetricsServer serves /metrics (Prometheus text) and /metrics.json on a
+# background thread for as long as the run lasts
+class MetricsServer:
+
+    def __init__(self, metrics: Metrics, host="127.0.0.1", port=9464):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.server = None
+
+    def handler(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path == "/metrics":
+                    return self.reply(metrics.prometheus().encode(), "text/plain; version=0.0.4")
+                if self.path == "/metrics.json":
+                    return self.reply(json.dumps(metrics.snapshot()).encode(), "application/json")
+                self.send_error(404)
+
+            def reply(self, data, content_type):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logger.debug(f"{self.address_string()} {format % args}")
+
+        return Handler
+
+    def start(self):
+        self.server = ThreadingHTTPServer((self.host, self.port), self.handler())
+        threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+        logger.info(f"Serving metrics on http://{self.host}:{self.server.server_address[1]}/metrics")
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+# process wide metrics, updates are cheap so they are always collected
+metrics = Metrics()
@@ -0,0 +1,63 @@
+import shutil
+import os
+
+
+class SparseUtils:
+    BLOCK_SIZE = 64 * 1024
+    ZERO_BLOCK = bytes(BLOCK_SIZE)
+
+    @staticmethod
+    def data_regions(fd, size):
+        # yields (offset, length) of the regions holding data, the whole file
+        # when the platform or filesystem can't tell holes apart
+        if not hasattr(os, "SEEK_DATA"):
+            yield 0, size
+            return
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError:
+                # ENXIO: only a hole is left
+                return
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+            yield start, end - start
+            offset = end
+
+    @staticmethod
+    def sparse_copy(src, dst):
+        # copies src to dst leaving holes for src's holes and all-zero blocks
+        block_size = SparseUtils.BLOCK_SIZE
+        with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+            size = os.fstat(fin.fileno()).st_size
+            for start, length in SparseUtils.data_regions(fin.fileno(), size):
+                fin.seek(start)
+                offset = start
+                remaining = length
+                while remaining > 0:
+                    block = fin.read(min(block_size, remaining))
+                    if not block:
+                        break
+                    if block != SparseUtils.ZERO_BLOCK[:len(block)]:
+                        fout.seek(offset)
+                        fout.write(block)
+                    offset += len(block)
+                    remaining -= len(block)
+            fout.truncate(size)
+        shutil.copymode(src, dst)
+
+    @staticmethod
+    def is_sparse(path):
+        st = os.stat(path)
+        return hasattr(st, "st_blocks") and st.st_blocks * 512 < st.st_size
+
+    @staticmethod
+    def sparsify(path):
+        # rewrites path in place as a sparse file, returns the bytes saved
+        st = os.stat(path)
+        if not hasattr(st, "st_blocks"):
+            return 0
+        tmp = f"{path}.{os.getpid()}.sparse"
+        SparseUtils.sparse_copy(path, tmp)
+        os.replace(tmp, path)
+        return st.st_blocks * 512 - os.stat(path).st_blocks * 512
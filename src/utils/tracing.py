@@ -0,0 +1,115 @@
+from contextlib import contextmanager
+import threading
+import json
+import time
+import os
+
+
+class Span:
+
+    def __init__(self, name, category, start, end, tid, tags):
+        self.name = name
+        self.category = category
+        self.start = start
+        self.end = end
+        self.tid = tid
+        self.tags = tags
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def __str__(self):
+        return f"Span({self.category}/{self.name}, {self.duration:.2f}s, {self.tags})"
+
+
+# Tracer collects timed spans for build stages and test phases, which can
+# be exported as a Chrome trace (chrome://tracing, Perfetto) or a plain
+# JSON timeline and summarized per stage
+class Tracer:
+
+    def __init__(self):
+        self.spans: list[Span] = []
+        self.lock = threading.Lock()
+        self.origin = time.time()
+
+    @contextmanager
+    def span(self, name, category="build", **tags):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.time(), category, **tags)
+
+    def add(self, name, start, end, category="build", tid=None, **tags):
+        # tid groups spans into rows, by default the recording thread
+        span = Span(name, category, start, end, tid or threading.current_thread().name, tags)
+        with self.lock:
+            self.spans.append(span)
+        return span
+
+    def chrome_events(self):
+        pid = os.getpid()
+        tids = {}
+        events = []
+        for span in sorted(self.spans, key=lambda s: s.start):
+            tid = tids.setdefault(span.tid, len(tids) + 1)
+            events.append({
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": int((span.start - self.origin) * 1e6),
+                "dur": int(span.duration * 1e6),
+                "pid": pid,
+                "tid": tid,
+                "args": span.tags,
+            })
+        for name, tid in tids.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": str(name)}})
+        return events
+
+    def export_chrome(self, path):
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": self.chrome_events(), "displayTimeUnit": "ms"}, f)
+
+    def export_timeline(self, path):
+        with open(path, 'w') as f:
+            json.dump([{"name": s.name, "category": s.category, "start": s.start - self.origin,
+                        "duration": s.duration, "thread": str(s.tid), **s.tags}
+                       for s in sorted(self.spans, key=lambda s: s.start)], f, indent=2)
+
+    def summary(self):
+        # per (category, stage): count, total, mean, max seconds, and how many
+        # spans of the category ran in parallel on average over its wall time
+        rows = {}
+        wall = {}
+        for span in self.spans:
+            row = rows.setdefault((span.category, span.name), {"count": 0, "total": 0.0, "max": 0.0})
+            row["count"] += 1
+            row["total"] += span.duration
+            row["max"] = max(row["max"], span.duration)
+            first, last = wall.get(span.category, (span.start, span.end))
+            wall[span.category] = (min(first, span.start), max(last, span.end))
+
+        summary = []
+        for (category, name), row in sorted(rows.items(), key=lambda item: (item[0][0], -item[1]["total"])):
+            summary.append({"category": category, "stage": name, **row, "mean": row["total"] / row["count"]})
+        parallelism = {}
+        for category, (first, last) in wall.items():
+            busy = sum(s.duration for s in self.spans if s.category == category)
+            parallelism[category] = busy / (last - first) if last > first else 0.0
+        return summary, parallelism
+
+    def format_summary(self):
+        summary, parallelism = self.summary()
+        lines = [f"{'category':<8} {'stage':<16} {'count':>6} {'total':>10} {'mean':>9} {'max':>9}"]
+        for row in summary:
+            lines.append(f"{row['category']:<8} {row['stage']:<16} {row['count']:>6} "
+                         f"{row['total']:>9.2f}s {row['mean']:>8.2f}s {row['max']:>8.2f}s")
+        for category, value in sorted(parallelism.items()):
+            lines.append(f"{category} average parallelism: {value:.2f}")
+        return "\n".join(lines)
+
+
+# process wide tracer, spans are cheap so it is always recording
+tracer = Tracer()
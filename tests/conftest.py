@@ -0,0 +1,33 @@
+import tempfile
+import shutil
+import atexit
+import json
+import os
+import pytest
+
+# src.config reads STAND_TEST_ROOT at import time, point it at a scratch
+# directory before any test module imports src
+ROOT = tempfile.mkdtemp(prefix="bootbaker-tests-")
+os.environ["BOOTBAKER_ROOT"] = ROOT
+atexit.register(shutil.rmtree, ROOT, ignore_errors=True)
+
+
+@pytest.fixture
+def fake_tools(tmp_path, monkeypatch):
+    # puts the benchmarks' stand-in qemu, qemu-img and build tools on PATH,
+    # the returned function (re)writes the profile scripting them
+    from benchmarks.fakes import FakeTools
+    from src.utils.freebsd_utils import FreeBSDUtils
+    profile = tmp_path / "profile.json"
+    fakes = FakeTools(str(tmp_path / "bin"), str(profile)).install()
+    for name, value in fakes.env({"PATH": os.environ.get("PATH", "")}).items():
+        monkeypatch.setenv(name, value)
+    # the recipes call qemu by absolute path
+    get_qemu_bin = FreeBSDUtils.get_qemu_bin
+    monkeypatch.setattr(FreeBSDUtils, "get_qemu_bin", lambda ma: get_qemu_bin(ma) and os.path.basename(get_qemu_bin(ma)))
+    monkeypatch.setattr(FreeBSDUtils, "QEMU_IMG", "qemu-img")
+
+    def configure(**spec):
+        profile.write_text(json.dumps(spec))
+    configure(qemu={"console": ["Consoles: EFI console", "---<<BOOT>>---"], "outcomes": {"pass": 1.0}})
+    return configure
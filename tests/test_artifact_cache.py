@@ -0,0 +1,62 @@
+from src.core.artifact_cache import ArtifactCache
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import os
+import pytest
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ArtifactCache(root=str(tmp_path / "artifacts"))
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return str(path)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_store_and_fetch(cache, tmp_path):
+    src = write(tmp_path / "kernel", b"kernel")
+    key = ArtifactCache.hash_inputs(kind="tree", version="13.2")
+    assert not cache.contains(key, "kernel")
+    assert not cache.fetch(key, "kernel", str(tmp_path / "missing"))
+
+    cache.store(key, "kernel", src)
+    assert cache.contains(key, "kernel")
+    dst = str(tmp_path / "out" / "kernel")
+    assert cache.fetch(key, "kernel", dst)
+    assert read(dst) == b"kernel"
+    # a linked artifact shares its inode, a cloned one does not
+    assert os.path.samefile(dst, cache.path(key, "kernel"))
+    assert cache.fetch(key, "kernel", dst, link=False)
+    assert not os.path.samefile(dst, cache.path(key, "kernel"))
+
+
+def test_hash_inputs_is_order_independent_and_unambiguous():
+    assert ArtifactCache.hash_inputs(a="1", b="2") == ArtifactCache.hash_inputs(b="2", a="1")
+    assert ArtifactCache.hash_inputs(a="12", b="") != ArtifactCache.hash_inputs(a="1", b="2")
+
+
+def test_concurrent_store_of_one_key(cache, tmp_path):
+    # threads race on the same key, every store succeeds and leaves one
+    # complete artifact and no temporaries
+    threads = 8
+    for round in range(20):
+        key = ArtifactCache.hash_inputs(round=round)
+        sources = [write(tmp_path / f"src-{round}-{i}", b"artifact" * 1024) for i in range(threads)]
+        barrier = threading.Barrier(threads)
+
+        def store(src, link):
+            barrier.wait()
+            return cache.store(key, "image", src, link=link)
+        with ThreadPoolExecutor(threads) as executor:
+            results = list(executor.map(store, sources, [i % 2 == 0 for i in range(threads)]))
+        assert set(results) == {cache.path(key, "image")}
+        assert read(results[0]) == b"artifact" * 1024
+        assert os.listdir(os.path.dirname(results[0])) == ["image"]
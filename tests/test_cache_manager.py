@@ -0,0 +1,127 @@
+from src.core.cache_manager import CacheManager
+from src.cli import main
+from click.testing import CliRunner
+import multiprocessing
+import time
+import os
+import pytest
+
+
+@pytest.mark.parametrize("flags, enforced", [(["-b"], False), (["-t"], True), ([], True)])
+def test_run_enforces_the_budget_unless_only_building(monkeypatch, flags, enforced):
+    calls = []
+    monkeypatch.setattr(CacheManager, "enforce", lambda self, *args, **kwargs: calls.append(kwargs))
+    # matches nothing, so nothing is built or booted
+    result = CliRunner().invoke(main, ["run", *flags, "-x", "!*-*-*-*"])
+    assert result.exit_code == 0, result.output
+    assert bool(calls) == enforced
+
+
+@pytest.fixture
+def root(tmp_path):
+    return str(tmp_path / "root")
+
+
+def make(root, rel_path, size=8192, atime=None):
+    path = os.path.join(root, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    if atime:
+        os.utime(path, (atime, atime))
+    return path
+
+
+def disk_size(*paths):
+    return sum(os.stat(path).st_blocks * 512 for path in paths)
+
+
+def test_classify_units():
+    manager = CacheManager(root="/r")
+    assert manager.classify(manager.unit("artifacts/ab/abcd/esp")) == "intermediate"
+    assert manager.unit("tree/amd64/work/FreeBSD-13.2-amd64-ufs/etc/fstab") == "tree/amd64/work/FreeBSD-13.2-amd64-ufs"
+    assert manager.classify("tree/amd64/work/FreeBSD-13.2-amd64-ufs") == "workspace"
+    assert manager.classify("cache/amd64/FreeBSD-13.2-RELEASE-amd64-bootonly.iso.xz") == "compressed"
+    assert manager.classify("cache/amd64/FreeBSD-13.2-RELEASE-amd64-bootonly.iso") == "decompressed"
+    assert manager.classify("image/amd64/FreeBSD-13.2-amd64-ufs-gpt-none.img") == "final"
+    assert manager.classify("logs/amd64/FreeBSD-13.2-amd64-ufs-gpt-none") == "log"
+    assert manager.classify("script/amd64/x.sh") is None
+
+
+def test_eviction_order_is_class_then_least_recently_used(root):
+    old, new = time.time() - 3600, time.time() - 60
+    paths = {
+        "final": make(root, "image/amd64/a.img", atime=old),
+        "compressed": make(root, "cache/amd64/a.iso.xz", atime=old),
+        "log_new": make(root, "logs/amd64/new", atime=new),
+        "log_old": make(root, "logs/amd64/old", atime=old),
+        "decompressed": make(root, "cache/amd64/a.iso", atime=new),
+    }
+    manager = CacheManager(root=root)
+    evicted = [path for path, _ in manager.enforce(budget=disk_size(paths["final"]), dry_run=True)]
+    assert evicted == ["logs/amd64/old", "logs/amd64/new", "cache/amd64/a.iso", "cache/amd64/a.iso.xz"]
+    assert all(os.path.exists(path) for path in paths.values())
+
+    manager.enforce(budget=disk_size(paths["final"], paths["compressed"]))
+    assert sorted(manager.scan()) == ["cache/amd64/a.iso.xz", "image/amd64/a.img"]
+    assert not os.path.exists(paths["log_old"])
+
+
+def test_pinned_and_recently_used_artifacts_stay(root):
+    old = time.time() - 3600
+    make(root, "logs/amd64/pinned", atime=old)
+    make(root, "logs/amd64/old", atime=old)
+    make(root, "logs/amd64/in-use", atime=old)
+    manager = CacheManager(root=root)
+    assert manager.pin("logs/*/pinned") == ["logs/amd64/pinned"]
+    keep_since = time.time()
+    manager.touch(os.path.join(root, "logs/amd64/in-use"))
+    evicted = manager.enforce(budget=0, keep_since=keep_since)
+    assert [path for path, _ in evicted] == ["logs/amd64/old"]
+    assert sorted(manager.scan()) == ["logs/amd64/in-use", "logs/amd64/pinned"]
+
+
+def test_hardlinked_artifacts_are_counted_once(root):
+    image = make(root, "image/amd64/a.img", size=64 * 1024)
+    artifact = os.path.join(root, "artifacts", "ab", "abcd", "img")
+    os.makedirs(os.path.dirname(artifact))
+    os.link(image, artifact)
+    manager = CacheManager(root=root)
+    size = disk_size(image)
+    assert manager.stats()["total"] == size
+    # evicting one of two links frees nothing, the budget still needs the
+    # other one gone
+    evicted = manager.enforce(budget=size - 1)
+    assert len(evicted) == 2
+    assert manager.stats()["total"] == 0
+
+
+def test_touches_are_written_on_flush(root):
+    log = make(root, "logs/amd64/a", atime=time.time() - 3600)
+    manager = CacheManager(root=root)
+    manager.scan()
+    before = manager.load()["logs/amd64/a"]["atime"]
+    CacheManager(root=root).touch(log)
+    assert manager.load()["logs/amd64/a"]["atime"] == before
+    CacheManager(root=root).flush()
+    assert manager.load()["logs/amd64/a"]["atime"] > before
+
+
+def touch_many(root, worker):
+    manager = CacheManager(root=root)
+    for i in range(20):
+        manager.touch(os.path.join(root, "logs", f"w{worker}", str(i)))
+        manager.flush()
+
+
+def test_index_updates_from_several_processes_are_not_lost(root):
+    for worker in range(4):
+        for i in range(20):
+            make(root, f"logs/w{worker}/{i}", size=1)
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=touch_many, args=(root, worker)) for worker in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert len(CacheManager(root=root).load()) == 80
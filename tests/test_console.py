@@ -0,0 +1,56 @@
+from src.core.console import ConsoleMatcher
+from src.core.configuration import Config
+
+TARGET = Config.target_string
+
+
+def test_success_on_target_string():
+    matcher = ConsoleMatcher(TARGET)
+    assert matcher.feed(b"Booting...\r\n") is None
+    verdict = matcher.feed(f"{TARGET}\r\n".encode())
+    assert verdict.passed
+    assert verdict.line == TARGET
+    # the verdict sticks
+    assert matcher.feed(b"panic: too late\n") is verdict
+
+
+def test_failure_patterns():
+    verdict = ConsoleMatcher(TARGET).feed(b"Fatal trap 12: page fault while in kernel mode\n")
+    assert not verdict.passed
+    assert verdict.pattern == "Fatal trap 12"
+
+
+def test_success_wins_on_the_same_line():
+    verdict = ConsoleMatcher(TARGET).feed(f"panic: {TARGET}\n".encode())
+    assert verdict.passed
+
+
+def test_prompt_without_newline():
+    matcher = ConsoleMatcher(TARGET)
+    verdict = matcher.feed(b"Trying to mount root from ufs:/dev/gpt/rootfs\n\nmountroot> ")
+    assert not verdict.passed
+    assert verdict.pattern == "mountroot>"
+    assert matcher.verdict_at is not None
+
+
+def test_line_split_across_feeds():
+    matcher = ConsoleMatcher(TARGET)
+    half = len(TARGET) // 2
+    assert matcher.feed(f"ok\n{TARGET[:half]}".encode()) is None
+    assert matcher.feed(f"{TARGET[half:]}\n".encode()).passed
+
+
+def test_custom_patterns_replace_the_defaults():
+    matcher = ConsoleMatcher(TARGET, success_patterns=[r"login: $"], failure_patterns=[])
+    assert matcher.feed(b"panic: ignored\n") is None
+    assert matcher.feed(b"FreeBSD/amd64 (bootbaker) (ttyu0)\n\nlogin: ").passed
+
+
+def test_milestones_and_unterminated_tail_cap():
+    matcher = ConsoleMatcher(TARGET)
+    matcher.feed(b"Consoles: EFI console\n")
+    matcher.feed(b"---<<BOOT>>---\n")
+    assert list(matcher.milestones) == ["loader", "kernel"]
+    assert matcher.first_output <= matcher.milestones["loader"] <= matcher.milestones["kernel"]
+    matcher.feed(b"x" * (ConsoleMatcher.MAX_LINE * 2))
+    assert len(matcher.pending) == ConsoleMatcher.MAX_LINE
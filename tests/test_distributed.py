@@ -0,0 +1,156 @@
+from src.core import distributed
+from src.core.distributed import Coordinator, Worker, Task
+from src.core.configuration import Config
+from src.core.history import RunHistory
+from src.core import engine
+from tests.test_engine import write_recipe
+import threading
+import socket
+import fcntl
+import time
+import os
+import pytest
+
+
+def configs(count=4):
+    combinations = [(filesystem, interface, encryption) for filesystem in ("ufs", "zfs")
+                    for interface in ("gpt", "mbr") for encryption in ("none", "geli")]
+    return [Config("amd64:amd64", filesystem, interface, None, None, None, encryption=encryption)
+            for filesystem, interface, encryption in combinations[:count]]
+
+
+def expire(coordinator, *tasks):
+    for task in tasks:
+        task.deadline = time.time() - 1
+
+
+def test_expired_lease_is_requeued_first():
+    coordinator = Coordinator(configs())
+    leased = [coordinator.tasks[payload["id"]] for payload in coordinator.lease("w1", 2)["tasks"]]
+    coordinator.heartbeat("w1", [leased[0].id])
+    expire(coordinator, leased[1])
+    coordinator.reap()
+    assert leased[0].state == Task.LEASED
+    assert leased[1].state == Task.QUEUED and leased[1].worker is None
+    assert coordinator.queue[0] == leased[1].id
+    # never started, so it was not an attempt
+    assert leased[1].attempts == 0
+
+
+def test_silent_worker_loses_its_tasks():
+    coordinator = Coordinator(configs())
+    coordinator.register("w1")
+    leased = coordinator.lease("w1", 2)["tasks"]
+    coordinator.workers["w1"]["seen"] -= Coordinator.WORKER_TIMEOUT
+    coordinator.reap()
+    assert "w1" not in coordinator.workers
+    assert coordinator.queue[:2] == [payload["id"] for payload in reversed(leased)]
+
+
+def test_task_lost_while_running_becomes_an_error():
+    coordinator = Coordinator(configs(1))
+    for attempt in range(Coordinator.MAX_ATTEMPTS):
+        task_id = coordinator.lease(f"w{attempt}")["tasks"][0]["id"]
+        assert coordinator.start(f"w{attempt}", task_id)["ok"]
+        expire(coordinator, coordinator.tasks[task_id])
+        coordinator.reap()
+    assert coordinator.finished.is_set()
+    result, = coordinator.reporter.results
+    assert result.status == engine.TestResult.ERROR
+    assert result.detail == f"lost {Coordinator.MAX_ATTEMPTS} workers"
+
+
+def test_idle_worker_steals_half_the_backlog():
+    coordinator = Coordinator(configs())
+    busy = [payload["id"] for payload in coordinator.lease("w1", 4)["tasks"]]
+    assert coordinator.start("w1", busy[0])["ok"]
+    # the started task stays, of the other three the victim keeps the larger half
+    stolen = [payload["id"] for payload in coordinator.lease("w2", 4)["tasks"]]
+    assert stolen == busy[3:]
+    assert all(coordinator.tasks[task_id].worker == "w2" for task_id in stolen)
+    assert not coordinator.start("w1", stolen[0])["ok"]
+    assert coordinator.start("w2", stolen[0])["ok"]
+
+
+def test_result_is_recorded_under_its_fingerprint():
+    coordinator = Coordinator(configs(1))
+    task_id = coordinator.lease("w1")["tasks"][0]["id"]
+    fingerprint = f"distributed-{os.getpid()}-{time.time()}"
+    assert coordinator.result("w1", task_id, engine.TestResult.PASSED, 1.0, fingerprint=fingerprint)["ok"]
+    config = coordinator.tasks[task_id].config
+    assert config.fingerprint == fingerprint
+    assert RunHistory().cached_pass(config)
+    # a second result of the same task is refused
+    assert not coordinator.result("w2", task_id, engine.TestResult.FAILED, 1.0)["ok"]
+
+
+# StubPipeline stands in for the worker's build, it writes the real recipe
+# for the fake qemu and fingerprints the config by its identifier
+class StubPipeline:
+    root = None
+    builds = []
+
+    def __init__(self, configs, max_workers=None):
+        self.configs = configs
+
+    def run(self):
+        for config in self.configs:
+            lock = os.path.join(Worker.LOCK_DIR, f"{config.machine_combo}.lock")
+            with open(lock) as f:
+                # held by the worker building it
+                with pytest.raises(BlockingIOError):
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            workdir = os.path.join(self.root, config.identifier)
+            os.makedirs(workdir, exist_ok=True)
+            write_recipe(config, type(self.root)(workdir))
+            config.fingerprint = f"{os.path.basename(self.root)}-{config.identifier}"
+            self.builds.append(config.identifier)
+        return self.configs
+
+
+@pytest.fixture
+def cluster(fake_tools, tmp_path, monkeypatch):
+    monkeypatch.setattr(Coordinator, "REAP_INTERVAL", 0.05)
+    monkeypatch.setattr(Worker, "POLL_INTERVAL", 0.05)
+    monkeypatch.setattr(Worker, "HEARTBEAT_INTERVAL", 0.05)
+    monkeypatch.setattr(StubPipeline, "root", tmp_path / "builds")
+    monkeypatch.setattr(StubPipeline, "builds", [])
+    monkeypatch.setattr(distributed, "BuildPipeline", StubPipeline)
+
+    def run(matrix, workers=2, reverify=False):
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        coordinator = Coordinator(matrix, port=port)
+        results = []
+        serving = threading.Thread(target=lambda: results.extend(coordinator.serve()))
+        serving.start()
+        # workers give up on a coordinator that refuses their registration
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.01)
+        threads = [threading.Thread(target=Worker(f"http://127.0.0.1:{port}", slots=1, name=f"w{i}",
+                                                  reverify=reverify).run) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads + [serving]:
+            thread.join(60)
+        assert not serving.is_alive()
+        return results
+    return run
+
+
+def test_workers_boot_the_matrix_and_reuse_passes(cluster):
+    matrix = configs()
+    results = cluster(matrix)
+    assert sorted(result.config.identifier for result in results) == sorted(c.identifier for c in matrix)
+    assert all(result.status == engine.TestResult.PASSED for result in results)
+    # every config built once, its log uploaded to the coordinator's side
+    assert sorted(StubPipeline.builds) == sorted(c.identifier for c in matrix)
+    assert all(os.path.exists(os.path.join(c.log_file, "index.json")) for c in matrix)
+    # unchanged inputs are cached passes, unless reverified
+    assert {result.status for result in cluster(configs())} == {engine.TestResult.CACHED}
+    assert {result.status for result in cluster(configs(), reverify=True)} == {engine.TestResult.PASSED}
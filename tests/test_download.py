@@ -0,0 +1,187 @@
+from src.utils.download import StreamingDownloader, ChecksumMismatch, _StreamDecompressor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import hashlib
+import lzma
+import os
+import pytest
+
+IMAGE = os.urandom(64 * 1024) + bytes(256 * 1024)
+XZ = lzma.compress(IMAGE, format=lzma.FORMAT_XZ)
+DIGEST = hashlib.sha512(XZ).hexdigest()
+
+
+class Server:
+    # local stand-in for the release mirror, records the Range headers it
+    # got and can ignore them or serve corrupt data
+
+    def __init__(self, body=XZ, ranges=True):
+        self.body = body
+        self.ranges = ranges
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                server.requests.append(self.headers.get("Range"))
+                if self.path.endswith("CHECKSUM.SHA512"):
+                    return self.reply(200, f"SHA512 (image.xz) = {DIGEST}\nnot a checksum line\n".encode())
+                requested = self.headers.get("Range")
+                if requested and server.ranges:
+                    start = int(requested.split("=")[1].rstrip("-"))
+                    if start >= len(server.body):
+                        return self.reply(416, b"")
+                    return self.reply(206, server.body[start:])
+                self.reply(200, server.body)
+
+            def reply(self, code, data):
+                self.send_response(code)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(**kwargs):
+        servers.append(Server(**kwargs))
+        return servers[-1]
+    yield start
+    for server in servers:
+        server.close()
+
+
+def paths(tmp_path):
+    return str(tmp_path / "image.xz"), str(tmp_path / "image")
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_fetch_verifies_and_decompresses(serve, tmp_path):
+    server = serve()
+    xz_path, img_path = paths(tmp_path)
+    downloader = StreamingDownloader(str(tmp_path))
+    downloader.fetch(f"{server.url}/image.xz", xz_path, img_path, expected_sha512=DIGEST)
+    assert read(xz_path) == XZ
+    assert read(img_path) == IMAGE
+    assert downloader.is_verified(xz_path, DIGEST)
+    assert not os.path.exists(f"{xz_path}.part")
+
+    # verified files are not fetched again
+    downloader.fetch(f"{server.url}/image.xz", xz_path, img_path, expected_sha512=DIGEST)
+    assert len(server.requests) == 1
+
+
+def test_fetch_resumes_partial_download_with_range(serve, tmp_path):
+    server = serve()
+    xz_path, img_path = paths(tmp_path)
+    with open(f"{xz_path}.part", 'wb') as f:
+        f.write(XZ[:1000])
+    StreamingDownloader(str(tmp_path)).fetch(f"{server.url}/image.xz", xz_path, img_path, expected_sha512=DIGEST)
+    assert server.requests == ["bytes=1000-"]
+    assert read(xz_path) == XZ
+    assert read(img_path) == IMAGE
+
+
+def test_fetch_restarts_when_server_ignores_range(serve, tmp_path):
+    server = serve(ranges=False)
+    xz_path, img_path = paths(tmp_path)
+    with open(f"{xz_path}.part", 'wb') as f:
+        f.write(XZ[:1000])
+    StreamingDownloader(str(tmp_path)).fetch(f"{server.url}/image.xz", xz_path, img_path, expected_sha512=DIGEST)
+    assert server.requests == ["bytes=1000-"]
+    assert read(xz_path) == XZ
+    assert read(img_path) == IMAGE
+
+
+def test_fetch_resumes_unverified_truncated_file(serve, tmp_path):
+    server = serve()
+    xz_path, img_path = paths(tmp_path)
+    with open(xz_path, 'wb') as f:
+        f.write(XZ[:2000])
+    StreamingDownloader(str(tmp_path)).fetch(f"{server.url}/image.xz", xz_path, img_path, expected_sha512=DIGEST)
+    assert server.requests == ["bytes=2000-"]
+    assert read(xz_path) == XZ
+
+
+def test_fetch_retries_from_scratch_after_bad_partial(serve, tmp_path):
+    server = serve()
+    xz_path, img_path = paths(tmp_path)
+    with open(f"{xz_path}.part", 'wb') as f:
+        f.write(b"\xfd7zXZ\x00" + bytes(994))
+    StreamingDownloader(str(tmp_path)).fetch(f"{server.url}/image.xz", xz_path, None, expected_sha512=DIGEST)
+    assert server.requests == ["bytes=1000-", None]
+    assert read(xz_path) == XZ
+
+
+def test_fetch_raises_on_checksum_mismatch(serve, tmp_path):
+    corrupt = bytearray(XZ)
+    corrupt[100] ^= 0xff
+    server = serve(body=bytes(corrupt))
+    xz_path, img_path = paths(tmp_path)
+    downloader = StreamingDownloader(str(tmp_path))
+    with pytest.raises(ChecksumMismatch):
+        downloader.fetch(f"{server.url}/image.xz", xz_path, img_path, expected_sha512=DIGEST)
+    # one retry, and nothing unverified is left to be trusted
+    assert len(server.requests) == 2
+    assert not os.path.exists(xz_path)
+    assert not os.path.exists(f"{xz_path}.part")
+    assert not downloader.is_verified(xz_path)
+
+
+def test_fetch_checksums(serve, tmp_path):
+    server = serve()
+    checksums = StreamingDownloader(str(tmp_path)).fetch_checksums(f"{server.url}/CHECKSUM.SHA512")
+    assert checksums == {"image.xz": DIGEST}
+
+
+def test_verification_lapses_when_file_changes(serve, tmp_path):
+    server = serve()
+    xz_path, _ = paths(tmp_path)
+    downloader = StreamingDownloader(str(tmp_path))
+    downloader.fetch(f"{server.url}/image.xz", xz_path, expected_sha512=DIGEST)
+    with open(xz_path, 'ab') as f:
+        f.write(b"\0")
+    assert not downloader.is_verified(xz_path)
+
+
+def test_corrupt_stream_without_checksum_is_not_resumed(serve, tmp_path):
+    corrupt = bytearray(XZ)
+    corrupt[100] ^= 0xff
+    server = serve(body=bytes(corrupt))
+    xz_path, img_path = paths(tmp_path)
+    with pytest.raises(lzma.LZMAError):
+        StreamingDownloader(str(tmp_path)).fetch(f"{server.url}/image.xz", xz_path, img_path)
+    assert not os.path.exists(f"{xz_path}.part")
+    assert not os.path.exists(f"{img_path}.part")
+
+
+def test_decompression_output_is_bounded(monkeypatch):
+    monkeypatch.setattr(_StreamDecompressor, "MAX_OUTPUT", 4096)
+    zeros = bytes(1024 * 1024)
+    # two streams with null padding between them, like concatenated .xz files
+    data = lzma.compress(zeros, format=lzma.FORMAT_XZ) + bytes(8) + XZ
+    decompressor = _StreamDecompressor()
+    pieces = []
+    for offset in range(0, len(data), 1000):
+        pieces += decompressor.decompress(data[offset:offset + 1000])
+    assert max(len(piece) for piece in pieces) <= 4096
+    assert b"".join(pieces) == zeros + IMAGE
+    assert decompressor.eof
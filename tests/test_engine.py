@@ -0,0 +1,170 @@
+from src.core import engine
+from src.core.configuration import Config
+from src.utils.freebsd_utils import FreeBSDUtils
+from src.utils.logstore import LogReader
+import threading
+import asyncio
+import psutil
+import time
+import os
+import pytest
+
+
+def config(filesystem="ufs"):
+    return Config("amd64:amd64", filesystem, "gpt", None, None, None)
+
+
+def write_script(config, text):
+    os.makedirs(config.script_dir, exist_ok=True)
+    with open(os.path.join(config.script_dir, config.script_file), 'w') as f:
+        f.write(text)
+
+
+def write_recipe(config, tmp_path, disk_mode="overlay"):
+    # the real qemu recipe, run against the fake qemu and qemu-img
+    image = str(tmp_path / "disk.img")
+    with open(image, 'wb') as f:
+        f.write(b"pristine image")
+    code, vars = str(tmp_path / "code.fd"), str(tmp_path / "vars.fd")
+    for path in (code, vars):
+        with open(path, 'wb') as f:
+            f.write(b"firmware")
+    write_script(config, FreeBSDUtils.get_qemu_recipe(config.machine, config.machine_arch, config.filesystem,
+                                                      image, code, vars, config.monitor, disk_mode))
+    return image
+
+
+def scratch_left(config):
+    if not os.path.isdir(config.SCRATCH_DIR):
+        return []
+    return [name for name in os.listdir(config.SCRATCH_DIR) if name.startswith(f"{config.identifier}.")]
+
+
+def alive(pid):
+    try:
+        return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+
+def guest_script(config, tmp_path):
+    # a guest that never answers, its pid shows whether it was killed
+    pidfile = tmp_path / "guest.pid"
+    write_script(config, f"sleep 300 &\necho $! > {pidfile}\nwait\n")
+    return pidfile
+
+
+def test_pass_streams_the_console_into_a_closed_log(fake_tools, tmp_path):
+    amd64 = config()
+    write_recipe(amd64, tmp_path)
+    result = engine.TestEngine(timeout=30).run([amd64])[0]
+    assert result.status == engine.TestResult.PASSED
+    assert result.matched == amd64.target_string
+    reader = LogReader(amd64.log_file)
+    # closed: everything written is in a chunk
+    assert reader.index["stored"] == reader.index["total"]
+    assert [line for _, line in reader.grep("^Consoles:")] == ["Consoles: EFI console"]
+    assert scratch_left(amd64) == []
+
+
+def test_failure_keeps_the_console_tail(fake_tools, tmp_path):
+    fake_tools(qemu={"console": ["Loading kernel..."], "outcomes": {"fail": 1.0}})
+    amd64 = config()
+    write_recipe(amd64, tmp_path)
+    result = engine.TestEngine(timeout=30).run([amd64])[0]
+    assert result.status == engine.TestResult.FAILED
+    assert result.detail == "matched 'panic: '"
+    assert "panic: fake failure" in result.tail
+
+
+def test_timeout_kills_the_whole_process_group(tmp_path):
+    amd64 = config()
+    pidfile = guest_script(amd64, tmp_path)
+    start = time.time()
+    result = engine.TestEngine(timeout=1).run([amd64])[0]
+    assert result.status == engine.TestResult.TIMEOUT
+    assert time.time() - start < 10
+    assert not alive(int(pidfile.read_text()))
+    assert LogReader(amd64.log_file).tail(1) == ["---Script execution timed out---"]
+    assert scratch_left(amd64) == []
+
+
+def test_cancellation_kills_the_guest_and_cleans_up(tmp_path):
+    amd64 = config()
+    pidfile = guest_script(amd64, tmp_path)
+
+    async def run():
+        task = asyncio.create_task(engine.TestEngine(timeout=300).run_one(amd64))
+        while not pidfile.exists() or not pidfile.read_text().strip():
+            await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    asyncio.run(run())
+    assert not alive(int(pidfile.read_text()))
+    assert scratch_left(amd64) == []
+    # the log was closed on the way out
+    reader = LogReader(amd64.log_file)
+    assert reader.index["stored"] == reader.index["total"]
+
+
+def test_history_is_queried_and_recorded_off_the_event_loop(fake_tools, tmp_path):
+    amd64 = config()
+    write_recipe(amd64, tmp_path)
+    threads = []
+
+    class History:
+        def cached_pass(self, config):
+            threads.append(threading.current_thread())
+            return False
+
+        def timeout_for(self, config):
+            threads.append(threading.current_thread())
+            return 30
+
+        def record(self, result):
+            threads.append(threading.current_thread())
+    history = History()
+    runner = engine.TestEngine(timeout_for=history.timeout_for, verdicts=history, record=history.record)
+    assert runner.run([amd64])[0].status == engine.TestResult.PASSED
+    assert len(threads) == 3
+    assert threading.main_thread() not in threads
+
+
+def test_max_workers_limits_guests(fake_tools, tmp_path):
+    fake_tools(qemu={"boot": 0.3, "console": ["booting"], "outcomes": {"pass": 1.0}})
+    configs = [config(fs) for fs in ("ufs", "zfs")]
+    for c in configs:
+        write_recipe(c, tmp_path)
+    start = time.time()
+    results = engine.TestEngine(max_workers=1, timeout=30).run(configs)
+    assert [r.status for r in results] == [engine.TestResult.PASSED] * 2
+    assert time.time() - start >= 0.6
+
+
+@pytest.mark.parametrize("disk_mode, pristine", [("overlay", True), ("snapshot", True), ("direct", False)])
+def test_only_direct_boots_write_the_built_image(fake_tools, tmp_path, disk_mode, pristine):
+    fake_tools(qemu={"write_disk": True, "console": ["booting"], "outcomes": {"pass": 1.0}})
+    amd64 = config()
+    image = write_recipe(amd64, tmp_path, disk_mode)
+    result = engine.TestEngine(timeout=30).run([amd64])[0]
+    assert result.status == engine.TestResult.PASSED
+    with open(image, 'rb') as f:
+        assert (f.read() == b"pristine image") == pristine
+    # the overlay and the vars copy went with the scratch dir
+    assert scratch_left(amd64) == []
+
+
+def test_overlay_is_created_in_the_scratch_dir(fake_tools, tmp_path):
+    amd64 = config()
+    write_recipe(amd64, tmp_path, "overlay")
+    path = os.path.join(amd64.script_dir, amd64.script_file)
+    with open(path, 'r') as f:
+        script = f.read()
+    with open(path, 'w') as f:
+        # list the scratch dir just before qemu starts
+        f.write(script.replace("\nqemu-system-x86_64", '\nls "$BOOTBAKER_SCRATCH"\nqemu-system-x86_64', 1))
+    engine.TestEngine(timeout=30).run([amd64])
+    listing = LogReader(amd64.log_file).tail(10)
+    assert "disk.img.qcow2" in listing
+    assert "vars.fd" in listing
@@ -0,0 +1,67 @@
+from src.core.history import RunHistory
+from src.core import engine
+from src.core.configuration import Config
+import pytest
+
+
+def config(arch="amd64:amd64", filesystem="ufs"):
+    return Config(arch, filesystem, "gpt", None, None, None)
+
+
+@pytest.fixture
+def history(tmp_path):
+    return RunHistory(path=str(tmp_path / "history.sqlite"))
+
+
+def record(history, config, durations, status=engine.TestResult.PASSED):
+    for duration in durations:
+        history.record(engine.TestResult(config, status, duration))
+
+
+def test_timeout_needs_enough_samples(history):
+    amd64 = config()
+    record(history, amd64, [20] * (RunHistory.MIN_SAMPLES - 1))
+    assert history.timeout_for(amd64, default=123) == 123
+    assert history.estimate(amd64) is None
+    record(history, amd64, [20])
+    assert history.timeout_for(amd64, default=123) == 20 * RunHistory.TIMEOUT_MARGIN
+
+
+def test_timeout_is_a_clamped_quantile_of_passed_runs(history):
+    amd64 = config()
+    record(history, amd64, [40, 41, 42, 43, 44])
+    # failures and timeouts do not stretch the timeout
+    record(history, amd64, [500] * 5, status=engine.TestResult.TIMEOUT)
+    assert history.timeout_for(amd64, default=0) == 44 * RunHistory.TIMEOUT_MARGIN
+
+    fast, slow = config(filesystem="zfs"), config("riscv:riscv64")
+    record(history, fast, [1] * 5)
+    record(history, slow, [1000] * 5)
+    assert history.timeout_for(fast, default=0) == RunHistory.TIMEOUT_FLOOR
+    assert history.timeout_for(slow, default=0) == RunHistory.TIMEOUT_CEILING
+
+
+def test_timeout_falls_back_to_the_arch(history):
+    record(history, config(filesystem="zfs"), [50] * 5)
+    assert history.timeout_for(config(), default=0) == 50 * RunHistory.TIMEOUT_MARGIN
+    assert history.timeout_for(config("arm64:aarch64"), default=7) == 7
+
+
+def test_estimate_is_the_median_of_all_outcomes(history):
+    amd64 = config()
+    record(history, amd64, [10, 20, 30])
+    record(history, amd64, [100, 100], status=engine.TestResult.FAILED)
+    assert history.estimate(amd64) == 30
+
+
+def test_cached_pass_follows_the_last_verdict(history):
+    amd64 = config()
+    assert not history.cached_pass(amd64)
+    amd64.fingerprint = "abc"
+    record(history, amd64, [20])
+    assert history.cached_pass(amd64)
+    # a cached result is not a run
+    record(history, amd64, [0], status=engine.TestResult.CACHED)
+    assert history.estimate(amd64) is None
+    record(history, amd64, [20], status=engine.TestResult.FAILED)
+    assert not history.cached_pass(amd64)
@@ -0,0 +1,98 @@
+from src.core.impact import ChangeImpact
+from src.core.configuration import Config
+import subprocess
+import pytest
+
+
+def git(repo, *args):
+    subprocess.run(["git", "-C", str(repo), *args], check=True, capture_output=True)
+
+
+@pytest.fixture
+def srctop(tmp_path):
+    # a source tree with one commit, edit() changes paths in a second one
+    repo = tmp_path / "src"
+    repo.mkdir()
+    git(repo, "init", "-q")
+    git(repo, "config", "user.email", "test@example.org")
+    git(repo, "config", "user.name", "test")
+    (repo / "README").write_text("src\n")
+    git(repo, "add", "-A")
+    git(repo, "commit", "-q", "-m", "initial")
+
+    def edit(*paths, commit=True):
+        for path in paths:
+            file = repo / path
+            file.parent.mkdir(parents=True, exist_ok=True)
+            file.write_text(f"{path}\n")
+        if commit:
+            git(repo, "add", "-A")
+            git(repo, "commit", "-q", "-m", "change")
+        return str(repo)
+    return edit
+
+
+def rules(tmp_path, *rules):
+    path = tmp_path / "impact.yml"
+    path.write_text("rules:\n" + "".join(f"  - paths: {paths}\n    affects: {affects}\n" for paths, affects in rules))
+    return str(path)
+
+
+def matrix():
+    return [Config(arch, filesystem, "gpt", None, None, None)
+            for arch in ("amd64:amd64", "arm64:aarch64") for filesystem in ("ufs", "zfs")]
+
+
+def selected(impact):
+    return sorted(config.identifier for config in impact.select(matrix()))
+
+
+def identifiers(arch=None, filesystem=None):
+    return sorted(config.identifier for config in matrix()
+                  if arch in (None, config.arch) and filesystem in (None, config.filesystem))
+
+
+def test_first_matching_rule_wins(srctop, tmp_path):
+    rules_file = rules(tmp_path, (["stand/efi/loader/arch/amd64/*"], ["amd64:amd64-*-*-*"]),
+                       (["stand/efi/*"], ["*-*-*-*"]))
+    repo = srctop("stand/efi/loader/arch/amd64/main.c")
+    assert selected(ChangeImpact("HEAD~1..HEAD", repo, rules_file)) == identifiers(arch="amd64:amd64")
+
+
+def test_rule_order_decides(srctop, tmp_path):
+    rules_file = rules(tmp_path, (["stand/efi/*"], ["*-*-*-*"]),
+                       (["stand/efi/loader/arch/amd64/*"], ["amd64:amd64-*-*-*"]))
+    repo = srctop("stand/efi/loader/arch/amd64/main.c")
+    assert selected(ChangeImpact("HEAD~1..HEAD", repo, rules_file)) == identifiers()
+
+
+def test_paths_are_combined_and_deduplicated(srctop, tmp_path):
+    rules_file = rules(tmp_path, (["stand/libsa/zfs/*"], ["*-zfs-*-*"]), (["stand/arm64/*"], ["arm64:aarch64-*-*-*"]))
+    repo = srctop("stand/libsa/zfs/zfs.c", "stand/libsa/zfs/zfsimpl.c", "stand/arm64/boot.c")
+    impact = ChangeImpact("HEAD~1..HEAD", repo, rules_file)
+    assert len(impact.affected()) == 2
+    assert selected(impact) == sorted(set(identifiers(filesystem="zfs") + identifiers(arch="arm64:aarch64")))
+
+
+def test_unmatched_paths_select_nothing(srctop):
+    repo = srctop("share/man/man8/loader.8", "usr.bin/grep/grep.c")
+    impact = ChangeImpact("HEAD~1..HEAD", repo)
+    assert impact.affected() == []
+    assert selected(impact) == []
+
+
+def test_single_revision_compares_the_working_tree(srctop):
+    repo = srctop("stand/libsa/zfs/zfs.c", commit=False)
+    git(repo, "add", "-N", ".")
+    impact = ChangeImpact("HEAD", repo)
+    assert impact.changed_paths() == ["stand/libsa/zfs/zfs.c"]
+    assert selected(impact) == identifiers(filesystem="zfs")
+
+
+def test_repo_rules_keep_specific_rules_first():
+    impact = ChangeImpact("HEAD", "/nonexistent")
+    assert [str(e) for e in impact.rule_for("stand/efi/loader/arch/amd64/elf64_freebsd.c")[1]] == \
+        [str(impact.parser.compile("amd64:amd64-*-*-*"))]
+    assert [str(e) for e in impact.rule_for("stand/efi/boot1/zfs_module.c")[1]] == \
+        [str(impact.parser.compile("*-zfs-*-*"))]
+    assert impact.rule_for("bin/sh/main.c") is None
@@ -0,0 +1,72 @@
+from src.utils.iso9660 import ISO9660Reader
+from benchmarks.iso_fixture import build_iso, write_iso_xz, content
+import stat
+import json
+import os
+import pytest
+
+MEMBERS = ["bin/sh", "lib/libc.so.7", "boot/kernel/kernel", "usr/bin/true"]
+
+
+@pytest.fixture(params=["iso", "iso.xz"])
+def image(request, tmp_path):
+    # the same image plain and through the seekable xz reader
+    path = str(tmp_path / f"bootonly.{request.param}")
+    if path.endswith(".xz"):
+        write_iso_xz(path, MEMBERS, member_bytes=5000)
+    else:
+        with open(path, 'wb') as f:
+            f.write(build_iso(MEMBERS, member_bytes=5000))
+    return path
+
+
+def test_index_uses_rock_ridge_names_and_modes(image):
+    with ISO9660Reader.open(image) as iso:
+        assert set(iso.entries) == {"", "bin", "bin/sh", "lib", "lib/libc.so.7", "boot", "boot/kernel",
+                                    "boot/kernel/kernel", "usr", "usr/bin", "usr/bin/true"}
+        assert iso.get("/lib/libc.so.7").size == 5000
+        assert iso.get("boot").is_dir
+        assert stat.S_IMODE(iso.get("bin/sh").mode) == 0o555
+
+
+def test_extract_members(image, tmp_path):
+    dest = str(tmp_path / "tree")
+    with ISO9660Reader.open(image) as iso:
+        missing = iso.extract(["lib/libc.so.7", "boot/kernel/kernel", "sbin/init"], dest)
+    assert missing == ["sbin/init"]
+    with open(os.path.join(dest, "lib/libc.so.7"), 'rb') as f:
+        assert f.read() == content("lib/libc.so.7", 5000)
+    assert os.path.getsize(os.path.join(dest, "boot/kernel/kernel")) == 5000
+    assert not os.path.exists(os.path.join(dest, "bin/sh"))
+
+
+def test_index_is_reused_until_the_image_changes(image):
+    with ISO9660Reader.open(image):
+        pass
+    with open(f"{image}.index.json", 'r') as f:
+        index = json.load(f)
+    # a planted entry only shows up if the saved index is loaded
+    index["entries"]["planted"] = dict(index["entries"]["bin/sh"], path="planted")
+    with open(f"{image}.index.json", 'w') as f:
+        json.dump(index, f)
+    with ISO9660Reader.open(image) as iso:
+        assert iso.get("planted") is not None
+
+    # a rebuilt image gets a fresh index
+    if image.endswith(".xz"):
+        write_iso_xz(image, MEMBERS[:2], member_bytes=5000)
+    else:
+        with open(image, 'wb') as f:
+            f.write(build_iso(MEMBERS[:2], member_bytes=5000))
+    with ISO9660Reader.open(image) as iso:
+        assert iso.get("planted") is None
+        assert iso.get("usr/bin/true") is None
+        assert iso.get("bin/sh") is not None
+
+
+def test_rejects_non_iso(tmp_path):
+    path = str(tmp_path / "not.iso")
+    with open(path, 'wb') as f:
+        f.write(bytes(20 * 2048))
+    with pytest.raises(ValueError):
+        ISO9660Reader.open(path)
@@ -0,0 +1,106 @@
+from src.utils.logstore import LogSink, LogReader
+import gzip
+import os
+import pytest
+
+
+def lines(count, prefix="line"):
+    return b"".join(f"{prefix} {i}\n".encode() for i in range(1, count + 1))
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(LogSink, "CHUNK_SIZE", 1024)
+
+
+def test_roundtrip_is_plain_gzip(tmp_path, small_chunks):
+    path = str(tmp_path / "log")
+    data = lines(1000)
+    with LogSink(path) as sink:
+        for offset in range(0, len(data), 100):
+            sink.write(data[offset:offset + 100])
+    with gzip.open(os.path.join(path, LogSink.DATA), 'rb') as f:
+        assert f.read() == data
+
+    reader = LogReader(path)
+    assert len(reader.index["chunks"]) > 1
+    assert not reader.index["truncated"]
+    assert reader.tail(2) == ["line 999", "line 1000"]
+
+
+def test_grep_numbers_lines_across_chunks(tmp_path, small_chunks):
+    path = str(tmp_path / "log")
+    with LogSink(path) as sink:
+        sink.write(lines(500) + b"panic: boom\n" + lines(500))
+    reader = LogReader(path)
+    assert list(reader.grep(r"^panic")) == [(501, "panic: boom")]
+    assert list(reader.grep(r"line 50\Z")) == [(50, "line 50"), (551, "line 50")]
+    assert list(reader.grep("PANIC", ignore_case=True)) == [(501, "panic: boom")]
+
+
+def test_cap_keeps_the_tail(tmp_path, small_chunks):
+    path = str(tmp_path / "log")
+    with LogSink(path, max_bytes=2048, tail_bytes=512) as sink:
+        sink.write(lines(1000))
+        sink.write(b"panic: past the cap\n")
+    reader = LogReader(path)
+    assert reader.index["truncated"]
+    assert reader.index["stored"] == 2048
+    assert reader.tail(1) == ["panic: past the cap"]
+    assert (None, "panic: past the cap") in list(reader.grep("panic"))
+    assert list(reader.grep(r"^line 1$")) == [(1, "line 1")]
+
+
+def test_readable_while_written(tmp_path, small_chunks):
+    path = str(tmp_path / "log")
+    sink = LogSink(path)
+    assert LogReader(path).tail() == []
+    sink.write(lines(200) + b"partial")
+    reader = LogReader(path)
+    # whole lines are cut into chunks, the partial one waits for its newline
+    assert reader.index["stored"] == len(lines(200))
+    assert reader.tail(1) == ["partial"]
+    assert list(reader.grep(r"^line 3$")) == [(3, "line 3")]
+    sink.close()
+    assert LogReader(path).index["stored"] == len(lines(200)) + len(b"partial")
+
+
+def test_replaces_a_plain_log_file(tmp_path):
+    path = str(tmp_path / "log")
+    with open(path, 'w') as f:
+        f.write("old")
+    with LogSink(path) as sink:
+        sink.write(b"new\n")
+    assert LogReader(path).tail() == ["new"]
+
+
+
+def test_grep_past_a_cap_larger_than_the_tail(tmp_path, small_chunks):
+    path = str(tmp_path / "log")
+    data = lines(2000)
+    with LogSink(path, max_bytes=4096, tail_bytes=256) as sink:
+        sink.write(data)
+    reader = LogReader(path)
+    assert reader.lost() == len(data) - 4096 - 256
+    matches = list(reader.grep(r"^line \d+$"))
+    # the tail starts mid-line, its first partial line is skipped and no
+    # stored line comes out a second time
+    tail_lines = data[-256:].decode().split("\n")[1:-1]
+    assert [m for m in matches if m[0] is None] == [(None, line) for line in tail_lines]
+    assert tail_lines[-1] == "line 2000"
+    assert [m[1] for m in matches if m[0]] == data[:4096].decode().split("\n")[:-1]
+
+
+def test_grep_tail_reaching_into_the_stored_chunks(tmp_path, small_chunks):
+    path = str(tmp_path / "log")
+    data = lines(300)
+    with LogSink(path, max_bytes=2048, tail_bytes=4096) as sink:
+        sink.write(data)
+    reader = LogReader(path)
+    assert reader.lost() == 0
+    matches = list(reader.grep(r"^line"))
+    stored = data[:2048].decode().split("\n")
+    # the line cut by the cap is only found in its stored part
+    past = data[2048:].decode().split("\n")[1:-1]
+    assert [line for _, line in matches] == stored + past
+    assert [line_no for line_no, _ in matches] == list(range(1, len(stored) + 1)) + [None] * len(past)
@@ -0,0 +1,107 @@
+from src.utils.metrics import Metrics, MetricsServer, Histogram
+from src.core.resource_manager import ResourceManager
+from src.core.configuration import Config
+from src.cli import main
+from click.testing import CliRunner
+import urllib.request
+import urllib.error
+import json
+import pytest
+
+
+def test_counters_and_label_escaping():
+    metrics = Metrics()
+    metrics.inc("bootbaker_tests_total", arch="amd64", status="passed")
+    metrics.inc("bootbaker_tests_total", 2, arch="amd64", status="passed")
+    metrics.inc("bootbaker_stages_total", stage='a"b\\c\nd', status="done")
+    text = metrics.prometheus()
+    assert "# TYPE bootbaker_tests_total counter\n" in text
+    assert 'bootbaker_tests_total{arch="amd64",status="passed"} 3\n' in text
+    assert 'bootbaker_stages_total{stage="a\\"b\\\\c\\nd",status="done"} 1\n' in text
+    # every family is announced, sampled or not
+    assert text.count("# HELP ") == len(Metrics.FAMILIES)
+
+
+def test_histograms_are_cumulative():
+    metrics = Metrics()
+    for seconds in (0.05, 3, 3, 4000):
+        metrics.observe("bootbaker_test_seconds", seconds, arch="riscv64")
+    text = metrics.prometheus()
+    assert 'bootbaker_test_seconds_bucket{arch="riscv64",le="0.1"} 1\n' in text
+    assert 'bootbaker_test_seconds_bucket{arch="riscv64",le="2.5"} 1\n' in text
+    assert 'bootbaker_test_seconds_bucket{arch="riscv64",le="5"} 3\n' in text
+    assert 'bootbaker_test_seconds_bucket{arch="riscv64",le="+Inf"} 4\n' in text
+    assert 'bootbaker_test_seconds_count{arch="riscv64"} 4\n' in text
+    assert 'bootbaker_test_seconds_sum{arch="riscv64"} 4006.05\n' in text
+    assert list(Histogram([1, 2]).cumulative()) == [(1, 0), (2, 0), (float("inf"), 0)]
+
+
+def test_gauges_come_from_collectors_and_cache_lookups():
+    metrics = Metrics()
+
+    def broken():
+        raise RuntimeError("scrape failed")
+        yield
+    metrics.register("broken", broken)
+    metrics.register("queue", lambda: [("bootbaker_queue_depth", {"queue": "admission"}, 7)])
+    for hit in (True, True, False, True):
+        metrics.cache("artifact", hit)
+    snapshot = json.loads(json.dumps(metrics.snapshot()))
+    assert snapshot["bootbaker_queue_depth"]["samples"] == [{"labels": {"queue": "admission"}, "value": 7}]
+    assert snapshot["bootbaker_cache_hit_ratio"]["samples"] == [{"labels": {"cache": "artifact"}, "value": 0.75}]
+    # a collector registered again under its name replaces the old one
+    metrics.register("queue", lambda: [("bootbaker_queue_depth", {"queue": "admission"}, 1)])
+    assert metrics.snapshot()["bootbaker_queue_depth"]["samples"][0]["value"] == 1
+
+
+def test_resource_manager_collector():
+    configs = [Config("amd64:amd64", "ufs", "gpt", None, None, None),
+               Config("riscv:riscv64", "ufs", "gpt", None, None, None)]
+    manager = ResourceManager(configs)
+    samples = {(name, tuple(labels.items())): value for name, labels, value in manager.collect()}
+    assert samples[("bootbaker_configs", ())] == 2
+    assert samples[("bootbaker_queue_depth", (("queue", "admission"),))] == 0
+    assert samples[("bootbaker_active_guests", (("arch", "amd64"),))] == 0
+    assert samples[("bootbaker_active_guests", (("arch", "riscv64"),))] == 0
+    assert ("bootbaker_host_memory_headroom_bytes", ()) in samples
+
+
+def test_server_serves_both_formats():
+    metrics = Metrics()
+    metrics.inc("bootbaker_tests_total", arch="amd64", status="failed")
+    server = MetricsServer(metrics, port=0).start()
+    try:
+        url = f"http://127.0.0.1:{server.server.server_address[1]}"
+        with urllib.request.urlopen(f"{url}/metrics") as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            assert 'bootbaker_tests_total{arch="amd64",status="failed"} 1' in response.read().decode()
+        with urllib.request.urlopen(f"{url}/metrics.json") as response:
+            assert json.load(response)["bootbaker_tests_total"]["samples"][0]["value"] == 1
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f"{url}/other")
+    finally:
+        server.stop()
+    assert server.server is None
+
+
+@pytest.mark.parametrize("address", ["foo", "localhost:http", "99999", "host:"])
+def test_run_rejects_a_bad_metrics_address(address):
+    result = CliRunner().invoke(main, ["run", "--metrics", address])
+    assert result.exit_code == 2
+    assert "expected [HOST:]PORT" in result.output
+
+
+def test_run_stops_the_server_when_it_fails(monkeypatch, tmp_path):
+    from src.utils.tracing import tracer
+    stopped = []
+    stop = MetricsServer.stop
+    monkeypatch.setattr(MetricsServer, "stop", lambda self: stopped.append(self) or stop(self))
+
+    def fail(path):
+        raise RuntimeError("export failed")
+    monkeypatch.setattr(tracer, "export_chrome", fail)
+    # matches nothing, so nothing is built
+    result = CliRunner().invoke(main, ["run", "-b", "-x", "!*-*-*-*", "--metrics", "0",
+                                       "--trace", str(tmp_path / "trace.json")])
+    assert isinstance(result.exception, RuntimeError)
+    assert len(stopped) == 1
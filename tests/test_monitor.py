@@ -0,0 +1,76 @@
+from src.core.monitor import MonitorAllocator, monitors
+from src.core.configuration import Config
+import threading
+import socket
+import os
+import pytest
+
+
+def test_unix_sockets_are_unique_across_threads():
+    allocator = MonitorAllocator("unix")
+    specs = []
+
+    def allocate():
+        for _ in range(50):
+            specs.append(allocator.allocate())
+    threads = [threading.Thread(target=allocate) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(specs)) == 200
+    assert all(spec.startswith(f"unix:{MonitorAllocator.RUN_DIR}/{os.getpid()}-") for spec in specs)
+
+
+def test_long_socket_paths_fall_back_to_tcp(monkeypatch):
+    monkeypatch.setattr(MonitorAllocator, "RUN_DIR", "/" + "x" * MonitorAllocator.MAX_SOCKET_PATH)
+    assert MonitorAllocator("unix").allocate().startswith("telnet:127.0.0.1:")
+
+
+def test_tcp_ports_skip_bound_and_allocated_ports():
+    with socket.socket() as busy:
+        busy.bind(("127.0.0.1", 0))
+        port = busy.getsockname()[1]
+        assert not MonitorAllocator.port_free(port)
+        allocator = MonitorAllocator("tcp")
+        allocator.next_port = port
+        first, second = allocator.allocate(), allocator.allocate()
+    assert first != f"telnet:127.0.0.1:{port}"
+    assert first != second
+
+
+def test_pinned_port_is_handed_out_once():
+    allocator = MonitorAllocator("unix")
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    assert allocator.allocate(port) == f"telnet:127.0.0.1:{port}"
+    with pytest.raises(RuntimeError):
+        allocator.allocate(port)
+    allocator.release(f"telnet:127.0.0.1:{port}")
+    assert allocator.allocate(port) == f"telnet:127.0.0.1:{port}"
+
+
+def test_unix_monitor_connect_and_cleanup():
+    allocator = MonitorAllocator("unix")
+    spec = allocator.allocate()
+    MonitorAllocator.prepare(spec)
+    path = spec.partition(":")[2]
+    with socket.socket(socket.AF_UNIX) as server:
+        server.bind(path)
+        server.listen()
+        with MonitorAllocator.connect(spec, timeout=5):
+            pass
+    allocator.release(spec)
+    assert not os.path.exists(path)
+    assert spec not in allocator.allocated
+
+
+def test_config_allocates_its_monitor_on_first_use(monkeypatch):
+    calls = []
+    monkeypatch.setattr(monitors, "allocate", lambda port=None: calls.append(port) or f"telnet:127.0.0.1:{port}")
+    config = Config("amd64:amd64", "ufs", "gpt", None, None, None, port=4711)
+    assert calls == []
+    assert config.monitor == "telnet:127.0.0.1:4711"
+    assert config.monitor == "telnet:127.0.0.1:4711"
+    assert calls == [4711]
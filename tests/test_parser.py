@@ -0,0 +1,70 @@
+from src.core.parser import Parser, MatrixExpression, AxisPattern
+from src.core.configuration import Config
+import io
+import pytest
+
+UNIVERSES = {
+    "arch": ["amd64:amd64", "arm64:aarch64", "riscv:riscv64"],
+    "filesystem": ["zfs", "ufs"],
+    "interface": ["gpt", "mbr"],
+    "encryption": ["geli", "none"],
+}
+
+
+def test_axis_pattern_globs_alternation_and_negation():
+    assert AxisPattern("*", ["zfs", "ufs"]).values == ("zfs", "ufs")
+    assert AxisPattern("{ufs,zfs}", ["zfs", "ufs"]).values == ("zfs", "ufs")
+    assert AxisPattern("!zfs", ["zfs", "ufs"]).values == ("ufs",)
+    assert AxisPattern("!{amd64*,arm*}", UNIVERSES["arch"]).values == ("riscv:riscv64",)
+    # literals outside the universe are taken as they are
+    ffs = AxisPattern("ffs", ["zfs", "ufs"])
+    assert ffs.values == ("ffs",)
+    assert "ffs" in ffs and "ufs" not in ffs
+    with pytest.raises(ValueError):
+        AxisPattern("{ufs,}", ["ufs"])
+
+
+def test_matrix_expression_expands_and_matches():
+    expression = MatrixExpression("arm64*-{zfs,ufs}-gpt-!geli@13.*", UNIVERSES, versions=["13.2", "14.0"])
+    assert list(expression.expand()) == [
+        ("arm64:aarch64", "zfs", "gpt", "none", "13.2"),
+        ("arm64:aarch64", "ufs", "gpt", "none", "13.2"),
+    ]
+    assert expression.matches(("arm64:aarch64", "ufs", "gpt", "none", "13.2"))
+    assert expression.matches(("arm64:aarch64", "ufs", "gpt", "none"))
+    assert not expression.matches(("arm64:aarch64", "ufs", "gpt", "none", "14.0"))
+    assert not expression.matches(("arm64:aarch64", "ufs", "gpt", "geli", "13.2"))
+
+
+def test_matrix_expression_splits_outside_braces():
+    assert MatrixExpression.split("amd64:amd64-{ufs,zfs}-gpt-none") == ["amd64:amd64", "{ufs,zfs}", "gpt", "none"]
+    with pytest.raises(ValueError):
+        MatrixExpression("amd64:amd64-ufs-gpt", UNIVERSES)
+
+
+def test_default_expression_only_yields_valid_arches():
+    configs = list(Parser("*-*-*-none").generate_configs())
+    arches = {config.arch for config in configs}
+    assert arches <= set(Config.VALID_ARCHES)
+    assert "amd64:amd64" in arches
+    # riscv has no mbr images
+    assert not any(config.arch == "riscv:riscv64" and config.interface == "mbr" for config in configs)
+    assert len(configs) == len(arches) * 4 - 2
+
+
+def test_unknown_expression_is_not_a_file():
+    with pytest.raises(FileNotFoundError):
+        Parser("amd64:amd64-ufs")
+
+
+def test_recipe_file_with_versions_and_exclude():
+    recipe = io.StringIO(
+        "arm64:\n"
+        "  arch: arm64:aarch64\n"
+        "  version: ['13.2', '14.0']\n"
+        "  regex_combination: ['{ufs,zfs}-gpt-none', 'ufs-gpt-none']\n"
+        "  exclude: ['*-zfs-*-*@14.0']\n"
+    )
+    configs = [(c.filesystem, c.version) for c in Parser(recipe).generate_configs()]
+    # the repeated ufs expression adds nothing
+    assert sorted(configs) == [("ufs", "13.2"), ("ufs", "14.0"), ("zfs", "13.2")]
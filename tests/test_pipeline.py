@@ -0,0 +1,115 @@
+from src.core.configuration import Config
+from src.core.pipeline import Stage, StageGraph, BuildPipeline
+import threading
+import pytest
+
+
+def graph_of(calls, fail=()):
+    # a -> b -> c and an independent d, every stage logs its key
+    graph = StageGraph()
+
+    def stage(key):
+        def run():
+            calls.append(key)
+            if key in fail:
+                raise RuntimeError(f"{key} failed")
+        return run
+    graph.add("a", stage("a"))
+    graph.add("b", stage("b"), ["a"])
+    graph.add("c", stage("c"), ["b"])
+    graph.add("d", stage("d"))
+    return graph
+
+
+def test_equal_keys_are_one_stage():
+    calls = []
+    graph = graph_of(calls)
+    again = graph.add("a", lambda: calls.append("again"))
+    assert again is graph.stages["a"]
+    graph.run(max_workers=2)
+    assert sorted(calls) == ["a", "b", "c", "d"]
+
+
+def test_unknown_dependency_is_refused():
+    with pytest.raises(ValueError):
+        StageGraph().add("b", lambda: None, ["a"])
+
+
+def test_failure_only_skips_dependents():
+    calls = []
+    stages = graph_of(calls, fail=["b"]).run(max_workers=2)
+    assert {key: stage.status for key, stage in stages.items()} == {
+        "a": Stage.DONE, "b": Stage.FAILED, "c": Stage.SKIPPED, "d": Stage.DONE}
+    assert "c" not in calls
+    assert str(stages["b"].error) == "b failed"
+
+
+def test_admit_holds_stages_until_released(monkeypatch):
+    monkeypatch.setattr(StageGraph, "POLL_INTERVAL", 0.01)
+    calls = []
+    graph = graph_of(calls)
+    release = threading.Event()
+    checks = []
+
+    def admit(stage):
+        # d waits until c is done, then is let through on a later check
+        checks.append(stage.key)
+        return stage.key != "d" or release.is_set()
+
+    def on_stage_done(stage):
+        if stage.key == "c":
+            release.set()
+    graph.run(max_workers=4, on_stage_done=on_stage_done, admit=admit)
+    assert calls == ["a", "b", "c", "d"]
+    assert checks.count("d") > 1
+
+
+def matrix():
+    return [Config("amd64:amd64", filesystem, interface, None, None, None)
+            for filesystem in ("ufs", "zfs") for interface in ("gpt", "mbr")]
+
+
+def test_plan_shares_stages_by_their_inputs():
+    configs = matrix()
+    stages = BuildPipeline(configs).plan().stages
+    identifiers = [config.identifier for config in configs]
+    img_file = configs[0].img_file
+    assert set(stages) == {
+        f"fetch:{img_file}", "tree:amd64:13.2", "stand:amd64", "esp-tree:amd64", "firmware:amd64",
+        "esp:amd64", "fs:amd64:13.2:ufs", "fs:amd64:13.2:zfs", f"snapshot:amd64:{configs[0].warm_start}",
+        *(f"image:{identifier}" for identifier in identifiers),
+        *(f"script:{identifier}" for identifier in identifiers)}
+    assert stages[f"image:{identifiers[3]}"].deps == ["esp:amd64", "fs:amd64:13.2:zfs"]
+
+
+def test_failed_shared_stage_only_drops_its_configs():
+    configs = matrix()
+    pipeline = BuildPipeline(configs, max_workers=2)
+    calls = []
+
+    def stub(key):
+        def run():
+            calls.append(key)
+            if key == "fs:amd64:13.2:zfs":
+                raise RuntimeError("makefs failed")
+        return run
+    for key, stage in pipeline.plan().stages.items():
+        stage.fn = stub(key)
+    built = pipeline.run()
+    assert [config.filesystem for config in built] == ["ufs", "ufs"]
+    assert not any(key.startswith("image:") and "zfs" in key for key in calls)
+    # shared stages ran once for all four configs
+    assert calls.count("esp:amd64") == 1
+
+
+def test_interface_and_encryption_variants_share_partitions():
+    variants = [Config("amd64:amd64", "ufs", interface, None, None, None, encryption=encryption)
+                for interface, encryption in [("gpt", "none"), ("mbr", "none"), ("gpt", "geli")]]
+    pipeline = BuildPipeline(variants)
+    stages = pipeline.plan().stages
+    assert len({config.identifier for config in variants}) == 3
+    assert [key for key in stages if key.startswith(("fs:", "esp:"))] == ["esp:amd64", "fs:amd64:13.2:ufs"]
+    for config in variants:
+        assert stages[f"image:{config.identifier}"].deps == ["esp:amd64", "fs:amd64:13.2:ufs"]
+    # and build from the same partition files
+    assert len({(builder.esp_file, builder.fs_file) for builder in pipeline.builders}) == 1
@@ -0,0 +1,112 @@
+from benchmarks.fakes import FakeTools
+import subprocess
+import json
+import sys
+import os
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# plans a matrix in a fresh STAND_TEST_ROOT, builds it with the benchmarks'
+# builder and fake tools, then plans it again before and after its boots
+# are recorded as passes
+SCRIPT = """
+import json, os
+from benchmarks.run import use_fake_qemu, bench_builder
+use_fake_qemu()
+from src.config import STAND_TEST_ROOT
+from src.core import pipeline
+from src.core.parser import Parser
+from src.core.planner import RunPlanner
+from src.core.history import RunHistory
+from src.core.engine import TestResult
+from src.utils.download import StreamingDownloader
+
+def configs():
+    return Parser("amd64:amd64-{ufs,zfs}-gpt-none").generate_configs()
+
+def plan():
+    planner = RunPlanner(configs()).plan()
+    return {"stages": {key: status for key, (status, _) in planner.stages.items()},
+            "tests": planner.tests, "downloads": planner.downloads}
+
+def files():
+    return sorted(os.path.join(d, f) for d, _, names in os.walk(STAND_TEST_ROOT) for f in names)
+
+out = {"fresh": plan(), "fresh_files": files()}
+pipeline.ConfigBuilder = bench_builder()
+build = pipeline.BuildPipeline(configs())
+out["built"] = len(build.run())
+out["unverified"] = plan()
+# the benchmark builder generates the download instead of verifying it
+for builder in build.builders:
+    StreamingDownloader(builder.CACHE_DIR).mark_verified(os.path.join(builder.CACHE_DIR, builder.config.img_file + ".xz"), "0")
+out["built_files"] = files()
+out["built_plan"] = plan()
+out["planned_files"] = files()
+history = RunHistory()
+for builder in build.builders:
+    history.record(TestResult(builder.config, TestResult.PASSED, 1.0))
+out["passed"] = plan()
+print(json.dumps(out))
+"""
+
+
+@pytest.fixture(scope="module")
+def plans(tmp_path_factory):
+    root = tmp_path_factory.mktemp("planner")
+    srctop = root / "src"
+    (srctop / "stand").mkdir(parents=True)
+    (srctop / "etc" / "mtree").mkdir(parents=True)
+    (srctop / "etc" / "mtree" / "BSD.root.dist").write_text("")
+    profile = root / "profile.json"
+    profile.write_text("{}")
+    fakes = FakeTools(str(root / "bin"), str(profile)).install()
+    env = {**fakes.env(), "BOOTBAKER_ROOT": str(root / "root"), "BOOTBAKER_SRCTOP": str(srctop)}
+    result = subprocess.run([sys.executable, "-c", SCRIPT], env=env, cwd=REPO, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def statuses(plan, kind):
+    return {key: status for key, status in plan["stages"].items() if key.startswith(f"{kind}:")}
+
+
+def test_fresh_root_plans_misses_and_writes_nothing(plans):
+    fresh = plans["fresh"]
+    assert plans["fresh_files"] == []
+    assert len(fresh["downloads"]) == 1
+    for kind in ("fetch", "stand", "esp", "fs", "image"):
+        assert set(statuses(fresh, kind).values()) == {"miss"}, kind
+    assert set(fresh["tests"].values()) == {"boot"}
+
+
+def test_partitions_are_unknown_until_their_inputs_are_known(plans):
+    # built, but the download is not verified, so the trees may be stale
+    unverified = plans["unverified"]
+    assert set(statuses(unverified, "fetch").values()) == {"miss"}
+    assert set(statuses(unverified, "stand").values()) == {"hit"}
+    for kind in ("esp", "fs", "image"):
+        assert set(statuses(unverified, kind).values()) == {"unknown"}, kind
+
+
+def test_built_matrix_plans_hits_without_writing(plans):
+    assert plans["built"] == 2
+    built = plans["built_plan"]
+    assert built["downloads"] == []
+    for kind in ("fetch", "stand", "esp", "fs", "image"):
+        assert set(statuses(built, kind).values()) == {"hit"}, kind
+    assert set(built["tests"].values()) == {"boot"}
+    assert plans["planned_files"] == plans["built_files"]
+
+
+def test_recorded_passes_plan_as_cached(plans):
+    # the planner's fingerprint is the one the builder gave the config
+    assert set(plans["passed"]["tests"].values()) == {"cached-pass"}
+
+
+def test_cli_import_leaves_the_core_unloaded():
+    heavy = ["psutil", "yaml", "lzma", "sqlite3", "asyncio", "urllib.request", "src.core.engine"]
+    code = f"import sys, src.cli; print([m for m in {heavy!r} if m in sys.modules])"
+    result = subprocess.run([sys.executable, "-c", code], cwd=REPO, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "[]"
@@ -0,0 +1,93 @@
+from src.core.scheduler import AdmissionScheduler
+from src.core.configuration import Config
+import asyncio
+
+
+def config(arch, filesystem="ufs"):
+    return Config(arch, filesystem, "gpt", None, None, None)
+
+
+class Idle(AdmissionScheduler):
+    # a host with plenty of memory and no other load
+    def external_load(self):
+        return 0.0
+
+    def memory_available(self):
+        return 64 * 1024 * self.MB
+
+
+def test_order_is_longest_expected_first():
+    configs = [config("amd64:amd64"), config("riscv:riscv64"), config("arm64:aarch64"), config("amd64:amd64", "zfs")]
+    ordered = AdmissionScheduler(cpu_cores=4).order(configs)
+    assert [c.identifier for c in ordered] == [configs[1].identifier, configs[2].identifier,
+                                               configs[0].identifier, configs[3].identifier]
+
+
+def test_estimates_override_the_cost_model_and_are_queried_once():
+    calls = []
+
+    def estimator(c):
+        calls.append(c.identifier)
+        return 300 if c.filesystem == "zfs" else None
+    scheduler = AdmissionScheduler(cpu_cores=4, estimator=estimator)
+    configs = [config("riscv:riscv64"), config("amd64:amd64", "zfs")]
+    assert scheduler.order(configs)[0] is configs[1]
+    assert scheduler.cost(configs[0])[2] == AdmissionScheduler.COST_MODELS["riscv64"]["duration"]
+    assert len(calls) == 2
+
+    async def run():
+        async with scheduler.slot(configs[0]):
+            pass
+    asyncio.run(run())
+    assert len(calls) == 2
+
+
+def test_a_single_job_always_runs():
+    class Full(AdmissionScheduler):
+        def memory_available(self):
+            return 0
+
+    async def run():
+        scheduler = Full(cpu_cores=1)
+        async with scheduler.slot(config("riscv:riscv64")) as job:
+            assert scheduler.running == [job]
+        assert scheduler.running == []
+    asyncio.run(run())
+
+
+def test_max_jobs_and_cpus_limit_concurrency():
+    async def run(scheduler, configs):
+        active, peak = 0, 0
+
+        async def guest(c):
+            nonlocal active, peak
+            async with scheduler.slot(c):
+                active += 1
+                peak = max(peak, active)
+                await asyncio.sleep(0.01)
+                active -= 1
+        await asyncio.gather(*(guest(c) for c in configs))
+        return peak
+
+    amd64 = [config("amd64:amd64", fs) for fs in ("ufs", "zfs")] * 3
+    assert asyncio.run(run(Idle(cpu_cores=8, max_jobs=2), amd64)) == 2
+    # riscv guests keep two host threads busy each
+    riscv = [config("riscv:riscv64")] * 4
+    assert asyncio.run(run(Idle(cpu_cores=4), riscv)) == 2
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def run():
+        scheduler = Idle(cpu_cores=1)
+        async with scheduler.slot(config("amd64:amd64")):
+            async def waiter():
+                async with scheduler.slot(config("amd64:amd64", "zfs")):
+                    pass
+            task = asyncio.create_task(waiter())
+            await asyncio.sleep(0)
+            assert len(scheduler.waiting) == 1
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            assert scheduler.waiting == []
+        assert scheduler.running == []
+    asyncio.run(run())
@@ -0,0 +1,103 @@
+from src.core.snapshot import FirmwareSnapshot
+from src.core.configuration import Config
+from src.utils.freebsd_utils import FreeBSDUtils
+import asyncio
+import os
+import pytest
+
+
+@pytest.fixture
+def snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(FirmwareSnapshot, "SNAPSHOT_DIR", str(tmp_path / "snapshots"))
+    qemu = tmp_path / "qemu-system-x86_64"
+    qemu.write_bytes(b"qemu")
+    monkeypatch.setattr(FreeBSDUtils, "get_qemu_bin", lambda ma: str(qemu))
+    code, vars = tmp_path / "code.fd", tmp_path / "vars.fd"
+    code.write_bytes(b"code")
+    vars.write_bytes(b"vars")
+    return FirmwareSnapshot("amd64", "amd64", str(code), str(vars))
+
+
+def test_enabled_only_for_edk2_arches():
+    amd64 = Config("amd64:amd64", "ufs", "gpt", None, None, None, recipe={"warm_start": True})
+    riscv = Config("riscv:riscv64", "ufs", "gpt", None, None, None, recipe={"warm_start": True})
+    cold = Config("amd64:amd64", "ufs", "gpt", None, None, None, recipe={"warm_start": False})
+    assert FirmwareSnapshot.enabled(amd64)
+    assert not FirmwareSnapshot.enabled(riscv)
+    assert not FirmwareSnapshot.enabled(cold)
+
+
+def test_key_follows_firmware_and_qemu(snapshot, tmp_path):
+    key = snapshot.key()
+    assert snapshot.key() == key
+    (tmp_path / "vars.fd").write_bytes(b"other vars")
+    changed = snapshot.key()
+    assert changed != key
+    with open(FreeBSDUtils.get_qemu_bin("amd64"), 'ab') as f:
+        f.write(b" upgraded")
+    assert snapshot.key() not in (key, changed)
+
+
+def test_ensure_takes_the_template_once(snapshot, monkeypatch):
+    taken = []
+
+    def take(staging):
+        taken.append(staging)
+        for name in ("state", "vars.fd"):
+            with open(os.path.join(staging, name), 'w') as f:
+                f.write(name)
+    monkeypatch.setattr(snapshot, "take", take)
+    state, vars_file = snapshot.ensure()
+    assert snapshot.ensure() == (state, vars_file)
+    assert len(taken) == 1
+    assert not os.path.exists(taken[0])
+    assert os.path.dirname(state) == os.path.join(FirmwareSnapshot.SNAPSHOT_DIR, snapshot.key())
+    assert open(vars_file).read() == "vars.fd"
+
+
+def test_failed_template_leaves_nothing_behind(snapshot, monkeypatch):
+    def take(staging):
+        raise Exception("Firmware did not reach the shell")
+    monkeypatch.setattr(snapshot, "take", take)
+    with pytest.raises(Exception, match="did not reach the shell"):
+        snapshot.ensure()
+    assert os.listdir(FirmwareSnapshot.SNAPSHOT_DIR) == []
+
+
+def test_resume_waits_for_the_guest_then_starts_the_loader(tmp_path):
+    config = Config("amd64:amd64", "ufs", "gpt", None, None, None)
+    sock = str(tmp_path / "monitor.sock")
+    config._monitor = f"unix:{sock}"
+    typed = tmp_path / "typed"
+    queries = []
+
+    async def monitor(reader, writer):
+        # paused while the migration loads, then running
+        while await reader.readline():
+            queries.append("info status")
+            status = "running" if len(queries) > 2 else "paused (inmigrate)"
+            writer.write(f"VM status: {status}\r\n(qemu) ".encode())
+            await writer.drain()
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_unix_server(monitor, sock)
+        process = await asyncio.create_subprocess_exec("sh", "-c", f"cat > {typed}", stdin=asyncio.subprocess.PIPE)
+        async with server:
+            await FirmwareSnapshot.resume(config, process)
+        process.stdin.close()
+        await process.wait()
+    asyncio.run(run())
+    assert len(queries) == 3
+    assert typed.read_bytes() == b"reconnect -r\rmap -r\rfs0:\\efi\\boot\\bootx64.efi\r"
+
+
+def test_restored_direct_guests_get_their_own_vars(snapshot):
+    state, vars_file = "/snapshots/key/state", "/snapshots/key/vars.fd"
+    recipe = FreeBSDUtils.get_qemu_recipe("amd64", "amd64", "ufs", "/image/disk.img", snapshot.bios_code,
+                                          vars_file, "unix:/monitor.sock", "direct", state)
+    assert f'cp {vars_file} "$vars"' in recipe
+    assert '-drive file="$vars",format=raw,if=pflash' in recipe
+    assert f"file={vars_file}" not in recipe
+    # the image itself is still booted directly
+    assert "-drive file=/image/disk.img," in recipe
@@ -0,0 +1,111 @@
+from src.utils.sparse import SparseUtils
+from src.core.artifact_cache import ArtifactCache
+from src.core.builder import ConfigBuilder
+from src.core.configuration import Config
+from src.config import IMAGE_ALIGN
+import os
+import pytest
+
+MB = 1024 * 1024
+
+
+def write_sparse(path, regions, size):
+    # regions is a list of (offset, data), the rest is left as holes
+    with open(path, 'wb') as f:
+        for offset, data in regions:
+            f.seek(offset)
+            f.write(data)
+        f.truncate(size)
+    return str(path)
+
+
+def allocated(path):
+    return os.stat(path).st_blocks * 512
+
+
+@pytest.fixture
+def holes(tmp_path):
+    # filesystems without hole support store every byte
+    probe = write_sparse(tmp_path / "probe", [(0, b"x")], 8 * MB)
+    if not hasattr(os, "SEEK_DATA") or allocated(probe) >= 8 * MB:
+        pytest.skip("no sparse file support here")
+    return tmp_path
+
+
+def test_data_regions_skip_holes(holes):
+    path = write_sparse(holes / "disk", [(0, b"a" * 4096), (4 * MB, b"b" * 8192)], 16 * MB)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        regions = list(SparseUtils.data_regions(fd, 16 * MB))
+    finally:
+        os.close(fd)
+    # the filesystem may round regions out to its blocks
+    assert [start for start, _ in regions] == [0, 4 * MB]
+    assert regions[0][1] >= 4096 and regions[1][1] >= 8192
+    assert sum(length for _, length in regions) < MB
+
+
+def test_sparsify_punches_zero_blocks(holes):
+    block = SparseUtils.BLOCK_SIZE
+    data = b"a" * block + bytes(64 * block) + b"b" * block
+    path = str(holes / "image")
+    with open(path, 'wb') as f:
+        f.write(data)
+    before = allocated(path)
+    saved = SparseUtils.sparsify(path)
+    assert saved == before - allocated(path)
+    assert saved >= 60 * block
+    assert SparseUtils.is_sparse(path)
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_clone_keeps_holes(holes):
+    src = write_sparse(holes / "src.img", [(0, b"boot"), (32 * MB, b"root")], 64 * MB)
+    dst = str(holes / "dst.img")
+    ArtifactCache.clone(src, dst)
+    assert os.path.getsize(dst) == 64 * MB
+    assert allocated(dst) < MB
+    with open(src, 'rb') as a, open(dst, 'rb') as b:
+        assert a.read() == b.read()
+
+
+def builder():
+    return ConfigBuilder(Config("amd64:amd64", "ufs", "gpt", None, None, None))
+
+
+def tree(path, *sizes):
+    path.mkdir()
+    for i, size in enumerate(sizes):
+        (path / f"file{i}").write_bytes(b"x" * size)
+    return str(path)
+
+
+def test_content_size_rounds_to_blocks_and_counts_hardlinks_once(tmp_path):
+    top = tree(tmp_path / "tree", 1, 4097, 0)
+    os.link(os.path.join(top, "file1"), os.path.join(top, "link"))
+    block = ConfigBuilder.BLOCK_SIZE
+    # the directory, one block, two blocks, an empty file still takes one
+    assert builder().content_size(top) == block + block + 2 * block + block
+
+
+@pytest.mark.parametrize("kind", ["esp", "ufs", "zfs"])
+def test_small_trees_are_clamped_to_the_minimum(tmp_path, kind):
+    assert builder().image_size(kind, tree(tmp_path / "tree", 10)) == ConfigBuilder.MIN_SIZES[kind]
+
+
+def test_large_trees_get_headroom_and_alignment(tmp_path):
+    top = tree(tmp_path / "tree", 20 * MB + 1)
+    size = builder().image_size("ufs", top)
+    assert size % IMAGE_ALIGN == 0
+    assert size >= 1.5 * (20 * MB + 1) and size - IMAGE_ALIGN < 1.5 * (20 * MB + 2 * ConfigBuilder.BLOCK_SIZE)
+
+
+def test_fat_type_switches_at_the_fat32_minimum():
+    esp = builder()
+    assert esp.get_fat_type(ConfigBuilder.MIN_SIZES["esp"]) == 16
+    assert esp.get_fat_type(ConfigBuilder.FAT32_MIN_SIZE - IMAGE_ALIGN) == 16
+    assert esp.get_fat_type(ConfigBuilder.FAT32_MIN_SIZE) == 32
+    assert "fat_type=32" in esp.get_esp_cmd("esp.img", "src", ConfigBuilder.FAT32_MIN_SIZE)
+    # keys hash the command with placeholders
+    assert "fat_type={fat_type}" in esp.get_esp_cmd("{esp}", "{src}", "{size}")
@@ -0,0 +1,92 @@
+from src.core.stand_cache import StandBuildCache
+from tests.test_impact import git
+import os
+import pytest
+
+
+@pytest.fixture
+def srctop(tmp_path, monkeypatch):
+    monkeypatch.setattr(StandBuildCache, "STAND_CACHE_DIR", str(tmp_path / "stand-cache"))
+    src = tmp_path / "src"
+    (src / "stand" / "efi").mkdir(parents=True)
+    (src / "etc" / "mtree").mkdir(parents=True)
+    (src / "stand" / "efi" / "main.c").write_text("int main;\n")
+    (src / "etc" / "mtree" / "BSD.root.dist").write_text("/set type=dir\n")
+    (src / "README").write_text("src\n")
+    return src
+
+
+@pytest.fixture
+def repo(srctop):
+    git(srctop, "init", "-q")
+    git(srctop, "config", "user.email", "test@example.org")
+    git(srctop, "config", "user.name", "test")
+    git(srctop, "add", "-A")
+    git(srctop, "commit", "-q", "-m", "initial")
+    return srctop
+
+
+def key(srctop, machine="amd64", machine_arch="amd64"):
+    return StandBuildCache(machine, machine_arch, srctop=str(srctop)).key()
+
+
+def test_git_fingerprint_follows_stand_sources(repo):
+    committed = key(repo)
+    assert key(repo) == committed
+    # changes outside stand do not rebuild the loader
+    (repo / "README").write_text("changed\n")
+    assert key(repo) == committed
+    (repo / "stand" / "efi" / "main.c").write_text("int main(void);\n")
+    edited = key(repo)
+    assert edited != committed
+    (repo / "stand" / "efi" / "new.c").write_text("\n")
+    untracked = key(repo)
+    assert untracked not in (committed, edited)
+    git(repo, "add", "-A")
+    git(repo, "commit", "-q", "-m", "stand change")
+    assert key(repo) not in (committed, edited, untracked)
+
+
+def test_fingerprint_covers_the_target(repo):
+    assert key(repo) != key(repo, "arm64", "aarch64")
+
+
+def test_without_git_a_stat_manifest_is_used(srctop):
+    plain = key(srctop)
+    assert key(srctop) == plain
+    main = srctop / "stand" / "efi" / "main.c"
+    st = main.stat()
+    os.utime(main, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    touched = key(srctop)
+    assert touched != plain
+    (srctop / "README").write_text("changed\n")
+    assert key(srctop) == touched
+
+
+def test_miss_builds_and_hit_links_the_tree(fake_tools, repo, tmp_path):
+    stand = StandBuildCache("amd64", "amd64", srctop=str(repo))
+    test_dir = tmp_path / "test-stand"
+    assert not stand.install(str(test_dir))
+    cached = os.path.join(StandBuildCache.STAND_CACHE_DIR, stand.key())
+    # only /boot is kept from the installed tree
+    assert sorted(os.listdir(cached)) == ["boot"]
+    loader = os.path.join("boot", "loader.efi")
+    assert os.stat(test_dir / loader).st_ino == os.stat(os.path.join(cached, loader)).st_ino
+
+    (test_dir / "boot" / "stale").write_text("left by an earlier run")
+    assert stand.install(str(test_dir))
+    assert not (test_dir / "boot" / "stale").exists()
+    assert os.stat(test_dir / loader).st_ino == os.stat(os.path.join(cached, loader)).st_ino
+    assert os.listdir(StandBuildCache.STAND_CACHE_DIR) == [stand.key()]
+
+
+def test_failed_build_leaves_no_cache_entry(fake_tools, repo, tmp_path, monkeypatch):
+    failing = tmp_path / "failing"
+    failing.mkdir()
+    (failing / "make").write_text("#!/bin/sh\nexit 2\n")
+    (failing / "make").chmod(0o755)
+    monkeypatch.setenv("PATH", f"{failing}{os.pathsep}{os.environ['PATH']}")
+    stand = StandBuildCache("amd64", "amd64", srctop=str(repo))
+    with pytest.raises(Exception, match="Could not build stand for amd64/amd64"):
+        stand.install(str(tmp_path / "test-stand"))
+    assert os.listdir(StandBuildCache.STAND_CACHE_DIR) == []
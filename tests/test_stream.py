@@ -0,0 +1,98 @@
+from src.cli import main
+from src.core import engine
+from src.core.configuration import Config
+from src.core.cache_manager import CacheManager
+from src.core.pipeline import BuildPipeline
+from src.core.resource_manager import ResourceManager
+from tests.test_engine import write_recipe
+from click.testing import CliRunner
+import asyncio
+import types
+
+
+def configs():
+    return [Config("amd64:amd64", filesystem, interface, None, None, None)
+            for filesystem, interface in [("ufs", "gpt"), ("ufs", "mbr"), ("zfs", "gpt")]]
+
+
+# StubPipeline plans an image and a script stage per config, the image
+# stage writes the real recipe for the fake qemu instead of running mkimg
+class StubPipeline(BuildPipeline):
+
+    def __init__(self, configs, tmp_path, fail=(), max_workers=None):
+        super().__init__(configs, max_workers=max_workers)
+        self.tmp_path = tmp_path
+        self.fail = set(fail)
+        self.on_image = None
+
+    def plan(self):
+        for config in self.configs:
+            builder = types.SimpleNamespace(config=config, identifier=config.identifier)
+            self.builders.append(builder)
+            image = self.graph.add(f"image:{config.identifier}", self.image(config))
+            script = self.graph.add(f"script:{config.identifier}", lambda: None, [image.key])
+            self.final_stages[config.identifier] = script.key
+        return self.graph
+
+    def image(self, config):
+        def build():
+            if self.on_image:
+                self.on_image()
+            if config.identifier in self.fail:
+                raise RuntimeError("mkimg failed")
+            workdir = self.tmp_path / config.identifier
+            workdir.mkdir()
+            write_recipe(config, workdir)
+        return build
+
+
+def test_run_stream_boots_until_the_terminator(fake_tools, tmp_path):
+    matrix = configs()
+    for config in matrix:
+        (tmp_path / config.identifier).mkdir()
+        write_recipe(config, tmp_path / config.identifier)
+
+    async def run():
+        queue = asyncio.Queue()
+        for config in matrix:
+            queue.put_nowait(config)
+        queue.put_nowait(None)
+        return await engine.TestEngine(max_workers=2, timeout=30).run_stream(queue)
+    results = asyncio.run(run())
+    assert [result.config for result in results] == matrix
+    assert all(result.status == engine.TestResult.PASSED for result in results)
+
+
+def test_stream_only_skips_the_failed_build(fake_tools, tmp_path):
+    matrix = configs()
+    pipeline = StubPipeline(matrix, tmp_path, fail=[matrix[1].identifier], max_workers=2)
+    manager = ResourceManager([], reverify=True)
+    results = asyncio.run(manager.stream_async(pipeline, max_backlog=3))
+    assert sorted(result.config.identifier for result in results) == \
+        sorted([matrix[0].identifier, matrix[2].identifier])
+    assert all(result.status == engine.TestResult.PASSED for result in results)
+    assert manager.configs == matrix
+
+
+def test_stream_holds_images_past_the_backlog(fake_tools, tmp_path, monkeypatch):
+    monkeypatch.setattr("src.core.pipeline.StageGraph.POLL_INTERVAL", 0.05)
+    matrix = configs()
+    pipeline = StubPipeline(matrix, tmp_path, max_workers=3)
+    manager = ResourceManager([], reverify=True)
+    waiting = []
+    # images built or building that no test has finished yet
+    pipeline.on_image = lambda: waiting.append(pipeline.images_started() - len(manager.results))
+    results = asyncio.run(manager.stream_async(pipeline, max_backlog=1))
+    assert len(results) == 3
+    assert max(waiting) == 1
+
+
+def test_cli_stream_runs_neither_the_build_nor_the_test_path(monkeypatch):
+    calls = []
+    monkeypatch.setattr(ResourceManager, "stream", lambda self, pipeline, max_backlog=None: calls.append("stream"))
+    monkeypatch.setattr(ResourceManager, "work", lambda self: calls.append("work"))
+    monkeypatch.setattr(BuildPipeline, "run", lambda self, *args: calls.append("build") or [])
+    monkeypatch.setattr(CacheManager, "enforce", lambda self, *args, **kwargs: calls.append("enforce"))
+    result = CliRunner().invoke(main, ["run", "--stream", "-x", "!*-*-*-*"])
+    assert result.exit_code == 0, result.output
+    assert calls == ["stream", "enforce"]
@@ -0,0 +1,46 @@
+from src.core.builder import ConfigBuilder
+from src.core.configuration import Config
+from src.core.resource_manager import ResourceManager
+from src.core import engine
+from tests.test_engine import write_recipe
+import os
+
+
+def config():
+    return Config("amd64:amd64", "ufs", "gpt", None, None, None)
+
+
+def built(config):
+    builder = ConfigBuilder(config)
+    # the image's own key is covered by the artifact cache tests
+    builder.image_key = "image"
+    builder.build_freebsd_scripts()
+    return builder
+
+
+def test_fingerprint_ignores_the_monitor():
+    first, second = built(config()), built(config())
+    assert first.config.monitor != second.config.monitor
+    assert first.config.fingerprint == second.config.fingerprint
+    with open(second.script) as f:
+        script = f.read()
+    # only the written script has this run's monitor
+    assert second.config.monitor in script and "{monitor}" not in script
+
+
+def test_fingerprint_follows_the_recipe():
+    overlay = built(config())
+    direct = Config("amd64:amd64", "ufs", "gpt", None, None, None, recipe={"disk_mode": "direct"})
+    assert built(direct).config.fingerprint != overlay.config.fingerprint
+
+
+def test_reverify_boots_a_cached_pass(fake_tools, tmp_path):
+    amd64 = config()
+    write_recipe(amd64, tmp_path)
+    amd64.fingerprint = f"reverify-{os.getpid()}-{tmp_path.name}"
+    assert [r.status for r in ResourceManager([amd64]).work()] == [engine.TestResult.PASSED]
+    assert [r.status for r in ResourceManager([amd64]).work()] == [engine.TestResult.CACHED]
+    # the same inputs, booted anyway
+    manager = ResourceManager([amd64], reverify=True)
+    assert manager.verdicts is None
+    assert [r.status for r in manager.work()] == [engine.TestResult.PASSED]